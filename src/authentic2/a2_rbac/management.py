@@ -1,73 +1,201 @@
+import operator
+
 from django.utils.translation import ugettext_lazy as _
 from django.utils.text import slugify
+from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
 from django.db.models.signals import post_migrate
 from django.apps import apps
 
+from django_rbac.models import VIEW_OP, ADMIN_OP, SEARCH_OP
+from django_rbac.managers import defer_update_transitive_closure
 from django_rbac.utils import get_role_model, get_ou_model, \
-    get_permission_model
+    get_permission_model, get_role_parenting_model, get_operation
 
 from ..utils import get_fk_model
 from . import utils, app_settings, signal_handlers
 
 
 def update_ou_admin_roles(ou):
-    Role = get_role_model()
+    reconcile_ous_admin_roles([ou])
 
-    if app_settings.MANAGED_CONTENT_TYPES == ():
-        Role.objects.filter(slug='a2-managers-of-{ou.slug}'.format(ou=ou)) \
-            .delete()
-    else:
-        ou_admin_role = ou.get_admin_role()
 
+def update_ous_admin_roles():
+    '''Create general admin roles linked to all organizational units,
+       they give general administrative rights to all mamanged content types
+       scoped to the given organizational unit.
+    '''
+    OU = get_ou_model()
+    ou_all = list(OU.objects.all())
+    if len(ou_all) < 2:
+        # If there is no ou or less than two, only generate global management
+        # roles
+        return
+    reconcile_ous_admin_roles(ou_all)
+
+
+def get_scoped_managed_cts():
+    '''Return (key, content type, slug) for each managed content type whose
+       model is scoped by an organizational unit.
+    '''
+    scoped_cts = []
     for key in MANAGED_CT:
         ct = ContentType.objects.get_by_natural_key(key[0], key[1])
-        model_class = ct.model_class()
-        ou_model = get_fk_model(model_class, 'ou')
         # do not create scoped admin roles if the model is not scopable
-        if not ou_model:
+        if not get_fk_model(ct.model_class(), 'ou'):
             continue
-        name = unicode(MANAGED_CT[key]['name'])
-        slug = '_a2-' + slugify(name)
-        scoped_name = unicode(MANAGED_CT[key]['scoped_name'])
-        name = scoped_name.format(ou=ou)
-        ou_slug = slug + '-' + ou.slug
-        if app_settings.MANAGED_CONTENT_TYPES == ():
-            Role.objects.filter(slug=ou_slug, ou=ou).delete()
-            continue
-        else:
-            ou_ct_admin_role = Role.objects.get_admin_role(
-                instance=ct,
-                ou=ou,
-                name=name,
-                slug=ou_slug,
-                update_slug=True,
-                update_name=True)
-        if not app_settings.MANAGED_CONTENT_TYPES or \
-                key in app_settings.MANAGED_CONTENT_TYPES:
-            ou_ct_admin_role.add_child(ou_admin_role)
-        else:
-            ou_ct_admin_role.remove_child(ou_admin_role)
-        if MANAGED_CT[key].get('must_view_user'):
-            ou_ct_admin_role.permissions.add(utils.get_view_user_perm(ou))
-        ou_ct_admin_role.permissions.add(utils.get_search_ou_perm(ou))
+        slug = '_a2-' + slugify(unicode(MANAGED_CT[key]['name']))
+        scoped_cts.append((key, ct, slug))
+    return scoped_cts
 
 
-def update_ous_admin_roles():
-    '''Create general admin roles linked to all organizational units,
-       they give general administrative rights to all mamanged content types
-       scoped to the given organizational unit.
+def reconcile_ous_admin_roles(ous):
+    '''Create or update the admin roles of the given organizational units and
+       of their managed content types.
+
+       Wanted roles, permissions and parentings are computed in memory and
+       compared to the database using a fixed number of queries, only
+       missing or obsolete rows are then created or deleted.
     '''
     Role = get_role_model()
     Permission = get_permission_model()
+    RoleParenting = get_role_parenting_model()
+    RolePermission = Role.permissions.through
     OU = get_ou_model()
-    ou_all = OU.objects.all()
-    if len(ou_all) < 2:
-        # If there is no ou or less than two, only generate global management
-        # roles
+    ous = list(ous)
+    if not ous:
+        return
+    scoped_cts = get_scoped_managed_cts()
+
+    if app_settings.MANAGED_CONTENT_TYPES == ():
+        Role.objects.filter(
+            slug__in=['a2-managers-of-{ou.slug}'.format(ou=ou) for ou in ous]).delete()
+        obsolete = set((ou.pk, slug + '-' + ou.slug) for ou in ous for key, ct, slug in scoped_cts)
+        qs = Role.objects.filter(ou__in=ous, slug__in=[slug for ou_id, slug in obsolete])
+        Role.objects.filter(pk__in=[pk for pk, ou_id, slug in qs.values_list('pk', 'ou_id', 'slug')
+                                    if (ou_id, slug) in obsolete]).delete()
         return
-    for ou in ou_all:
-        update_ou_admin_roles(ou)
+
+    view_op = get_operation(VIEW_OP)
+    admin_op = get_operation(ADMIN_OP)
+    search_op = get_operation(SEARCH_OP)
+    ou_ct = ContentType.objects.get_for_model(OU)
+    ct_ct = ContentType.objects.get_for_model(ContentType)
+    user_ct = ContentType.objects.get_for_model(get_user_model())
+    perm_ct = ContentType.objects.get_for_model(Permission)
+
+    # permissions are identified by (operation, ou, target_ct, target_id), for
+    # each wanted role keep the permission it mirrors, its name, slug and ou
+    # and the other permissions it must have
+    wanted_roles = {}
+    wanted_parentings = set()
+    obsolete_parentings = set()
+    for ou in ous:
+        ou_admin_perm = (view_op.pk, None, ou_ct.pk, ou.pk)
+        search_ou_perm = (search_op.pk, None, ou_ct.pk, ou.pk)
+        view_user_perm = (view_op.pk, ou.pk, ct_ct.pk, user_ct.pk)
+        wanted_roles[ou_admin_perm] = (
+            None,
+            _('Managers of "{ou}"').format(ou=ou),
+            '_a2-managers-of-{ou.slug}'.format(ou=ou),
+            ())
+        for key, ct, slug in scoped_cts:
+            ct_admin_perm = (admin_op.pk, ou.pk, ct_ct.pk, ct.pk)
+            permissions = (search_ou_perm,)
+            if MANAGED_CT[key].get('must_view_user'):
+                permissions += (view_user_perm,)
+            wanted_roles[ct_admin_perm] = (
+                ou.pk,
+                unicode(MANAGED_CT[key]['scoped_name']).format(ou=ou),
+                slug + '-' + ou.slug,
+                permissions)
+            if not app_settings.MANAGED_CONTENT_TYPES or \
+                    key in app_settings.MANAGED_CONTENT_TYPES:
+                wanted_parentings.add((ct_admin_perm, ou_admin_perm))
+            else:
+                obsolete_parentings.add((ct_admin_perm, ou_admin_perm))
+
+    wanted_perms = set(wanted_roles)
+    for ou_id, name, slug, permissions in wanted_roles.itervalues():
+        wanted_perms.update(permissions)
+    ou_pks = [ou.pk for ou in ous]
+    perm_qs = Permission.objects.filter(
+        Q(target_ct=ou_ct, target_id__in=ou_pks, ou__isnull=True)
+        | Q(target_ct=ct_ct, ou__in=ou_pks),
+        operation__in=[view_op, admin_op, search_op])
+
+    def get_perms():
+        return dict(((perm.operation_id, perm.ou_id, perm.target_ct_id, perm.target_id),
+                     perm.pk) for perm in perm_qs.all())
+
+    with transaction.atomic(), defer_update_transitive_closure():
+        perms = get_perms()
+        missing_perms = wanted_perms - set(perms)
+        if missing_perms:
+            Permission.objects.bulk_create(
+                Permission(operation_id=operation_id, ou_id=ou_id, target_ct_id=target_ct_id,
+                           target_id=target_id)
+                for operation_id, ou_id, target_ct_id, target_id in missing_perms)
+            perms = get_perms()
+
+        roles = {}
+        for role in Role.objects.filter(
+                admin_scope_ct=perm_ct,
+                admin_scope_id__in=[perms[perm] for perm in wanted_roles]):
+            roles[role.admin_scope_id] = role
+        # roles are created or saved one by one as they are few and need
+        # the same slug handling as in Role.save()
+        for perm, (ou_id, name, slug, permissions) in wanted_roles.iteritems():
+            role = roles.get(perms[perm])
+            if role is None:
+                roles[perms[perm]] = Role.objects.create(
+                    admin_scope_ct=perm_ct, admin_scope_id=perms[perm], ou_id=ou_id,
+                    name=name, slug=slug)
+            elif (role.ou_id, role.name, role.slug) != (ou_id, name, slug):
+                role.ou_id, role.name, role.slug = ou_id, name, slug
+                role.save()
+
+        def role_pk(perm):
+            return roles[perms[perm]].pk
+
+        wanted_role_perms = set()
+        for perm, (ou_id, name, slug, permissions) in wanted_roles.iteritems():
+            for permission in (perm,) + permissions:
+                wanted_role_perms.add((role_pk(perm), perms[permission]))
+        existing_role_perms = set(
+            RolePermission.objects.filter(role__in=[role.pk for role in roles.itervalues()])
+            .values_list('role_id', 'permission_id'))
+        RolePermission.objects.bulk_create(
+            RolePermission(role_id=role_id, permission_id=permission_id)
+            for role_id, permission_id in wanted_role_perms - existing_role_perms)
+
+        wanted_parentings = set((role_pk(parent), role_pk(child))
+                                for parent, child in wanted_parentings)
+        obsolete_parentings = set((role_pk(parent), role_pk(child))
+                                  for parent, child in obsolete_parentings)
+        existing_parentings = set(
+            RoleParenting.objects.filter(
+                direct=True,
+                parent__in=[parent for parent, child in wanted_parentings | obsolete_parentings],
+                child__in=[child for parent, child in wanted_parentings | obsolete_parentings])
+            .values_list('parent_id', 'child_id'))
+        missing_parentings = wanted_parentings - existing_parentings
+        if missing_parentings:
+            RoleParenting.objects.bulk_create(
+                RoleParenting(parent_id=parent_id, child_id=child_id, direct=True)
+                for parent_id, child_id in missing_parentings)
+            # bulk_create() does not send post_save signals, the closure is updated with a new
+            # RBAC generation when leaving defer_update_transitive_closure()
+            RoleParenting.objects.tls.CLOSURE_UPDATED = True
+        obsolete_parentings &= existing_parentings
+        if obsolete_parentings:
+            RoleParenting.objects.filter(
+                reduce(operator.or_, (Q(parent=parent_id, child=child_id)
+                                         for parent_id, child_id in obsolete_parentings)),
+                direct=True).delete()
+
 
 MANAGED_CT = {
     ('a2_rbac', 'role'): {
@@ -206,6 +206,20 @@ default_settings = dict(
     A2_ACCOUNTS_URL=Setting(default=None, definition='IdP has no account page, redirect to this one.'),
     A2_CACHE_ENABLED=Setting(default=True, definition='Disable all cache decorators for testing purpose.'),
     A2_ACCEPT_EMAIL_AUTHENTICATION=Setting(default=True, definition='Enable authentication by email'),
+    A2_API_CREDENTIALS_CACHE_TIMEOUT=Setting(
+        default=60,
+        definition='Duration in seconds during which a successful verification of HTTP Basic '
+                   'credentials on the API is cached, 0 disables the cache'),
+    A2_LOGIN_BLOCKS_CACHE_TIMEOUT=Setting(
+        default=60,
+        definition='Duration in seconds during which the login forms of the authentication '
+                   'frontends are cached for anonymous users, 0 disables the cache'),
+    A2_LOG_COLLECTION_ENABLED=Setting(
+        default=False,
+        definition='Show the logs of the request on the error page to clients from INTERNAL_IPS'),
+    A2_LOG_COLLECTION_MAX_RECORDS=Setting(
+        default=200,
+        definition='Maximum number of log records kept for the error page, older ones are dropped'),
 
 )
 
@@ -11,6 +11,18 @@ class Authentic2Config(AppConfig):
     verbose_name = 'Authentic2'
 
     def ready(self):
+        from django.db.models.signals import post_save, post_delete
+        from django.core.signals import request_finished
+        from django_rbac.utils import new_rbac_generation
+        from .middleware import clear_stored_request
+        from .models import PasswordReset, AuthorizedRole
+        from .utils import clear_password_reset_cache
+
         plugins.init()
+        post_save.connect(clear_password_reset_cache, sender=PasswordReset)
+        post_delete.connect(clear_password_reset_cache, sender=PasswordReset)
+        post_save.connect(new_rbac_generation, sender=AuthorizedRole)
+        post_delete.connect(new_rbac_generation, sender=AuthorizedRole)
+        request_finished.connect(clear_stored_request)
         debug.HIDDEN_SETTINGS = re.compile(
             'API|TOKEN|KEY|SECRET|PASS|PROFANITIES_LIST|SIGNATURE|LDAP')
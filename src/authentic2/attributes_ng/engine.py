@@ -22,9 +22,13 @@ class UnsortableError(Exception):
     def __str__(self):
         return 'UnsortableError: %r' % self.unsortable_instances
 
-def topological_sort(source_and_instances, ctx, raise_on_unsortable=False):
+def topological_sort(source_and_instances, ctx, raise_on_unsortable=False,
+                     attribute_names=None):
     '''
     Sort instances topologically based on their dependency declarations.
+
+    If attribute_names is a dictionary, it receives the names of the attributes
+    produced by each sorted instance, indexed by (id(source), id(instance)).
     '''
     sorted_list = []
     variables = set(ctx.keys())
@@ -36,7 +40,10 @@ def topological_sort(source_and_instances, ctx, raise_on_unsortable=False):
             dependencies = set(source.get_dependencies(instance, ctx))
             if dependencies <= variables:
                 sorted_list.append((source, instance))
-                variables.update(a for a, b in source.get_attribute_names(instance, ctx))
+                names = set(a for a, b in source.get_attribute_names(instance, ctx) or ())
+                if attribute_names is not None:
+                    attribute_names[(id(source), id(instance))] = names
+                variables.update(names)
             else:
                 new_unsorted.append((source, instance))
         unsorted = new_unsorted
@@ -79,18 +86,51 @@ def get_attribute_names(ctx):
                 yield attribute_name, attribute_description
 
 
+def prune_instances(sorted_list, ctx, wanted_attributes, attribute_names=None):
+    '''
+    Keep only instances producing wanted attributes or attributes needed by
+    them. sorted_list must be topologically sorted, attribute_names is the
+    dictionary filled by topological_sort().
+    '''
+    attribute_names = attribute_names or {}
+    needed = set()
+    for name in wanted_attributes:
+        needed.add(name)
+        # verified flags are produced alongside the attribute itself
+        if name.endswith(':verified'):
+            needed.add(name[:-len(':verified')])
+    kept = []
+    for source, instance in reversed(sorted_list):
+        names = attribute_names.get((id(source), id(instance)))
+        if names is None:
+            names = set(a for a, b in source.get_attribute_names(instance, ctx) or ())
+        if names and not (names & needed):
+            continue
+        needed.update(source.get_dependencies(instance, ctx))
+        kept.append((source, instance))
+    kept.reverse()
+    return kept
+
+
 def get_attributes(ctx):
     '''
     Traverse and sources instances and aggregate produced attributes.
 
     Traversal is done by respecting a topological sort of instances based on
-    their declared dependencies
+    their declared dependencies. If ctx contains a '__wanted_attributes' list,
+    only instances needed to compute those attributes are traversed.
     '''
     source_and_instances = []
     for source in get_sources():
         source_and_instances.extend(((source, instance) for instance in
             source.get_instances(ctx)))
-    source_and_instances = topological_sort(source_and_instances, ctx)
+    attribute_names = {}
+    source_and_instances = topological_sort(source_and_instances, ctx,
+                                            attribute_names=attribute_names)
+    wanted_attributes = ctx.get('__wanted_attributes')
+    if wanted_attributes is not None:
+        source_and_instances = prune_instances(source_and_instances, ctx, wanted_attributes,
+                                               attribute_names=attribute_names)
     ctx = ctx.copy()
     for source, instance in source_and_instances:
         ctx.update(source.get_attributes(instance, ctx.copy()))
@@ -1,8 +1,19 @@
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes
+
 from authentic2_idp_oidc.models import OIDCClient
 
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.authentication import BasicAuthentication
 
+from . import app_settings
+
 
 class OIDCUser(object):
     """ Fake user class to return in case OIDC authentication
@@ -28,12 +39,55 @@ class OIDCUser(object):
         return self.authenticated
 
 
+CREDENTIALS_CACHE_KEY = 'a2-api-credentials|%s'
+
+
+def credentials_digest(*parts):
+    '''Keyed hash of credentials, cached values cannot be used to brute-force passwords without
+       the secret key.'''
+    msg = '\0'.join(force_bytes(part) for part in parts)
+    return hmac.new(force_bytes(settings.SECRET_KEY), msg, hashlib.sha256).hexdigest()
+
+
 class Authentic2Authentication(BasicAuthentication):
+    '''Authenticate OIDC clients with API access and users using HTTP Basic authentication.
+
+       Successful user verifications are cached for A2_API_CREDENTIALS_CACHE_TIMEOUT seconds,
+       the cached verification is tied to the current password hash of the user so that it
+       becomes invalid as soon as the password changes.
+    '''
+
+    def get_credentials_cache_timeout(self):
+        if not app_settings.A2_CACHE_ENABLED:
+            return 0
+        return app_settings.A2_API_CREDENTIALS_CACHE_TIMEOUT
+
+    def get_cached_user(self, userid, password):
+        key = CREDENTIALS_CACHE_KEY % credentials_digest(userid, password)
+        cached = cache.get(key)
+        if not cached:
+            return None
+        user_pk, backend, digest = cached
+        user = get_user_model().objects.filter(pk=user_pk).first()
+        if (user is None or not user.is_active
+                or not constant_time_compare(
+                    digest, credentials_digest(userid, password, user.password))):
+            cache.delete(key)
+            return None
+        user.backend = backend
+        return user
+
+    def set_cached_user(self, userid, password, user, timeout):
+        if not getattr(user, 'pk', None):
+            return
+        key = CREDENTIALS_CACHE_KEY % credentials_digest(userid, password)
+        digest = credentials_digest(userid, password, user.password)
+        cache.set(key, (user.pk, getattr(user, 'backend', None), digest), timeout)
 
     def authenticate_credentials(self, userid, password):
         # try Simple OIDC Authentication
-        try:
-            client = OIDCClient.objects.get(client_id=userid, client_secret=password)
+        client = OIDCClient.objects.filter(client_id=userid).first()
+        if client is not None and constant_time_compare(client.client_secret, password):
             if not client.has_api_access:
                 raise AuthenticationFailed('OIDC client does not have access to the API')
             if client.identifier_policy not in (client.POLICY_UUID,
@@ -43,7 +97,14 @@ class Authentic2Authentication(BasicAuthentication):
             user = OIDCUser(client)
             user.authenticated = True
             return (user, True)
-        except OIDCClient.DoesNotExist:
-            pass
         # try BasicAuthentication
-        return super(Authentic2Authentication, self).authenticate_credentials(userid, password)
+        timeout = self.get_credentials_cache_timeout()
+        if timeout:
+            user = self.get_cached_user(userid, password)
+            if user is not None:
+                return (user, None)
+        user, auth = super(Authentic2Authentication, self).authenticate_credentials(userid,
+                                                                                    password)
+        if timeout:
+            self.set_cached_user(userid, password, user, timeout)
+        return (user, auth)
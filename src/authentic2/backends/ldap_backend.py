@@ -12,6 +12,8 @@ import logging
 import random
 import base64
 import urllib
+import hashlib
+import json
 import six
 import os
 
@@ -22,6 +24,7 @@ log = logging.getLogger(__name__)
 
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.models import Group
 from django.utils.encoding import force_bytes, force_text
 
@@ -57,6 +60,12 @@ for bundle_path in CA_BUNDLE_PATHS:
         DEFAULT_CA_BUNDLE = bundle_path
         break
 
+# hits and misses of the LDAP attributes cache, see LDAPBackend.get_cached_ldap_attributes()
+ATTRIBUTES_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+}
+
 
 def map_bytes(d):
     if isinstance(d, six.string_types):
@@ -96,8 +105,8 @@ class LDAPUser(get_user_model()):
             # retrieve encrypted bind pw if necessary
             encrypted_bindpw = self.ldap_data.get('block', {}).get('encrypted_bindpw')
             if encrypted_bindpw:
-                decrypted = crypto.aes_base64_decrypt(settings.SECRET_KEY, encrypted_bindpw,
-                                                      raise_on_error=False)
+                decrypted = crypto.aes_base64_authenticated_decrypt(
+                    settings.SECRET_KEY, encrypted_bindpw, raise_on_error=False)
                 if decrypted:
                     decrypted = force_text(decrypted)
                     self.ldap_data['block']['bindpw'] = decrypted
@@ -108,7 +117,7 @@ class LDAPUser(get_user_model()):
         data = dict(self.ldap_data)
         data['block'] = dict(data['block'])
         if data['block'].get('bindpw'):
-            data['block']['encrypted_bindpw'] = crypto.aes_base64_encrypt(
+            data['block']['encrypted_bindpw'] = crypto.aes_base64_authenticated_encrypt(
                 settings.SECRET_KEY, force_bytes(data['block']['bindpw']))
             del data['block']['bindpw']
         session[self.SESSION_LDAP_DATA_KEY] = data
@@ -142,7 +151,8 @@ class LDAPUser(get_user_model()):
         cache = self.ldap_data.setdefault('password', {})
         if password is not None:
             # Prevent eavesdropping of the password through the session storage
-            password = crypto.aes_base64_encrypt(settings.SECRET_KEY, force_bytes(password))
+            password = crypto.aes_base64_authenticated_encrypt(settings.SECRET_KEY,
+                                                               force_bytes(password))
         cache[self.dn] = password
         # ensure session is marked dirty
         self.update_request()
@@ -153,7 +163,8 @@ class LDAPUser(get_user_model()):
             password = cache.get(self.dn)
             if password is not None:
                 try:
-                    password = crypto.aes_base64_decrypt(settings.SECRET_KEY, password)
+                    password = crypto.aes_base64_authenticated_decrypt(settings.SECRET_KEY,
+                                                                       password)
                 except crypto.DecryptionError:
                     logging.getLogger(__name__).error('unable to decrypt a stored LDAP password')
                     self.keep_password_in_session(None)
@@ -185,6 +196,7 @@ class LDAPUser(get_user_model()):
             conn = self.get_connection()
             self.ldap_backend.modify_password(conn, self.block, self.dn, old_password, new_password)
         self.keep_password_in_session(new_password)
+        self.ldap_backend.clear_ldap_attributes_cache(self.block, self.dn)
         if self.block['keep_password']:
             super(LDAPUser, self).set_password(new_password)
         else:
@@ -204,9 +216,19 @@ class LDAPUser(get_user_model()):
         self.ldap_backend.update_default(self.block, validate=False)
         return self.ldap_backend.get_connection(self.block, credentials=credentials)
 
-    def get_attributes(self):
+    def get_attributes(self, refresh=False):
+        '''Return LDAP attributes of the user, from the cache if the block defines an
+           attributes_cache_timeout and refresh is False.'''
+        if not refresh:
+            attributes = self.ldap_backend.get_cached_ldap_attributes(self.block, self.dn)
+            if attributes is not None:
+                return attributes
         conn = self.get_connection()
-        return self.ldap_backend.get_ldap_attributes(self.block, conn, self.dn) or {}
+        attributes = self.ldap_backend.get_ldap_attributes(self.block, conn, self.dn)
+        if attributes is None:
+            return {}
+        self.ldap_backend.set_cached_ldap_attributes(self.block, self.dn, attributes)
+        return attributes
 
     def save(self, *args, **kwargs):
         if hasattr(self, 'keep_pk'):
@@ -316,6 +338,8 @@ class LDAPBackend(object):
         'connect_with_user_credentials': True,
         # can reset password
         'can_reset_password': False,
+        # how long in seconds to keep retrieved attributes of an user in the cache, 0 to disable
+        'attributes_cache_timeout': 0,
     }
     _REQUIRED = ('url', 'basedn')
     _TO_ITERABLE = ('url', 'groupsu', 'groupstaff', 'groupactive')
@@ -876,11 +900,57 @@ class LDAPBackend(object):
                         .filter(user=user, source=block['realm']) \
                         .delete()
 
+    @classmethod
+    def get_ldap_attributes_cache_key(cls, block, dn):
+        urls = block['url']
+        if isinstance(urls, six.string_types):
+            urls = [urls]
+        # attributes also depend on the configuration of the block
+        config = json.dumps([
+            sorted(cls.get_ldap_attributes_names(block)),
+            [map(force_text, mapping) for mapping in block['attribute_mappings']],
+            block['mandatory_attributes_values'],
+        ], sort_keys=True)
+        key = u'%s|%s|%s|%s' % (block['realm'], u' '.join(map(force_text, urls)),
+                                force_text(dn).lower(), config)
+        return 'a2-ldap-attributes|%s' % hashlib.sha1(force_bytes(key)).hexdigest()
+
+    @classmethod
+    def get_cached_ldap_attributes(cls, block, dn):
+        '''Return attributes stored by set_cached_ldap_attributes() or None'''
+        if not block.get('attributes_cache_timeout') or not app_settings.A2_CACHE_ENABLED:
+            return None
+        attributes = cache.get(cls.get_ldap_attributes_cache_key(block, dn))
+        if attributes is None:
+            ATTRIBUTES_CACHE_STATS['misses'] += 1
+        else:
+            ATTRIBUTES_CACHE_STATS['hits'] += 1
+        log.debug('LDAP attributes cache %s for %r (hits: %d, misses: %d)',
+                  'miss' if attributes is None else 'hit', dn,
+                  ATTRIBUTES_CACHE_STATS['hits'], ATTRIBUTES_CACHE_STATS['misses'])
+        return attributes
+
+    @classmethod
+    def set_cached_ldap_attributes(cls, block, dn, attributes):
+        timeout = block.get('attributes_cache_timeout')
+        if not timeout or not app_settings.A2_CACHE_ENABLED:
+            return
+        cache.set(cls.get_ldap_attributes_cache_key(block, dn), attributes, timeout)
+
+    @classmethod
+    def clear_ldap_attributes_cache(cls, block, dn):
+        if not block.get('attributes_cache_timeout'):
+            return
+        cache.delete(cls.get_ldap_attributes_cache_key(block, dn))
+
     def _return_user(self, dn, password, conn, block, attributes=None):
         attributes = attributes or self.get_ldap_attributes(block, conn, dn)
         if attributes is None:
             # attributes retrieval failed
             return
+        # attributes were just retrieved for the login or the synchronization, later calls to
+        # LDAPUser.get_attributes() can use them
+        self.set_cached_ldap_attributes(block, dn, attributes)
         log.debug('retrieved attributes for %r: %r', dn, attributes)
         username = self.create_username(block, attributes)
         if not username:
@@ -8,6 +8,8 @@ from Crypto.Hash import SHA256
 from Crypto.Hash import HMAC
 from Crypto import Random
 
+from django.utils.crypto import constant_time_compare
+
 
 class DecryptionError(Exception):
     pass
@@ -61,6 +63,74 @@ def aes_base64_decrypt(key, payload, raise_on_error=True):
     return aes.decrypt(crypted)
 
 
+# PBKDF2 is costly and the key material (generally settings.SECRET_KEY) does not change during the
+# life of a process, so derived keys are computed once.
+_derived_keys_cache = {}
+
+DERIVED_KEYS_SALT = 'authentic2.crypto.derived-keys'
+
+
+def get_derived_keys(key):
+    '''Derive an AES-128 key and an HMAC-SHA256 key from any key material using PBKDF2, result is
+       memoized per process.
+    '''
+    cache_key = hashlib.sha256(key).digest()
+    keys = _derived_keys_cache.get(cache_key)
+    if keys is None:
+        prf = lambda secret, salt: HMAC.new(secret, salt, SHA256).digest()
+        derived = PBKDF2(key, DERIVED_KEYS_SALT, dkLen=48, prf=prf)
+        keys = _derived_keys_cache[cache_key] = (derived[:16], derived[16:])
+    return keys
+
+
+def aes_base64_authenticated_encrypt(key, data):
+    '''Encrypt data using AES-128 in CFB mode with a new random IV for each message, then sign the
+       header, the IV and the ciphertext with HMAC-SHA256 shortened to 128 bits.
+
+       Contrary to aes_base64_encrypt() keys are derived only once per process.
+    '''
+    mode = 2  # AES128-CFB-SHA256
+    aes_key, hmac_key = get_derived_keys(key)
+    iv = Random.get_random_bytes(16)
+    aes = AES.new(aes_key, AES.MODE_CFB, iv)
+    crypted = struct.pack('<2sB', 'a2', mode) + iv + aes.encrypt(data)
+    hmac = HMAC.new(hmac_key, crypted, SHA256).digest()[:16]
+    return base64url_encode(crypted + hmac)
+
+
+def aes_base64_authenticated_decrypt(key, payload, raise_on_error=True):
+    '''Decrypt data encrypted with aes_base64_authenticated_encrypt, payloads produced by
+       aes_base64_encrypt are also accepted.
+    '''
+    try:
+        if '$' in payload:
+            return aes_base64_decrypt(key, payload)
+        try:
+            raw = base64url_decode(payload)
+        except Exception as e:
+            raise DecryptionError('base64 decoding failed', e)
+        try:
+            magic, mode = struct.unpack('<2sB', raw[:3])
+        except struct.error as e:
+            raise DecryptionError('invalid packing', e)
+        if magic != 'a2':
+            raise DecryptionError('invalid magic string', magic)
+        if mode != 2:
+            raise DecryptionError('mode is not AES128-CFB-SHA256', mode)
+        if len(raw) < 3 + 16 + 16:
+            raise DecryptionError('payload is too short')
+        aes_key, hmac_key = get_derived_keys(key)
+        crypted, hmac = raw[:-16], raw[-16:]
+        if not constant_time_compare(HMAC.new(hmac_key, crypted, SHA256).digest()[:16], hmac):
+            raise DecryptionError('invalid HMAC')
+        aes = AES.new(aes_key, AES.MODE_CFB, crypted[3:19])
+        return aes.decrypt(crypted[19:])
+    except DecryptionError:
+        if not raise_on_error:
+            return None
+        raise
+
+
 def add_padding(msg, block_size):
     '''Pad message with zero bytes to match block_size'''
     pad_length = block_size - (len(msg) + 2) % block_size
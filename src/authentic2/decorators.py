@@ -1,8 +1,11 @@
 import pickle
 import re
+import random
+import hashlib
 from json import dumps as json_dumps
 from contextlib import contextmanager
 import time
+import threading
 from functools import wraps
 
 from django.contrib.auth.decorators import login_required
@@ -111,12 +114,16 @@ class CacheDecoratorBase(object):
             return cls(**kwargs)(args[0])
         return super(CacheDecoratorBase, cls).__new__(cls, *args, **kwargs)
 
+    DEFAULT_MAX_SIZE = 1000
+
     def __init__(self, timeout=None, hostname_vary=True, args=None,
-                 kwargs=None):
+                 kwargs=None, max_size=DEFAULT_MAX_SIZE):
         self.timeout = timeout
         self.hostname_vary = hostname_vary
         self.args = args
         self.kwargs = kwargs
+        self.max_size = max_size
+        self.hits = self.misses = 0
 
     def set(self, key, value):
         raise NotImplementedError
@@ -127,6 +134,16 @@ class CacheDecoratorBase(object):
     def clear(self):
         raise NotImplementedError
 
+    def invalidate(self, *args, **kwargs):
+        '''Clear the cache, can be used as a signal receiver'''
+        self.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
     def __call__(self, func):
         @wraps(func)
         def f(*args, **kwargs):
@@ -139,9 +156,11 @@ class CacheDecoratorBase(object):
                 if tstamp is not None:
                     if self.timeout is None or \
                        tstamp + self.timeout > now:
+                           self.hits += 1
                            return value
                     if hasattr(self, 'delete'):
-                        self.delete(key, (key, tstamp))
+                        self.delete(key, (value, tstamp))
+                self.misses += 1
                 value = func(*args, **kwargs)
                 self.set(key, (value, now))
                 return value
@@ -150,9 +169,12 @@ class CacheDecoratorBase(object):
         f.cache = self
         return f
 
+    def key_prefix(self):
+        return str(id(self))
+
     def key(self, *args, **kwargs):
         '''Transform arguments to string and build a key from it'''
-        parts = [str(id(self))] # add cache instance to the key
+        parts = [self.key_prefix()] # add cache instance to the key
         if self.hostname_vary:
             request = middleware.StoreRequestMiddleware.get_request()
             if request:
@@ -185,17 +207,24 @@ class SimpleDictionnaryCacheMixin(object):
         return self.cache.get(key, (None, None))
 
     def delete(self, key, value):
-        if key in self.cache and self.cache[key] == value:
-            del self.cache[key]
+        if self.cache.get(key) == value:
+            self.cache.pop(key, None)
 
     def clear(self):
         self.cache.clear()
 
 
 class GlobalCache(SimpleDictionnaryCacheMixin, CacheDecoratorBase):
+    '''Cache values in the process, at most max_size values are kept'''
     def __init__(self, *args, **kwargs):
-        self.cache = {}
         super(GlobalCache, self).__init__(*args, **kwargs)
+        self.cache = utils.LRUCache(max_size=self.max_size, timeout=self.timeout)
+
+    def stats(self):
+        stats = super(GlobalCache, self).stats()
+        if isinstance(self.cache, utils.LRUCache):
+            stats.update(self.cache.stats(), hits=stats['hits'], misses=stats['misses'])
+        return stats
 
 
 class RequestCache(SimpleDictionnaryCacheMixin, CacheDecoratorBase):
@@ -204,21 +233,137 @@ class RequestCache(SimpleDictionnaryCacheMixin, CacheDecoratorBase):
         request = middleware.StoreRequestMiddleware.get_request()
         if not request:
             return {}
-        # create a cache dictionary on the request
-        return request.__dict__.setdefault(self.__class__.__name__, {})
+        # create a cache on the request
+        cache = request.__dict__.get(self.__class__.__name__)
+        if cache is None:
+            cache = request.__dict__[self.__class__.__name__] = utils.LRUCache(
+                max_size=self.max_size)
+        return cache
 
 
 class DjangoCache(SimpleDictionnaryCacheMixin, CacheDecoratorBase):
+    '''Cache values in the Django cache, they are shared between processes.
+
+       Timeouts are randomly increased by up to jitter (a ratio of the timeout) so that values
+       computed together do not expire together. Expired values are kept grace more seconds
+       (the timeout by default): during this time a single caller recomputes the value while
+       concurrent callers get the stale one. clear() invalidates all values by changing the
+       version stored with them; the version and the value are fetched together.
+    '''
+    VERSION_KEY = 'a2-cache-version|%s'
+
+    def __init__(self, *args, **kwargs):
+        self.jitter = kwargs.pop('jitter', 0.1)
+        self.grace = kwargs.pop('grace', None)
+        self.lock_timeout = kwargs.pop('lock_timeout', 60)
+        super(DjangoCache, self).__init__(*args, **kwargs)
+        if self.grace is None:
+            self.grace = self.timeout
+        self.name = str(id(self))
+        self.stale_hits = 0
+        self.local = threading.local()
+
     @property
     def cache(self):
         return django_cache
 
+    def version_key(self):
+        return self.VERSION_KEY % self.name
+
+    def get_version(self, version=None):
+        if version is None:
+            version = self.cache.get(self.version_key())
+        if version is None:
+            version = utils.get_hex_uuid()[:8]
+            if not self.cache.add(self.version_key(), version, None):
+                version = self.cache.get(self.version_key(), version)
+        return version
+
+    def key_prefix(self):
+        return self.name
+
+    def key(self, *args, **kwargs):
+        key = super(DjangoCache, self).key(*args, **kwargs)
+        # keep keys short and valid for memcached
+        return 'a2-cache|%s' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_timeout(self):
+        if self.timeout is None:
+            return None
+        return self.timeout * (1 + random.uniform(0, self.jitter))
+
     def set(self, key, value):
-        self.cache.set(key, value, timeout=self.timeout)
+        value, tstamp = value
+        # store the version seen when the value was looked up, a value computed before a
+        # clear() must not look valid after it
+        version = getattr(self.local, 'version', None) or self.get_version()
+        timeout = self.get_timeout()
+        if timeout is None:
+            self.cache.set(key, (value, None, version), timeout=None)
+        else:
+            self.cache.set(key, (value, tstamp + timeout, version), timeout=timeout + self.grace)
+
+    def get(self, key):
+        values = self.cache.get_many([self.version_key(), key])
+        version = self.local.version = self.get_version(values.get(self.version_key()))
+        entry = values.get(key)
+        if entry is None or entry[2] != version:
+            return (None, None)
+        return entry[:2]
 
     def delete(self, key, value):
         if self.get(key) == value:
-            self.delete(key)
+            self.cache.delete(key)
+
+    def clear(self):
+        self.cache.set(self.version_key(), utils.get_hex_uuid()[:8], None)
+
+    def stats(self):
+        stats = super(DjangoCache, self).stats()
+        stats['stale_hits'] = self.stale_hits
+        return stats
+
+    def __call__(self, func):
+        # methods of different classes can share a name, the line number tells them apart
+        code = getattr(func, '__code__', None)
+        self.name = '%s.%s.%s' % (func.__module__, func.__name__,
+                                  code.co_firstlineno if code else id(self))
+
+        @wraps(func)
+        def f(*args, **kwargs):
+            try:
+                if not app_settings.A2_CACHE_ENABLED or self.timeout == 0:
+                    raise CacheUnusable
+                key = self.key(*args, **kwargs)
+            except CacheUnusable:  # fallback when cache cannot be used
+                return func(*args, **kwargs)
+            now = time.time()
+            value, expires = self.get(key)
+            if expires is None and value is not None:
+                self.hits += 1
+                return value
+            if expires is not None:
+                if expires > now:
+                    self.hits += 1
+                    return value
+                # stale value, only the caller getting the lock recomputes it
+                lock_key = key + '|lock'
+                if not self.cache.add(lock_key, 1, self.lock_timeout):
+                    self.stale_hits += 1
+                    return value
+                try:
+                    self.misses += 1
+                    value = func(*args, **kwargs)
+                    self.set(key, (value, now))
+                finally:
+                    self.cache.delete(lock_key)
+                return value
+            self.misses += 1
+            value = func(*args, **kwargs)
+            self.set(key, (value, now))
+            return value
+        f.cache = self
+        return f
 
 
 class PickleCacheMixin(object):
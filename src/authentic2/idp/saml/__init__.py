@@ -26,10 +26,9 @@ class Plugin(object):
 
     def check_origin(self, request, origin):
         from authentic2.cors import make_origin
-        from authentic2.saml.models import LibertySession
-        for session in LibertySession.objects.filter(
-                django_session_key=request.session.session_key):
-            provider_origin = make_origin(session.provider_id)
+        from authentic2.saml.models import get_session_provider_ids
+        for provider_id in get_session_provider_ids(request.session.session_key):
+            provider_origin = make_origin(provider_id)
             if origin == provider_origin:
                 return True
 
@@ -37,6 +36,19 @@ class Plugin(object):
 class SAML2IdPConfig(AppConfig):
     name = 'authentic2.idp.saml'
     label = 'authentic2_idp_saml'
+
+    def ready(self):
+        from django.db.models.signals import post_save, post_delete
+        from authentic2.saml.models import (LibertySession, LibertyServiceProvider,
+                                            SAMLAttribute, SPOptionsIdPPolicy,
+                                            clear_session_provider_ids)
+        from authentic2.saml.common import clear_attribute_release_plan_cache
+
+        post_save.connect(clear_session_provider_ids, sender=LibertySession)
+        post_delete.connect(clear_session_provider_ids, sender=LibertySession)
+        for sender in (SAMLAttribute, SPOptionsIdPPolicy, LibertyServiceProvider):
+            post_save.connect(clear_attribute_release_plan_cache, sender=sender)
+            post_delete.connect(clear_attribute_release_plan_cache, sender=sender)
 default_app_config = 'authentic2.idp.saml.SAML2IdPConfig'
 
 
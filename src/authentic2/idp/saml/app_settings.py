@@ -51,6 +51,9 @@ wRiVcNacaP+BivkrMjr4BlsUM6yH4MOBsNhLURiiCL+tLJV7U0DWlCse/doWij4U
 TKX6tp6oI+7MIJE6ySZ0cBqOiydAkBePZhu57j6ToBkTa0dbHjn1WA==
 -----END RSA PRIVATE KEY-----''',
             ADD_CERTIFICATE_TO_KEY_INFO=True,
+            SLO_SOAP_MAX_WORKERS=8,
+            SLO_SOAP_TIMEOUT=5,
+            SLO_SOAP_DEADLINE=10,
     )
 
     def __init__(self, prefix):
@@ -26,9 +26,7 @@ class SamlBackend(object):
             Q(liberty_provider__authorized_roles__isnull=True)
             | Q(liberty_provider__authorized_roles__in=request.user.roles_and_parents()))
         ls = []
-        sessions = models.LibertySession.objects.filter(
-            django_session_key=request.session.session_key)
-        sessions_eids = set(session.provider_id for session in sessions)
+        sessions_eids = models.get_session_provider_ids(request.session.session_key)
         all_policy = common.get_sp_options_policy_all()
         default_policy = common.get_sp_options_policy_default()
         queries = []
@@ -96,38 +94,38 @@ class SamlBackend(object):
         return ls
 
     def logout_list(self, request):
-        all_sessions = models.LibertySession.objects.filter(
-            django_session_key=request.session.session_key)
-        self.logger.debug("all_sessions %r" % all_sessions)
-        provider_ids = set([s.provider_id for s in all_sessions])
+        provider_ids = models.get_session_provider_ids(request.session.session_key)
         self.logger.debug("provider_ids %r" % provider_ids)
         result = []
-        for provider_id in provider_ids:
-            name = provider_id
-            provider = None
-            try:
-                provider = models.LibertyProvider.objects.get(entity_id=provider_id)
-                name = provider.name
-            except models.LibertyProvider.DoesNotExist:
+        if not provider_ids:
+            return result
+        qs = models.LibertyProvider.objects.filter(entity_id__in=provider_ids)
+        qs = qs.select_related('service_provider__sp_options_policy')
+        providers = dict((provider.entity_id, provider) for provider in qs)
+        for provider_id in sorted(provider_ids):
+            provider = providers.get(provider_id)
+            if provider is None:
                 self.logger.error(u'session found for unknown provider %s', provider_id)
+                continue
+            # global policies are cached per request and the service provider with its policy
+            # is already loaded, no query is done here
+            policy = common.get_sp_options_policy(provider)
+            if not policy:
+                self.logger.error(u'No policy found for %s', provider_id)
+            elif not policy.forward_slo:
+                self.logger.info(u'%s configured to not reveive slo', provider_id)
             else:
-                policy = common.get_sp_options_policy(provider)
-                if not policy:
-                    self.logger.error(u'No policy found for %s', provider_id)
-                elif not policy.forward_slo:
-                    self.logger.info(u'%s configured to not reveive slo', provider_id)
-                else:
-                    url = reverse(saml2_endpoints.idp_slo, args=[provider_id])
-                    # add a nonce so this link is never cached
-                    nonce = hex(random.getrandbits(128))
-                    url = '{0}?provider_id={1}&nonce={2}'.format(
-                        url, urllib.quote(provider_id), nonce)
-                    name = name or provider_id
-                    code = render_to_string('idp/saml/logout_fragment.html', {
-                        'needs_iframe': policy.needs_iframe_logout,
-                        'name': name, 'url': url,
-                        'iframe_timeout': policy.iframe_logout_timeout})
-                    result.append(code)
+                url = reverse(saml2_endpoints.idp_slo, args=[provider_id])
+                # add a nonce so this link is never cached
+                nonce = hex(random.getrandbits(128))
+                url = '{0}?provider_id={1}&nonce={2}'.format(
+                    url, urllib.quote(provider_id), nonce)
+                name = provider.name or provider_id
+                code = render_to_string('idp/saml/logout_fragment.html', {
+                    'needs_iframe': policy.needs_iframe_logout,
+                    'name': name, 'url': url,
+                    'iframe_timeout': policy.iframe_logout_timeout})
+                result.append(code)
         return result
 
     def links(self, request):
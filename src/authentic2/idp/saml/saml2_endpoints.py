@@ -49,7 +49,7 @@ from authentic2.saml.models import (LibertyArtifact,
     LibertySession, LibertyFederation, 
     nameid2kwargs, saml2_urn_to_nidformat,
     nidformat_to_saml2_urn, save_key_values, get_and_delete_key_values,
-    LibertyProvider, LibertyServiceProvider, SAMLAttribute, NAME_ID_FORMATS)
+    LibertyProvider, LibertyServiceProvider, NAME_ID_FORMATS)
 from authentic2.saml.common import redirect_next, asynchronous_bindings, \
     soap_bindings, load_provider, get_saml2_request_message, \
     error_page, set_saml2_response_responder_status_code, \
@@ -63,18 +63,20 @@ from authentic2.saml.common import redirect_next, asynchronous_bindings, \
     AUTHENTIC_STATUS_CODE_UNKNOWN_SESSION, \
     AUTHENTIC_STATUS_CODE_INTERNAL_SERVER_ERROR, \
     AUTHENTIC_STATUS_CODE_UNAUTHORIZED, \
-    send_soap_request, get_saml2_query_request, \
+    send_soap_request, soap_call_many, SOAPException, get_saml2_query_request, \
     get_saml2_request_message_async_binding, create_saml2_server, \
-    get_saml2_metadata, get_sp_options_policy, \
+    get_saml2_metadata, get_sp_options_policy, get_attribute_release_plan, \
     get_entity_id, AUTHENTIC_SAME_ID_SENTINEL
 import authentic2.saml.saml2utils as saml2utils
+from authentic2.saml.utils import lazy_dump
 from common import kill_django_sessions
 from authentic2.constants import NONCE_FIELD_NAME
 
 from authentic2.idp import signals as idp_signals
 
 from authentic2.utils import (make_url, get_backends as get_idp_backends,
-        get_username, login_require, find_authentication_event, datetime_to_xs_datetime)
+        get_username, login_require, find_authentication_event, datetime_to_xs_datetime,
+        normalize_attribute_values)
 from authentic2 import utils
 from authentic2.attributes_ng.engine import get_attributes
 from authentic2 import hooks
@@ -185,25 +187,14 @@ def fill_assertion(request, saml_request, assertion, provider_id, nid_format):
                 edu_person_targeted_id)
     assertion.subject.nameID.format = NAME_ID_FORMATS[nid_format]['samlv2']
 
-def get_attribute_definitions(provider):
-    '''Query all attribute definitions for a providers'''
-    qs = SAMLAttribute.objects.for_generic_object(provider) \
-            .filter(enabled=True)
-    sp_options_policy = get_sp_options_policy(provider)
-    if sp_options_policy:
-        qs |= SAMLAttribute.objects.for_generic_object(sp_options_policy) \
-                .filter(enabled=True)
-    return qs.distinct()
-
 def add_attributes(request, assertion, provider):
-    qs = get_attribute_definitions(provider)
-    wanted_attributes = [definition.attribute_name for definition in qs]
+    wanted_attributes, definitions = get_attribute_release_plan(provider.pk)
 
     ctx = get_attributes({
         'request': request,
         'user': request.user,
         'service': provider,
-        '__wanted_attributes': wanted_attributes,
+        '__wanted_attributes': list(wanted_attributes),
     })
     if not assertion.attributeStatement:
         assertion.attributeStatement = [lasso.Saml2AttributeStatement()]
@@ -219,23 +210,21 @@ def add_attributes(request, assertion, provider):
             if atv.any and len(atv.any) == 1 and isinstance(atv.any[0], lasso.MiscTextNode) and \
                     atv.any[0].textChild:
                 seen.add((name, name_format, atv.any[0].content.decode('utf-8')))
-    for definition in qs:
-        name = definition.name
-        name_format = definition.name_format_uri()
-        friendly_name = definition.friendly_name
+    verified = set()
+    for name, name_format, friendly_name, attribute_name in definitions:
+        if ctx.get(attribute_name + ':verified'):
+            verified.add(name)
         if (name, name_format) in attributes:
             continue
         attribute, value = attributes[(name, name_format)] = lasso.Saml2Attribute(), []
         attribute.friendlyName = friendly_name.encode('utf-8')
         attribute.name = name.encode('utf-8')
         attribute.nameFormat = name_format.encode('utf-8')
-    verified = set()
-    for definition in qs:
-        verified_attribute_name = definition.attribute_name + ':verified'
-        if ctx.get(verified_attribute_name):
-            verified.add(definition.name)
     ctx['@verified_attributes@'] = list(verified)
-    tuples = [tuple(t) for definition in qs for t in definition.to_tuples(ctx)]
+    tuples = [(name, name_format, friendly_name or None, text_value)
+              for name, name_format, friendly_name, attribute_name in definitions
+              if attribute_name in ctx
+              for text_value in normalize_attribute_values(ctx[attribute_name])]
     seen = set()
     for name, name_format, friendly_name, value in tuples:
         # prevent repeating attribute values
@@ -264,9 +253,8 @@ def saml2_add_attribute_values(assertion, attributes):
     else:
         logger.info("there are attributes to add")
         logger.debug("\
-            assertion before processing %s" % assertion.dump())
-        logger.debug("adding attributes %s" \
-            % str(attributes))
+            assertion before processing %s", lazy_dump(assertion))
+        logger.debug("adding attributes %s", attributes)
         if not assertion.attributeStatement:
             assertion.attributeStatement = [lasso.Saml2AttributeStatement()]
         attribute_statement = assertion.attributeStatement[0]
@@ -315,7 +303,7 @@ def saml2_add_attribute_values(assertion, attributes):
                 attribute_value_list.append(attribute_value)
             attribute.attributeValue = attribute_value_list
         logger.debug("assertion after processing "
-            "%s" % assertion.dump())
+            "%s", lazy_dump(assertion))
 
 
 def build_assertion(request, login, nid_format='transient'):
@@ -325,8 +313,8 @@ def build_assertion(request, login, nid_format='transient'):
     logger = logging.getLogger(__name__)
     entity_id = get_entity_id(request, reverse(metadata))
     now = datetime.datetime.utcnow()
-    logger.info("building assertion at %s" % str(now))
-    logger.debug('named Id format is %s' % nid_format)
+    logger.info("building assertion at %s", now)
+    logger.debug('named Id format is %s', nid_format)
     # 1 minute ago
     notBefore = now - datetime.timedelta(0, app_settings.SECONDS_TOLERANCE)
     # 1 minute in the future
@@ -362,7 +350,7 @@ def build_assertion(request, login, nid_format='transient'):
         except ObjectDoesNotExist:
             # TODO: previous session over secure transport (ssl) ?
             authn_context = lasso.SAML2_AUTHN_CONTEXT_PREVIOUS_SESSION
-    logger.info("authn_context %s" % authn_context)
+    logger.info("authn_context %s", authn_context)
     login.buildAssertion(authn_context,
             now.isoformat() + 'Z',
             'unused',  # reauthenticateOnOrAfter is only for ID-FF 1.2
@@ -374,8 +362,7 @@ def build_assertion(request, login, nid_format='transient'):
     # service providers can outlive the IdP session.
     expiry_date = request.session.get_expiry_date()
     assertion.authnStatement[0].sessionNotOnOrAfter = datetime_to_xs_datetime(expiry_date)
-    logger.debug("assertion building in progress %s" \
-        % assertion.dump())
+    logger.debug("assertion building in progress %s", lazy_dump(assertion))
     logger.debug("fill assertion")
     fill_assertion(request, login.request, assertion, login.remoteProviderId,
         nid_format)
@@ -409,7 +396,7 @@ def build_assertion(request, login, nid_format='transient'):
     kwargs['entity_id'] = login.remoteProviderId
     kwargs['user'] = request.user
     logger.info(u'sending nameID %(name_id_format)r: %(name_id_content)r to '
-                u'%(entity_id)s for user %(user)s' % kwargs)
+                u'%(entity_id)s for user %(user)s', kwargs)
 
     register_new_saml2_session(request, login)
 
@@ -451,8 +438,7 @@ def sso(request):
         except (lasso.ProfileInvalidMsgError,
             lasso.ProfileMissingIssuerError,), e:
             logger.warning('invalid message for WebSSO profile with '
-                          'HTTP-Redirect binding: %r exception: %s' \
-                          % (message, e),
+                          'HTTP-Redirect binding: %r exception: %s', message, e,
                           extra={'request': request})
             return HttpResponseBadRequest(_("SAMLv2 Single Sign On: "
                 "invalid message for WebSSO profile with HTTP-Redirect "
@@ -479,7 +465,7 @@ def sso(request):
             logger.debug('processAuthnRequestMsg not successful')
             log_info_authn_request_details(login)
             provider_id = login.remoteProviderId
-            logger.debug('loading provider %s' % provider_id)
+            logger.debug('loading provider %s', provider_id)
             provider_loaded = load_provider(request, provider_id,
                     server=login.server, autoload=True)
             if not provider_loaded:
@@ -495,8 +481,7 @@ def sso(request):
                 if not policy:
                     return error_page(request, _('sso: No SP policy defined'),
                         logger=logger, warning=True)
-                logger.info('provider %s loaded with success' \
-                    % provider_id)
+                logger.info('provider %s loaded with success', provider_id)
             if policy.authn_request_signed:
                 verify_hint = lasso.PROFILE_SIGNATURE_VERIFY_HINT_FORCE
             else:
@@ -514,15 +499,14 @@ def sso(request):
             name_id_policy.format and \
             name_id_policy.format != \
                 lasso.SAML2_NAME_IDENTIFIER_FORMAT_UNSPECIFIED:
-        logger.debug('nameID policy is %r', name_id_policy.dump())
+        logger.debug('nameID policy is %r', lazy_dump(name_id_policy))
         nid_format = saml2_urn_to_nidformat(name_id_policy.format,
             accepted=policy.accepted_name_id_format)
         logger.debug('nameID format %s', nid_format)
         default_nid_format = policy.default_name_id_format
         logger.debug('default nameID format %s', default_nid_format)
         accepted_nid_format = policy.accepted_name_id_format
-        logger.debug('nameID format accepted %s' \
-            % str(accepted_nid_format))
+        logger.debug('nameID format accepted %s', accepted_nid_format)
         if (not nid_format or nid_format not in accepted_nid_format) and \
            default_nid_format != nid_format:
             set_saml2_response_responder_status_code(login.response,
@@ -537,7 +521,7 @@ def sso(request):
             login.request.nameIdPolicy = lasso.Samlp2NameIDPolicy()
             name_id_policy = login.request.nameIdPolicy
         name_id_policy.format = NAME_ID_FORMATS[nid_format]['samlv2']
-        logger.debug('set nameID policy format %s' % nid_format)
+        logger.debug('set nameID policy format %s', nid_format)
     return sso_after_process_request(request, login, nid_format=nid_format)
 
 
@@ -576,7 +560,7 @@ def need_consent_for_federation(request, login, nid_format):
         % (reverse('a2-consent-federation'), NONCE_FIELD_NAME,
             nonce, get_url_with_nonce(request, continue_sso, nonce),
             display_name)
-    logger.debug('redirect to url %s' % url)
+    logger.debug('redirect to url %s', url)
     return HttpResponseRedirect(url)
 
 
@@ -590,13 +574,12 @@ def continue_sso(request):
         consent_answer = request.GET.get('consent_answer', '')
         if consent_answer:
             logger.info("back from the consent page for "
-                "federation with answer %s" \
-                    % consent_answer)
+                "federation with answer %s", consent_answer)
         consent_attribute_answer = \
             request.GET.get('consent_attribute_answer', '')
         if consent_attribute_answer:
             logger.info("back from the consent page for "
-                "attributes %s" % consent_attribute_answer)
+                "attributes %s", consent_attribute_answer)
     nonce = request.GET.get(NONCE_FIELD_NAME, '')
     if not nonce:
         logger.warning('nonce not found')
@@ -662,8 +645,7 @@ def sso_after_process_request(request, login, consent_obtained=False,
     force_authn = login.request.forceAuthn
     passive = login.request.isPassive
 
-    logger.debug('named Id format is %s' \
-        % nid_format)
+    logger.debug('named Id format is %s', nid_format)
 
     # check if user is authorized through this service
     service = LibertyServiceProvider.objects.get(
@@ -701,12 +683,12 @@ def sso_after_process_request(request, login, consent_obtained=False,
     access_granted = True
     for decision in decisions:
         logger.info('authorize_service connected '
-            'to function %s' % decision[0].__name__)
+            'to function %s', decision[0].__name__)
         dic = decision[1]
         if dic and 'authz' in dic:
 	    logger.info('decision is %s', dic['authz'])
             if 'message' in dic:
-		logger.info(u'with message %s', unicode(dic['message']))
+		logger.info(u'with message %s', dic['message'])
             if not dic['authz']:
                 logger.info('access denied by an external function')
                 access_granted = False
@@ -773,8 +755,7 @@ def sso_after_process_request(request, login, consent_obtained=False,
     '''
 
     logger = logging.getLogger(__name__)
-    logger.debug('the user consent status before process is %s' \
-        % str(consent_obtained))
+    logger.debug('the user consent status before process is %s', consent_obtained)
 
     consent_value = None
     if consent_obtained:
@@ -785,8 +766,7 @@ def sso_after_process_request(request, login, consent_obtained=False,
     if not consent_obtained and not transient:
         consent_obtained = \
                 not saml_policy.ask_user_consent
-        logger.debug('the policy says %s' \
-            % str(consent_obtained))
+        logger.debug('the policy says %s', consent_obtained)
         if consent_obtained:
             #The user consent is bypassed by the policy
             consent_value = 'urn:oasis:names:tc:SAML:2.0:consent:unspecified'
@@ -797,14 +777,14 @@ def sso_after_process_request(request, login, consent_obtained=False,
                     user=request.user,
                     sp__liberty_provider__entity_id=login.remoteProviderId)
             logger.debug('consent already '
-                'given (existing federation) for %s' % login.remoteProviderId)
+                'given (existing federation) for %s', login.remoteProviderId)
             consent_obtained = True
             '''This is abusive since a federation may exist even if we have
             not previously asked the user consent.'''
             consent_value = 'urn:oasis:names:tc:SAML:2.0:consent:prior'
         except ObjectDoesNotExist:
             logger.debug('consent not yet given \
-                (no existing federation) for %s' % login.remoteProviderId)
+                (no existing federation) for %s', login.remoteProviderId)
 
     if not consent_obtained and not transient:
         logger.debug('signal avoid_consent sent')
@@ -813,7 +793,7 @@ def sso_after_process_request(request, login, consent_obtained=False,
              audience=login.remoteProviderId)
         for c in avoid_consent:
             logger.info('avoid_consent connected '
-                'to function %s' % c[0].__name__)
+                'to function %s', c[0].__name__)
             if c[1] and 'avoid_consent' in c[1] and c[1]['avoid_consent']:
                 logger.debug('\
                     avoid consent by signal')
@@ -827,14 +807,13 @@ def sso_after_process_request(request, login, consent_obtained=False,
         return need_consent_for_federation(request, login, nid_format)
 
     logger.debug(''
-        'login dump before processing %s' % login.dump())
+        'login dump before processing %s', lazy_dump(login))
     try:
         if needs_persistence(nid_format):
             logger.debug('load identity dump')
             load_federation(request, get_entity_id(request, reverse(metadata)), login, user)
         login.validateRequestMsg(not user.is_anonymous(), consent_obtained)
-        logger.debug('validateRequestMsg %s' \
-            % login.dump())
+        logger.debug('validateRequestMsg %s', lazy_dump(login))
     except lasso.LoginRequestDeniedError:
         logger.error('access denied due to LoginRequestDeniedError')
         set_saml2_response_responder_status_code(login.response,
@@ -858,7 +837,7 @@ def return_login_error(request, login, error):
     """Set the first level status code to Responder, the second level to error
     and return the response message for the assertionConsumer"""
     logger = logging.getLogger(__name__)
-    logger.debug('error %s' % error)
+    logger.debug('error %s', error)
     set_saml2_response_responder_status_code(login.response, error)
     return return_login_response(request, login)
 
@@ -868,14 +847,14 @@ def return_login_response(request, login):
     logger = logging.getLogger(__name__)
     if login.protocolProfile == lasso.LOGIN_PROTOCOL_PROFILE_BRWS_ART:
         login.buildArtifactMsg(lasso.HTTP_METHOD_ARTIFACT_GET)
-        logger.info('sending Artifact to assertionConsumer %r' % login.msgUrl)
+        logger.info('sending Artifact to assertionConsumer %r', login.msgUrl)
         save_artifact(request, login)
     elif login.protocolProfile == lasso.LOGIN_PROTOCOL_PROFILE_BRWS_POST:
         login.buildAuthnResponseMsg()
-        logger.info('sending POST to assertionConsumer %r' % login.msgUrl)
-        logger.debug('POST content %r' % login.msgBody)
+        logger.info('sending POST to assertionConsumer %r', login.msgUrl)
+        logger.debug('POST content %r', login.msgBody)
     else:
-        logger.error('NotImplementedError with login %s' % login.dump())
+        logger.error('NotImplementedError with login %s', lazy_dump(login))
         raise NotImplementedError()
     provider = LibertyProvider.objects.get(entity_id=login.remoteProviderId)
     return return_saml2_response(request, login,
@@ -927,7 +906,7 @@ def artifact(request):
     logger = logging.getLogger(__name__)
     logger.info('soap call received')
     soap_message = get_soap_message(request)
-    logger.debug('soap message %r' % soap_message)
+    logger.debug('soap message %r', soap_message)
     server = create_server(request)
     login = lasso.Login(server)
     try:
@@ -939,8 +918,7 @@ def artifact(request):
         try:
             login.processRequestMsg(soap_message)
         except lasso.DsError, e:
-            logger.error('signature error for %s: %s'
-                    % (e, login.remoteProviderId))
+            logger.error('signature error for %s: %s', e, login.remoteProviderId)
         else:
             logger.info('reloading artifact')
             reload_artifact(login)
@@ -948,7 +926,7 @@ def artifact(request):
         logger.exception('resolve error')
     try:
         login.buildResponseMsg(None)
-        logger.debug('resolve response %s' % login.msgBody)
+        logger.debug('resolve response %s', login.msgBody)
     except:
         logger.exception('resolve error')
         return soap_fault(request,
@@ -960,8 +938,7 @@ def artifact(request):
 
 def check_delegated_authentication_permission(request):
     logger = logging.getLogger(__name__)
-    logger.info('superuser? %s' \
-        % str(request.user.is_superuser()))
+    logger.info('superuser? %s', request.user.is_superuser())
     return request.user.is_superuser()
 
 
@@ -1023,8 +1000,8 @@ def idp_sso(request, provider_id=None, return_profile=False):
     login.request.nameIdPolicy.allowCreate = True
 
     login.processAuthnRequestMsg(None)
-    logger.debug('nameId %r' % nid_format)
-    logger.debug('binding %r' % binding)
+    logger.debug('nameId %r', nid_format)
+    logger.debug('binding %r', binding)
     logger.info('authentication request initialized toward provider_id %r', provider_id)
 
     return sso_after_process_request(request, login,
@@ -1090,20 +1067,18 @@ def process_logout_request(request, message, binding):
     logout = lasso.Logout(server)
     if not message:
         return logout, HttpResponseBadRequest('No message was present', content_type='text/plain')
-    logger.debug('slo with binding %s message %s' \
-        % (binding, message))
+    logger.debug('slo with binding %s message %s', binding, message)
     try:
         try:
             logout.processRequestMsg(message)
         except (lasso.ServerProviderNotFoundError,
                 lasso.ProfileUnknownProviderError):
-            logger.debug('loading provider %s' \
-                % logout.remoteProviderId)
+            logger.debug('loading provider %s', logout.remoteProviderId)
             p = load_provider(request, logout.remoteProviderId,
                     server=logout.server)
             if not p:
                 logger.error(''
-                    'slo unknown provider %s' % logout.remoteProviderId)
+                    'slo unknown provider %s', logout.remoteProviderId)
                 return logout, return_logout_error(request, logout,
                         AUTHENTIC_STATUS_CODE_UNKNOWN_PROVIDER)
             policy = get_sp_options_policy(p)
@@ -1113,12 +1088,12 @@ def process_logout_request(request, message, binding):
             logout.processRequestMsg(message)
     except lasso.DsError:
         logger.error(''
-            'slo signature error on request %s' % message)
+            'slo signature error on request %s', message)
         return logout, return_logout_error(request, logout,
                 lasso.LIB_STATUS_CODE_INVALID_SIGNATURE)
     except Exception:
         logger.exception(''
-            'slo unknown error when processing a request %s' % message)
+            'slo unknown error when processing a request %s', message)
         return logout, HttpResponseBadRequest('Invalid logout request', content_type='text/plain')
     if binding != 'SOAP' and not check_destination(request, logout.request):
         logger.error(''
@@ -1132,8 +1107,7 @@ def log_logout_request(logout):
     logger = logging.getLogger(__name__)
     name_id = nameid2kwargs(logout.request.nameId)
     session_indexes = logout.request.sessionIndexes
-    logger.info('slo nameid: %s session_indexes: %s' \
-        % (name_id, session_indexes))
+    logger.info('slo nameid: %s session_indexes: %s', name_id, session_indexes)
 
 
 def validate_logout_request(request, logout, idp=True):
@@ -1157,8 +1131,7 @@ def logout_synchronous_other_backends(request, logout, django_sessions_keys):
     logger = logging.getLogger(__name__)
     backends = get_idp_backends()
     if backends:
-        logger.info('backends %s' \
-            % str(backends))
+        logger.info('backends %s', backends)
     else:
         logger.info('no backends')
     ok = True
@@ -1179,22 +1152,24 @@ def get_only_last_session(issuer_id, provider_id, name_id, session_indexes):
        provider only keep the more recent one.
     """
     logger = logging.getLogger(__name__)
-    logger.debug('%s %s' % (name_id.dump(),
-        session_indexes))
-    lib_session1 = LibertySession.get_for_nameid_and_session_indexes(
-            issuer_id, provider_id, name_id, session_indexes)
+    logger.debug('%s %s', lazy_dump(name_id), session_indexes)
+    lib_session1 = list(LibertySession.get_for_nameid_and_session_indexes(
+            issuer_id, provider_id, name_id, session_indexes))
     django_session_keys = [s.django_session_key for s in lib_session1]
-    lib_session = LibertySession.objects.filter(
-            django_session_key__in=django_session_keys)
-    providers = set([s.provider_id for s in lib_session])
     result = []
-    for provider in providers:
-        if provider != provider_id:
-            x = lib_session.filter(provider_id=provider)
-            latest = x.latest('creation')
-            result.append(latest)
+    if django_session_keys:
+        # sessions of other providers, the most recent first for each provider
+        lib_session = LibertySession.objects.filter(
+                django_session_key__in=django_session_keys) \
+            .exclude(provider_id=provider_id) \
+            .order_by('provider_id', '-creation', '-id')
+        seen = set()
+        for s in lib_session:
+            if s.provider_id not in seen:
+                seen.add(s.provider_id)
+                result.append(s)
     if lib_session1:
-        logger.debug('last session %s' % lib_session1)
+        logger.debug('last session %s', lib_session1)
     return lib_session1, result, django_session_keys
 
 
@@ -1216,7 +1191,7 @@ def build_session_dump(liberty_sessions):
         session.append(u'</NidAndSessionIndex>')
     session.append(u'</Session>')
     s = ''.join(session)
-    logger.debug('session built %s' % s)
+    logger.debug('session built %s', s)
     return s
 
 
@@ -1224,12 +1199,53 @@ def set_session_dump_from_liberty_sessions(profile, lib_sessions):
     '''Extract all assertion from a list of lib_sessions, and create a session
     dump from them'''
     logger = logging.getLogger(__name__)
-    logger.debug('lib_sessions %s' \
-        % lib_sessions)
+    logger.debug('lib_sessions %s', lib_sessions)
     session_dump = build_session_dump(lib_sessions).encode('utf8')
     profile.setSessionFromDump(session_dump)
-    logger.debug('profile %s' \
-        % profile.session.dump())
+    logger.debug('profile %s', lazy_dump(profile.session))
+
+
+def relay_logout_by_soap(server, lib_sessions):
+    '''Send logout requests by SOAP to the providers of lib_sessions.
+
+       Lasso profiles are built and processed sequentially but SOAP requests
+       are sent concurrently, return False if any provider failed to logout.
+    '''
+    logger = logging.getLogger(__name__)
+    success = True
+    relays = []
+    for lib_session in lib_sessions:
+        logger.info('slo, relaying logout to provider %s', lib_session.provider_id)
+        # As we are in a synchronous binding, we need SOAP support
+        relay = lasso.Logout(server)
+        try:
+            set_session_dump_from_liberty_sessions(relay, [lib_session])
+            relay.initRequest(lib_session.provider_id, lasso.HTTP_METHOD_SOAP)
+            relay.buildRequestMsg()
+        except lasso.Error:
+            logger.exception('slo, relaying to %s failed', lib_session.provider_id)
+            success = False
+            continue
+        if relay.msgBody and relay.msgUrl:
+            relays.append((lib_session.provider_id, relay))
+        else:
+            logger.info('Provider %s does not support SOAP', lib_session.provider_id)
+    soap_responses = soap_call_many(
+        [(relay.msgUrl, relay.msgBody) for provider_id, relay in relays],
+        max_workers=app_settings.SLO_SOAP_MAX_WORKERS,
+        timeout=app_settings.SLO_SOAP_TIMEOUT,
+        deadline=app_settings.SLO_SOAP_DEADLINE)
+    for (provider_id, relay), soap_response in zip(relays, soap_responses):
+        if isinstance(soap_response, SOAPException):
+            logger.error('slo, relaying to %s failed: %s', provider_id, soap_response)
+            success = False
+            continue
+        try:
+            relay.processResponseMsg(soap_response)
+        except lasso.Error:
+            logger.exception('slo, relaying to %s failed', provider_id)
+            success = False
+    return success
 
 
 @require_POST
@@ -1242,7 +1258,7 @@ def slo_soap(request):
     if not message:
         logger.error('no message received')
         return HttpResponseBadRequest('Bad SOAP message', content_type='text/plain')
-    logger.info('soap message received %s' % message)
+    logger.info('soap message received %s', message)
     logout, error = process_logout_request(request, message, 'SOAP')
     if error:
         return error
@@ -1254,19 +1270,16 @@ def slo_soap(request):
         provider = \
             LibertyProvider.objects.get(entity_id=logout.remoteProviderId)
     except ObjectDoesNotExist:
-        logger.warn('provider %r unknown' \
-            % logout.remoteProviderId)
+        logger.warn('provider %r unknown', logout.remoteProviderId)
         return return_logout_error(request, logout,
                 AUTHENTIC_STATUS_CODE_UNAUTHORIZED)
     policy = get_sp_options_policy(provider)
     if not policy:
-        logger.error('No policy found for %s'\
-             % logout.remoteProviderId)
+        logger.error('No policy found for %s', logout.remoteProviderId)
         return return_logout_error(request, logout,
             AUTHENTIC_STATUS_CODE_UNAUTHORIZED)
     if not policy.accept_slo:
-        logger.warn('received slo from %s not authorized'\
-             % logout.remoteProviderId)
+        logger.warn('received slo from %s not authorized', logout.remoteProviderId)
         return return_logout_error(request, logout,
             AUTHENTIC_STATUS_CODE_UNAUTHORIZED)
 
@@ -1275,28 +1288,29 @@ def slo_soap(request):
             get_only_last_session(logout.server.providerId,
                     logout.remoteProviderId, logout.request.nameId,
                     logout.request.sessionIndexes)
+    partial = False
     if not found:
         logger.debug('no third SP session found')
     else:
         logger.info('begin SP sessions processing...')
+        forwarded_lib_sessions = []
         for lib_session in lib_sessions:
             p = load_provider(request, lib_session.provider_id,
                     server=logout.server)
             if not p:
                 logger.error('slo cannot logout provider %s, it is '
-                    'no more known.' % lib_session.provider_id)
+                    'no more known.', lib_session.provider_id)
                 continue
             else:
-                logger.info('provider %s loaded' % str(p))
+                logger.info('provider %s loaded', p)
                 policy = get_sp_options_policy(p)
                 if not policy:
-                    logger.error('No policy found for %s' \
-                        % lib_session.provider_id)
+                    logger.error('No policy found for %s', lib_session.provider_id)
                 elif not policy.forward_slo:
-                    logger.info('%s configured to not reveive slo' \
-                        % lib_session.provider_id)
-                if not policy or not policy.forward_slo:
-                    lib_sessions.remove(lib_session)
+                    logger.info('%s configured to not reveive slo', lib_session.provider_id)
+                if policy and policy.forward_slo:
+                    forwarded_lib_sessions.append(lib_session)
+        lib_sessions = forwarded_lib_sessions
         set_session_dump_from_liberty_sessions(logout,
             found[0:1] + lib_sessions)
         try:
@@ -1307,37 +1321,23 @@ def slo_soap(request):
                 continue with others!
             '''
             logger.error('one provider does \
-                not support SOAP %s' % [s.provider_id for s in lib_sessions])
+                not support SOAP %s', [s.provider_id for s in lib_sessions])
         except Exception, e:
-            logger.exception('slo, unknown error %s' % str(e))
+            logger.exception('slo, unknown error %s', e)
             logout.buildResponseMsg()
             provider = LibertyProvider.objects.get(entity_id=logout.remoteProviderId)
             return return_saml2_response(request, logout,
                 title=_('You are being redirected to "%s"') % provider.name)
-        for lib_session in lib_sessions:
-            try:
-                logger.info('slo, relaying logout to provider %s' \
-                    % lib_session.provider_id)
-                '''
-                    As we are in a synchronous binding, we need SOAP support
-                '''
-                logout.initRequest(lib_session.provider_id,
-                    lasso.HTTP_METHOD_SOAP)
-                logout.buildRequestMsg()
-                if logout.msgBody:
-                    logger.info('slo by SOAP')
-                    soap_response = send_soap_request(request, logout)
-                    logout.processResponseMsg(soap_response)
-                else:
-                    logger.info('Provider does not support SOAP')
-            except lasso.Error:
-                logger.exception('slo, relaying to %s failed ' %
-                        lib_session.provider_id)
+        partial = not relay_logout_by_soap(logout.server, lib_sessions)
 
     '''
         Respond to the SP initiating SLO
     '''
     try:
+        if partial and logout.response:
+            set_saml2_response_responder_status_code(logout.response,
+                                                     lasso.SAML2_STATUS_CODE_PARTIAL_LOGOUT)
+            logger.warning('partial logout')
         logout.buildResponseMsg()
     except lasso.Error:
         logger.exception('slo failure to build reponse msg')
@@ -1361,25 +1361,22 @@ def slo(request):
         request.method)
     if response:
         return response
-    logger.debug('asynchronous slo message %s' % message)
+    logger.debug('asynchronous slo message %s', message)
 
     try:
         provider = \
             LibertyProvider.objects.get(entity_id=logout.remoteProviderId)
     except ObjectDoesNotExist:
-        logger.warn('provider %r unknown' \
-            % logout.remoteProviderId)
+        logger.warn('provider %r unknown', logout.remoteProviderId)
         return return_logout_error(request, logout,
                 AUTHENTIC_STATUS_CODE_UNAUTHORIZED)
     policy = get_sp_options_policy(provider)
     if not policy:
-        logger.error('No policy found for %s'\
-             % logout.remoteProviderId)
+        logger.error('No policy found for %s', logout.remoteProviderId)
         return return_logout_error(request, logout,
             AUTHENTIC_STATUS_CODE_UNAUTHORIZED)
     if not policy.accept_slo:
-        logger.warn('received slo from %s not authorized'\
-             % logout.remoteProviderId)
+        logger.warn('received slo from %s not authorized', logout.remoteProviderId)
         return return_logout_error(request, logout,
             AUTHENTIC_STATUS_CODE_UNAUTHORIZED)
 
@@ -1392,7 +1389,7 @@ def slo(request):
                     server=logout.server)
             logout.processRequestMsg(message)
     except lasso.DsError, e:
-        logger.exception('signature error %s' % e)
+        logger.exception('signature error %s', e)
         logout.buildResponseMsg()
         provider = LibertyProvider.objects.get(entity_id=logout.remoteProviderId)
         return return_saml2_response(request, logout,
@@ -1403,12 +1400,12 @@ def slo(request):
     session_indexes = logout.request.sessionIndexes
     if len(session_indexes) == 0:
         logger.warning('slo received a request from %s without any \
-            SessionIndex, it is forbidden' % logout.remoteProviderId)
+            SessionIndex, it is forbidden', logout.remoteProviderId)
         logout.buildResponseMsg()
         provider = LibertyProvider.objects.get(entity_id=logout.remoteProviderId)
         return return_saml2_response(request, logout,
             title=_('You are being redirected to "%s"') % provider.name)
-    logger.info('asynchronous slo from %s' % logout.remoteProviderId)
+    logger.info('asynchronous slo from %s', logout.remoteProviderId)
     # Filter sessions
     if not logout.request.nameId:
         logger.warning('slo refused, no NameID in the SLO request')
@@ -1472,19 +1469,18 @@ def idp_slo(request, provider_id=None):
     all = request.POST.get('all')
     next = request.POST.get('next')
 
-    logger.debug('provider_id in parameter %s' % str(provider_id))
+    logger.debug('provider_id in parameter %s', provider_id)
 
     if request.method == 'GET' and 'provider_id' in request.GET:
         provider_id = request.GET.get('provider_id')
-        logger.debug('provider_id from GET %s' % str(provider_id))
+        logger.debug('provider_id from GET %s', provider_id)
     if request.method == 'POST' and 'provider_id' in request.POST:
         provider_id = request.POST.get('provider_id')
-        logger.debug('provider_id from POST %s' % str(provider_id))
+        logger.debug('provider_id from POST %s', provider_id)
     if not provider_id:
         logger.info('to initiate a slo we need a provider_id')
         return redirect_next(request, next) or ko_icon(request)
-    logger.info('slo initiated with %(provider_id)s' \
-        % {'provider_id': provider_id})
+    logger.info('slo initiated with %(provider_id)s', {'provider_id': provider_id})
 
     server = create_server(request)
     logout = lasso.Logout(server)
@@ -1495,12 +1491,11 @@ def idp_slo(request, provider_id=None):
         return redirect_next(request, next) or ko_icon(request)
     policy = get_sp_options_policy(provider)
     if not policy:
-        logger.error('No policy found for %s'\
-             % provider_id)
+        logger.error('No policy found for %s', provider_id)
         return redirect_next(request, next) or ko_icon(request)
     if not policy.forward_slo:
         logger.warn('slo asked for %s configured to not reveive '
-            'slo' % provider_id)
+            'slo', provider_id)
         return redirect_next(request, next) or ko_icon(request)
 
     lib_sessions = LibertySession.objects.filter(
@@ -1513,8 +1508,7 @@ def idp_slo(request, provider_id=None):
         logout.initRequest(provider_id, policy.http_method_for_slo_request)
     except (lasso.ProfileMissingAssertionError,
             lasso.ProfileSessionNotFoundError):
-        logger.error('slo failed because no sessions exists for %r' \
-            % provider_id)
+        logger.error('slo failed because no sessions exists for %r', provider_id)
         return redirect_next(request, next) or ko_icon(request)
     if all is not None:
         logout.request.sessionIndexes = []
@@ -1531,9 +1525,10 @@ def idp_slo(request, provider_id=None):
     if logout.msgBody:
         logger.info('slo by SOAP')
         try:
-            soap_response = send_soap_request(request, logout)
+            soap_response = send_soap_request(request, logout,
+                                              timeout=app_settings.SLO_SOAP_TIMEOUT)
         except Exception, e:
-            logger.exception('slo SOAP failure due to %s' % str(e))
+            logger.exception('slo SOAP failure due to %s', e)
             return redirect_next(request, next) or ko_icon(request)
         return process_logout_response(request, logout, soap_response, next)
     else:
@@ -1544,7 +1539,7 @@ def idp_slo(request, provider_id=None):
 
 def process_logout_response(request, logout, soap_response, next):
     logger = logging.getLogger(__name__)
-    logger.info('Response is %s' % str(soap_response))
+    logger.info('Response is %s', soap_response)
     try:
         logout.processResponseMsg(soap_response)
     except getattr(lasso, 'ProfileRequestDeniedError', lasso.LogoutRequestDeniedError):
@@ -1552,8 +1547,8 @@ def process_logout_response(request, logout, soap_response, next):
         return redirect_next(request, next) or ko_icon(request)
     except:
         logger.exception('\
-            slo error with soap response %r and logout dump %r' \
-                % (soap_response, logout.dump()))
+            slo error with soap response %r and logout dump %r',
+            soap_response, lazy_dump(logout))
     else:
         LibertySession.objects.filter(
                     django_session_key=request.session.session_key,
@@ -1648,7 +1643,7 @@ def log_info_authn_request_details(login):
                 'format': nameIdPolicy.format,
                 'spNameQualifier': nameIdPolicy.spNameQualifier}
 
-    logger.info('%r' % details)
+    logger.info('%r', details)
 
 
 def check_destination(request, req_or_res):
@@ -1,15 +1,21 @@
 import urlparse
 import logging
 import datetime
+import time
 import random
 import struct
-import time
+import collections
 try:
     import threading
 except ImportError:
     threading = None
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
 
 from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
 from django.contrib import messages
 from django.utils.translation import ugettext as _
 from django.shortcuts import render
@@ -17,67 +23,85 @@ from django.shortcuts import render
 from . import app_settings, utils, plugins
 
 class ThreadCollector(object):
-    def __init__(self):
+    '''Collect items in bounded per-thread buffers.
+
+       Collections must be explicitly started, items collected outside of a collection are
+       dropped. A collection is freed when it is cleared or when its thread ends.
+    '''
+    def __init__(self, max_items=None):
         if threading is None:
             raise NotImplementedError(
                 "threading module is not available, "
                 "this panel cannot be used without it")
-        self.collections = {}  # a dictionary that maps threads to collections
+        self.max_items = max_items
+        self.local = threading.local()
 
-    def get_collection(self, thread=None):
+    def start_collection(self, max_items=None):
+        self.local.collection = collections.deque(maxlen=max_items or self.max_items)
+
+    def get_collection(self):
         """
-        Returns a list of collected items for the provided thread, of if none
-        is provided, returns a list for the current thread.
+        Returns the collection of the current thread, or None if no collection
+        was started.
         """
-        if thread is None:
-            thread = threading.currentThread()
-        if thread not in self.collections:
-            self.collections[thread] = []
-        return self.collections[thread]
+        return getattr(self.local, 'collection', None)
 
-    def clear_collection(self, thread=None):
-        if thread is None:
-            thread = threading.currentThread()
-        if thread in self.collections:
-            del self.collections[thread]
+    def clear_collection(self):
+        self.local.collection = None
 
-    def collect(self, item, thread=None):
-        self.get_collection(thread).append(item)
+    def collect(self, item):
+        collection = self.get_collection()
+        if collection is not None:
+            collection.append(item)
 
 MESSAGE_IF_STRING_REPRESENTATION_INVALID = '[Could not get log message]'
 
 class ThreadTrackingHandler(logging.Handler):
+    '''Keep log records in the collection of the current thread, records are only formatted
+       when they are displayed.'''
     def __init__(self, collector):
         logging.Handler.__init__(self)
         self.collector = collector
 
     def emit(self, record):
-        try:
-            message = self.format(record)
-        except Exception:
-            message = MESSAGE_IF_STRING_REPRESENTATION_INVALID
-
-        record = {
-            'message': message,
-            'time': datetime.datetime.fromtimestamp(record.created),
-            'level': record.levelname,
-            'file': record.pathname,
-            'line': record.lineno,
-            'channel': record.name,
-        }
         self.collector.collect(record)
 
+    def format_records(self, records):
+        formatted = []
+        for record in records:
+            try:
+                message = self.format(record)
+            except Exception:
+                message = MESSAGE_IF_STRING_REPRESENTATION_INVALID
+            formatted.append({
+                'message': message,
+                'time': datetime.datetime.fromtimestamp(record.created),
+                'level': record.levelname,
+                'file': record.pathname,
+                'line': record.lineno,
+                'channel': record.name,
+            })
+        return formatted
+
 
 # We don't use enable/disable_instrumentation because logging is global.
-# We can't add thread-local logging handlers. Hopefully logging is cheap.
+# We can't add thread-local logging handlers, so the handler is only installed
+# when LoggingCollectorMiddleware is enabled.
 
 collector = ThreadCollector()
 logging_handler = ThreadTrackingHandler(collector)
-logging.root.addHandler(logging_handler)
 
 class LoggingCollectorMiddleware(object):
+    '''Show the logs of a request on the error page to clients from INTERNAL_IPS, it must be
+       enabled with the A2_LOG_COLLECTION_ENABLED setting.'''
+    def __init__(self):
+        if not app_settings.A2_LOG_COLLECTION_ENABLED:
+            raise MiddlewareNotUsed
+        if logging_handler not in logging.root.handlers:
+            logging.root.addHandler(logging_handler)
+
     def process_request(self, request):
-        collector.clear_collection()
+        collector.start_collection(app_settings.A2_LOG_COLLECTION_MAX_RECORDS)
 
     def show_logs(self, request):
         if request.META.get('REMOTE_ADDR', None) in settings.INTERNAL_IPS:
@@ -85,8 +109,13 @@ class LoggingCollectorMiddleware(object):
 
     def process_exception(self, request, exception):
         if self.show_logs(request):
-            request.logs = collector.get_collection()
+            request.logs = logging_handler.format_records(collector.get_collection() or [])
             request.exception = exception
+        collector.clear_collection()
+
+    def process_response(self, request, response):
+        collector.clear_collection()
+        return response
 
 class CollectIPMiddleware(object):
     def process_response(self, request, response):
@@ -94,12 +123,63 @@ class CollectIPMiddleware(object):
         if not hasattr(request, 'session') or request.session.is_empty():
             return response
 
-        ips = set(request.session.setdefault('ips', []))
+        ips = set(request.session.get('ips', []))
         ip = request.META.get('REMOTE_ADDR', None)
         if ip and ip not in ips:
             ips.add(ip)
             request.session['ips'] = list(ips)
-            request.session.modified = True
+        return response
+
+
+class SessionChangesMiddleware(object):
+    '''Prevent saving sessions whose content did not change.
+
+       Many views mark the session as modified without really changing it, with database backed
+       sessions it turns page views into an UPDATE of the session row. The content of the session
+       is serialized when it is loaded and compared with its content at the end of the request.
+
+       Sessions are still saved once their last save is older than half their age, so that
+       the expiry of the sessions of active users keeps sliding.
+
+       It must be placed just after django.contrib.sessions.middleware.SessionMiddleware.
+    '''
+    SAVED_KEY = '_a2_session_saved'
+
+    def process_request(self, request):
+        session = getattr(request, 'session', None)
+        if session is None:
+            return
+        load = session.load
+
+        def snapshot_load():
+            data = load()
+            session._a2_snapshot = (session.session_key, self.serialize(session, data))
+            return data
+        session.load = snapshot_load
+
+    @classmethod
+    def serialize(cls, session, data):
+        try:
+            return session.serializer().dumps(data)
+        except Exception:
+            return None
+
+    def process_response(self, request, response):
+        session = getattr(request, 'session', None)
+        snapshot = getattr(session, '_a2_snapshot', None)
+        if not snapshot or session.is_empty():
+            return response
+        now = int(time.time())
+        unchanged = (snapshot[1] is not None and snapshot[0] == session.session_key
+                     and self.serialize(session, session._session) == snapshot[1])
+        if unchanged:
+            saved = session._session.get(self.SAVED_KEY)
+            if saved is not None and now - saved < session.get_expiry_age() / 2:
+                session.modified = False
+                return response
+        elif not session.modified:
+            return response
+        session[self.SAVED_KEY] = now
         return response
 
 class OpenedSessionCookieMiddleware(object):
@@ -132,22 +212,58 @@ class RequestIdMiddleware(object):
                 random_id = random.getrandbits(32)
                 request.request_id = struct.pack('I', random_id).encode('hex')
 
+class RequestStore(object):
+    '''Context-local storage for the current request.
+
+       A context variable is used when the contextvars module is available, so that coroutines
+       sharing a thread see their own request. Otherwise a threading.local() is used, it is
+       greenlet-local when the threading module is monkey-patched by gevent or eventlet.
+    '''
+    def __init__(self):
+        if ContextVar is not None:
+            self.var = ContextVar('authentic2-request', default=None)
+        else:
+            self.local = threading.local()
+
+    def get(self):
+        if ContextVar is not None:
+            return self.var.get()
+        return getattr(self.local, 'request', None)
+
+    def set(self, request):
+        if ContextVar is not None:
+            self.var.set(request)
+        else:
+            self.local.request = request
+
+    def clear(self):
+        self.set(None)
+
+
 class StoreRequestMiddleware(object):
-    collection = {}
+    '''Make the current request available to code without access to it, through
+       StoreRequestMiddleware.get_request().'''
+    store = RequestStore()
 
     def process_request(self, request):
-        StoreRequestMiddleware.collection[threading.currentThread()] = request
+        StoreRequestMiddleware.store.set(request)
 
     def process_response(self, request, response):
-        StoreRequestMiddleware.collection.pop(threading.currentThread(), None)
+        StoreRequestMiddleware.store.clear()
         return response
 
     def process_exception(self, request, exception):
-        StoreRequestMiddleware.collection.pop(threading.currentThread(), None)
+        StoreRequestMiddleware.store.clear()
 
     @classmethod
     def get_request(cls):
-        return cls.collection.get(threading.currentThread())
+        return cls.store.get()
+
+
+def clear_stored_request(sender, **kwargs):
+    '''Forget the current request when it is finished, even if process_response() was
+       skipped.'''
+    StoreRequestMiddleware.store.clear()
 
 class ViewRestrictionMiddleware(object):
     RESTRICTION_SESSION_KEY = 'view-restriction'
@@ -155,17 +271,12 @@ class ViewRestrictionMiddleware(object):
     def check_view_restrictions(self, request):
         '''Check if a restriction on accessible views must be applied'''
         from django.db.models import Model
-        from .models import PasswordReset
 
         user = request.user
         b = user.is_authenticated()
         if b and isinstance(user, Model):
-            now = time.time()
-            last_time = request.session.get('last_password_reset_check', 0)
-            if now - last_time > 10:
-                if PasswordReset.objects.filter(user=request.user).exists():
-                    return 'password_change'
-            request.session['last_password_reset_check'] = now
+            if utils.has_password_reset(user):
+                return 'password_change'
         for plugin in plugins.get_plugins():
             if hasattr(plugin, 'check_view_restrictions'):
                 view = plugin.check_view_restrictions(request)
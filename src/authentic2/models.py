@@ -11,9 +11,11 @@ from django.contrib.contenttypes.models import ContentType
 
 from model_utils.managers import QueryManager
 
+from django.core.cache import cache
+
 from authentic2.a2_rbac.models import Role
 from authentic2.a2_rbac.utils import get_default_ou
-from django_rbac.utils import get_role_model_name
+from django_rbac.utils import get_role_model_name, get_rbac_generation
 
 try:
     from django.contrib.contenttypes.fields import GenericForeignKey
@@ -21,7 +23,7 @@ except ImportError:
     from django.contrib.contenttypes.generic import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 
-from . import managers
+from . import managers, app_settings
 # install our natural_key implementation
 from . import natural_key
 from .utils import ServiceAccessDenied
@@ -320,6 +322,12 @@ class PasswordReset(models.Model):
         return unicode(self.user)
 
 
+SERVICE_AUTHORIZATION_CACHE_KEY = 'a2-service-authorization|%s|%s|%s'
+# the generation is not seen by other processes if the cache is not shared between them, keep
+# decisions for a short time only
+SERVICE_AUTHORIZATION_CACHE_TIMEOUT = 10
+
+
 class Service(models.Model):
     name = models.CharField(
         verbose_name=_('name'),
@@ -375,10 +383,25 @@ class Service(models.Model):
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, unicode(self))
 
+    def is_authorized(self, user):
+        '''Return whether user can access this service, decisions are cached until role
+           memberships, role parentings or authorized roles change, and at most
+           SERVICE_AUTHORIZATION_CACHE_TIMEOUT seconds.'''
+        cache_key = None
+        if app_settings.A2_CACHE_ENABLED and user.pk is not None and self.pk is not None:
+            cache_key = SERVICE_AUTHORIZATION_CACHE_KEY % (
+                self.pk, user.pk, get_rbac_generation())
+            authorized = cache.get(cache_key)
+            if authorized is not None:
+                return authorized
+        authorized = not self.authorized_roles.exists() \
+            or user.roles_and_parents().filter(allowed_services=self).exists()
+        if cache_key:
+            cache.set(cache_key, authorized, SERVICE_AUTHORIZATION_CACHE_TIMEOUT)
+        return authorized
+
     def authorize(self, user):
-        if not self.authorized_roles.exists():
-            return True
-        if user.roles_and_parents().filter(allowed_services=self).exists():
+        if self.is_authorized(user):
             return True
         raise ServiceAccessDenied(service=self)
 
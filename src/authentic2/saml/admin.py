@@ -138,13 +138,15 @@ class LibertyProviderAdmin(admin.ModelAdmin):
     form = LibertyProviderForm
     list_display = ('name', 'ou', 'slug', 'entity_id')
     search_fields = ('name', 'entity_id')
-    readonly_fields = ('entity_id','protocol_conformance','entity_id_sha1','federation_source')
+    readonly_fields = ('entity_id','protocol_conformance','entity_id_sha1','federation_source',
+                       'metadata_refreshed')
     fieldsets = (
             (None, {
                 'fields' : ('name', 'slug', 'ou', 'entity_id', 'entity_id_sha1','federation_source')
             }),
             (_('Metadata files'), {
-                'fields': ('metadata_url', 'metadata', 'public_key', 'ssl_certificate', 'ca_cert_chain')
+                'fields': ('metadata_url', 'metadata_refreshed', 'metadata', 'public_key',
+                           'ssl_certificate', 'ca_cert_chain')
             }),
     )
     inlines = [
@@ -5,7 +5,9 @@ from django.utils.translation import ugettext_lazy as _
 
 class AppSettings(object):
     __PREFIX = 'SAML_'
-    __NAMES = ('ALLOWED_FEDERATION_MODE', 'DEFAULT_FEDERATION_MODE')
+    __NAMES = ('ALLOWED_FEDERATION_MODE', 'DEFAULT_FEDERATION_MODE', 'KEY_VALUE_STORE',
+               'KEY_VALUE_TIMEOUT', 'METADATA_AUTOLOAD_ASYNC', 'METADATA_REFRESH_INTERVAL',
+               'METADATA_REFRESH_RETRY', 'METADATA_REFRESH_MAX_RETRY')
 
     class FEDERATION_MODE:
         EXPLICIT = 0
@@ -30,6 +32,20 @@ class AppSettings(object):
             'ALLOWED_FEDERATION_MODE': (FEDERATION_MODE.EXPLICIT,
                 FEDERATION_MODE.IMPLICIT),
             'DEFAULT_FEDERATION_MODE': FEDERATION_MODE.EXPLICIT,
+            # store for the state of SSO and SLO between requests, the faster
+            # authentic2.saml.models.CacheKeyValueStore can be used only if the default cache
+            # is shared by all the processes (memcached for example, not the LocMemCache)
+            'KEY_VALUE_STORE': 'authentic2.saml.models.DatabaseKeyValueStore',
+            'KEY_VALUE_TIMEOUT': 3600 * 24,
+            # queue autoload of unknown providers for the refresh-metadata command instead of
+            # retrieving their metadata during the SSO request
+            'METADATA_AUTOLOAD_ASYNC': False,
+            # delay between two refreshes of metadata from metadata_url
+            'METADATA_REFRESH_INTERVAL': 3600 * 6,
+            # first delay before retrying a failed refresh, doubled on each failure up to
+            # METADATA_REFRESH_MAX_RETRY
+            'METADATA_REFRESH_RETRY': 300,
+            'METADATA_REFRESH_MAX_RETRY': 3600 * 24,
     }
 
 
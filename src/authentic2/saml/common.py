@@ -5,6 +5,10 @@ import httplib
 import logging
 import re
 import datetime
+import hashlib
+import threading
+import time
+import Queue
 
 import requests
 
@@ -13,15 +17,20 @@ from django.conf import settings
 from django.http import HttpResponseRedirect, Http404, HttpResponse
 from django.shortcuts import render
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.template.defaultfilters import slugify
 
 from authentic2.saml.models import (LibertyFederation, LibertyProvider,
-                                    LibertyServiceProvider, SPOptionsIdPPolicy)
+                                    LibertyServiceProvider, SPOptionsIdPPolicy, KeyValue,
+                                    SAMLAttribute)
 from authentic2.saml import models
 from authentic2.saml import saml2utils
 
 from authentic2.http_utils import get_url
-from authentic2.decorators import RequestCache
+from authentic2.decorators import RequestCache, GlobalCache
 from authentic2.idp.saml import app_settings
+from authentic2.saml import app_settings as saml_app_settings
 from .. import nonce
 
 AUTHENTIC_STATUS_CODE_NS = "http://authentic.entrouvert.org/status_code/"
@@ -300,33 +309,36 @@ def load_federation(request, entity_id, login, user=None):
         user = request.user
     assert user is not None
 
-    identity_dump = federations_to_identity_dump(
-        entity_id, LibertyFederation.objects.filter(user=user))
-    login.setIdentityFromDump(identity_dump)
+    # federations are not cached: a stale dump would make lasso create a new persistent
+    # federation
+    federations = LibertyFederation.objects.filter(user=user) \
+        .select_related('sp__liberty_provider')
+    login.setIdentityFromDump(federations_to_identity_dump(entity_id, federations))
 
 
-def retrieve_metadata_and_create(request, provider_id, sp_or_idp):
+def retrieve_metadata_and_create(request, provider_id, sp_or_idp, timeout=None):
     logger.debug('trying to load %s from wkl', provider_id)
     if not provider_id.startswith('http'):
         logger.debug('not an http url, failing')
         return None
     # Try the WKL
     try:
-        metadata = get_url(provider_id)
+        metadata = get_url(provider_id, timeout=timeout)
     except Exception, e:
         logging.error('SAML metadata autoload: failure to retrieve metadata '
                       'for entity id %s: %s', provider_id, e)
         return None
     logger.debug('loaded %d bytes', len(metadata))
     try:
-        metadata = unicode(metadata, 'utf8')
+        if not isinstance(metadata, unicode):
+            metadata = unicode(metadata, 'utf8')
     except:
         logging.error('SAML metadata autoload: retrieved metadata for entity '
                       'id %s is not UTF-8', provider_id)
         return None
     p = LibertyProvider(metadata=metadata)
     try:
-        p.full_clean(exclude=['entity_id', 'protocol_conformance'])
+        p.full_clean(exclude=['entity_id', 'protocol_conformance', 'name', 'slug'])
     except ValidationError, e:
         logging.error('SAML metadata autoload: retrieved metadata for entity '
                       'id %s are invalid, %s', provider_id, e.args)
@@ -335,6 +347,13 @@ def retrieve_metadata_and_create(request, provider_id, sp_or_idp):
         logging.exception('SAML metadata autoload: retrieved metadata '
                           'validation raised an unknown exception')
         return None
+    p.name = (p.name or provider_id)[:128]
+    p.slug = slugify(p.name)[:128]
+    # keep the metadata up to date with the refresh-metadata command
+    p.metadata_url = provider_id
+    p.metadata_refreshed = timezone.now()
+    p.metadata_next_refresh = p.metadata_refreshed + datetime.timedelta(
+        seconds=saml_app_settings.METADATA_REFRESH_INTERVAL)
     p.save()
     logger.debug('%s saved', p)
     s = LibertyServiceProvider(liberty_provider=p, enabled=True)
@@ -342,6 +361,55 @@ def retrieve_metadata_and_create(request, provider_id, sp_or_idp):
     return p
 
 
+METADATA_AUTOLOAD_KEY_PREFIX = 'metadata-autoload|'
+
+
+def enqueue_metadata_autoload(entity_id, sp_or_idp='sp'):
+    '''Ask the refresh-metadata command to retrieve metadata of an unknown provider'''
+    key = METADATA_AUTOLOAD_KEY_PREFIX + hashlib.sha1(force_bytes(entity_id)).hexdigest()
+    KeyValue.objects.get_or_create(key=key, defaults={'value': (entity_id, sp_or_idp)})
+    logger.info('SAML metadata autoload: queued retrieval of metadata for entity id %s',
+                entity_id)
+
+
+def process_metadata_autoload_queue(timeout=None):
+    '''Retrieve metadata of providers queued by enqueue_metadata_autoload(), return the
+       created providers'''
+    providers = []
+    for kv in KeyValue.objects.filter(key__startswith=METADATA_AUTOLOAD_KEY_PREFIX):
+        entity_id, sp_or_idp = kv.value
+        if not LibertyProvider.objects.filter(entity_id=entity_id).exists():
+            provider = retrieve_metadata_and_create(None, entity_id, sp_or_idp, timeout=timeout)
+            if provider:
+                providers.append(provider)
+        kv.delete()
+    return providers
+
+
+def refresh_metadata(provider, timeout=None):
+    '''Refresh metadata of a provider and schedule the next refresh, after a failure the
+       delay before the next try doubles each time. Return True if metadata changed.'''
+    try:
+        changed = provider.update_metadata(timeout=timeout, commit=False)
+    except ValidationError:
+        provider.metadata_refresh_failures += 1
+        delay = min(saml_app_settings.METADATA_REFRESH_RETRY
+                    * 2 ** (provider.metadata_refresh_failures - 1),
+                    saml_app_settings.METADATA_REFRESH_MAX_RETRY)
+        provider.metadata_next_refresh = timezone.now() + datetime.timedelta(seconds=delay)
+        provider.save(update_fields=['metadata_refresh_failures', 'metadata_next_refresh'])
+        raise
+    provider.metadata_refresh_failures = 0
+    provider.metadata_next_refresh = provider.metadata_refreshed + datetime.timedelta(
+        seconds=saml_app_settings.METADATA_REFRESH_INTERVAL)
+    update_fields = ['metadata_refresh_failures', 'metadata_next_refresh']
+    update_fields += provider.METADATA_UPDATE_FIELDS
+    if changed:
+        update_fields += provider.METADATA_CHANGE_FIELDS
+    provider.save(update_fields=update_fields)
+    return changed
+
+
 def load_provider(request, entity_id, server=None, sp_or_idp='sp',
                   autoload=False):
     '''Look up a provider in the database, and verify it handles wanted
@@ -361,6 +429,9 @@ def load_provider(request, entity_id, server=None, sp_or_idp='sp',
     except LibertyProvider.DoesNotExist:
         autoload = getattr(settings, 'SAML_METADATA_AUTOLOAD', 'none')
         if autoload and (autoload == 'sp' or autoload == 'both'):
+            if saml_app_settings.METADATA_AUTOLOAD_ASYNC:
+                enqueue_metadata_autoload(entity_id, sp_or_idp)
+                return False
             liberty_provider = retrieve_metadata_and_create(request, entity_id,
                                                             sp_or_idp)
             if not liberty_provider:
@@ -447,11 +518,12 @@ class SOAPException(Exception):
     pass
 
 
-def soap_call(url, msg):
+def soap_call(url, msg, timeout=None):
     logger = logging.getLogger(__name__)
     try:
         logger.debug('SOAP call to %r with data %r', url, msg[:10000])
-        response = requests.post(url, data=msg, headers={'Content-Type': 'text/xml'})
+        response = requests.post(url, data=msg, headers={'Content-Type': 'text/xml'},
+                                 timeout=timeout)
         response.raise_for_status()
     except requests.RequestException, e:
         logging.error('SOAP call to %r error %s with data %r', url, e, msg[:10000])
@@ -460,11 +532,50 @@ def soap_call(url, msg):
     return response.content
 
 
-def send_soap_request(request, profile):
+def soap_call_many(calls, max_workers=4, timeout=None, deadline=None):
+    '''Make SOAP calls concurrently using a bounded pool of threads.
+
+       calls is a list of (url, msg) pairs, timeout is the timeout of each
+       call and deadline the maximum time spent waiting for all the calls. The
+       list of response contents is returned in the same order as calls, failed
+       calls or calls not finished before the deadline are replaced by a
+       SOAPException.
+    '''
+    results = [None] * len(calls)
+    pending = Queue.Queue()
+    for i, call in enumerate(calls):
+        pending.put((i, call))
+    end = time.time() + deadline if deadline else None
+
+    def worker():
+        while end is None or time.time() < end:
+            try:
+                i, (url, msg) = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = soap_call(url, msg, timeout=timeout)
+            except SOAPException, e:
+                results[i] = e
+
+    threads = []
+    for i in range(min(max_workers, len(calls))):
+        thread = threading.Thread(target=worker, name='soap-call-%d' % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(None if end is None else max(0, end - time.time()))
+    # copy results as late workers could still modify them
+    return [result if result is not None else SOAPException(url, 'deadline exceeded')
+            for result, (url, msg) in zip(list(results), calls)]
+
+
+def send_soap_request(request, profile, timeout=None):
     '''Send the SOAP request hold by the profile'''
     if not profile.msgUrl or not profile.msgBody:
         raise SOAPException('Missing body or url')
-    return soap_call(profile.msgUrl, profile.msgBody, None)
+    return soap_call(profile.msgUrl, profile.msgBody, timeout=timeout)
 
 
 def set_saml2_response_responder_status_code(response, code, msg=None):
@@ -488,9 +599,9 @@ def error_page(request, message, back=None, logger=None, warning=False):
     if not logger:
         logger = logging
     if warning:
-        logging.warning('Showing message %r on an error page' % message)
+        logging.warning('Showing message %r on an error page', message)
     else:
-        logging.error('Showing message %r on an error page' % message)
+        logging.error('Showing message %r on an error page', message)
     if back is None:
         referer = request.META.get('HTTP_REFERER')
         if referer:
@@ -554,6 +665,35 @@ def get_sp_options_policy(provider):
     return get_sp_options_policy_default()
 
 
+ATTRIBUTE_RELEASE_PLAN_TIMEOUT = 60
+
+
+@GlobalCache(timeout=ATTRIBUTE_RELEASE_PLAN_TIMEOUT, hostname_vary=False)
+def get_attribute_release_plan(provider_pk):
+    '''Return the attribute release plan of a provider, a pair made of the local attribute
+       names to compute and of the (name, name_format, friendly_name, attribute_name)
+       definitions of the SAML attributes to release.
+    '''
+    provider = LibertyProvider.objects.select_related('service_provider__sp_options_policy') \
+        .get(pk=provider_pk)
+    qs = SAMLAttribute.objects.for_generic_object(provider).filter(enabled=True)
+    sp_options_policy = get_sp_options_policy(provider)
+    if sp_options_policy:
+        qs |= SAMLAttribute.objects.for_generic_object(sp_options_policy).filter(enabled=True)
+    wanted_attributes = []
+    definitions = []
+    for definition in qs.distinct().order_by('pk'):
+        if definition.attribute_name not in wanted_attributes:
+            wanted_attributes.append(definition.attribute_name)
+        definitions.append((definition.name, definition.name_format_uri(),
+                            definition.friendly_name, definition.attribute_name))
+    return tuple(wanted_attributes), tuple(definitions)
+
+
+def clear_attribute_release_plan_cache(sender, instance, **kwargs):
+    get_attribute_release_plan.cache.clear()
+
+
 def get_session_not_on_or_after(assertion):
     '''Extract the minimal value for the SessionNotOnOrAfter found in the given
        assertion AuthenticationStatement(s).
@@ -0,0 +1,81 @@
+import logging
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils.timezone import now
+
+from authentic2.saml.common import process_metadata_autoload_queue, refresh_metadata
+from authentic2.saml.models import LibertyProvider
+
+
+class Command(BaseCommand):
+    help = '''Refresh metadata of SAML providers from their metadata URL and retrieve metadata of
+providers queued for autoload'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('entity_ids', nargs='*',
+                            help='entity ids of providers to refresh, default is all')
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='keep running and look for providers to refresh every INTERVAL seconds')
+        parser.add_argument(
+            '--force', default=False, action='store_true',
+            help='refresh providers even if their next refresh is not due')
+        parser.add_argument(
+            '--timeout', type=int, default=10,
+            help='timeout of HTTP requests in seconds')
+        parser.add_argument(
+            '--report', default=False, action='store_true',
+            help='show freshness of the metadata of each provider')
+
+    def handle(self, *args, **options):
+        while True:
+            self.refresh(options)
+            if options['report']:
+                self.report(options)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def get_queryset(self, options):
+        qs = LibertyProvider.objects.exclude(metadata_url='')
+        if options['entity_ids']:
+            qs = qs.filter(entity_id__in=options['entity_ids'])
+        return qs
+
+    def refresh(self, options):
+        logger = logging.getLogger(__name__)
+        verbosity = int(options['verbosity'])
+        for provider in process_metadata_autoload_queue(timeout=options['timeout']):
+            logger.info(u'saml: metadata of %s were autoloaded', provider.entity_id)
+            if verbosity > 1:
+                self.stdout.write(u'%s: created\n' % provider.entity_id)
+        qs = self.get_queryset(options)
+        if not options['force']:
+            qs = qs.filter(Q(metadata_next_refresh__isnull=True)
+                           | Q(metadata_next_refresh__lte=now()))
+        for provider in qs:
+            try:
+                changed = refresh_metadata(provider, timeout=options['timeout'])
+            except ValidationError as e:
+                logger.warning(u'saml: metadata refresh failed for %s (%d failures): %s',
+                               provider.entity_id, provider.metadata_refresh_failures,
+                               u', '.join(e.messages))
+                continue
+            if changed:
+                logger.info(u'saml: metadata of %s were updated', provider.entity_id)
+            if verbosity > 1:
+                self.stdout.write(u'%s: %s\n' % (provider.entity_id,
+                                                 'updated' if changed else 'unchanged'))
+
+    def report(self, options):
+        current = now()
+        for provider in self.get_queryset(options).order_by('metadata_refreshed'):
+            age = (u'%ds' % (current - provider.metadata_refreshed).total_seconds()
+                   if provider.metadata_refreshed else u'never refreshed')
+            next_refresh = (u'%ds' % (provider.metadata_next_refresh - current).total_seconds()
+                            if provider.metadata_next_refresh else u'now')
+            self.stdout.write(u'%s age=%s failures=%d next_refresh=%s\n' % (
+                provider.entity_id, age, provider.metadata_refresh_failures, next_refresh))
@@ -2,7 +2,6 @@ import sys
 import xml.etree.ElementTree as etree
 import os
 import requests
-from StringIO import StringIO
 import warnings
 
 from django.core.management.base import BaseCommand, CommandError
@@ -21,6 +20,9 @@ from .mapping import (get_def_name_from_oid, get_definition_from_oid, get_full_d
 
 SAML2_METADATA_UI_HREF = 'urn:oasis:names:tc:SAML:metadata:ui'
 
+# number of EntityDescriptor loaded together
+BATCH_SIZE = 100
+
 
 def md_element_name(tag_name):
     return '{%s}%s' % (lasso.SAML2_METADATA_HREF, tag_name)
@@ -94,7 +96,10 @@ def text_child(tree, tag, default=''):
     return elt.text if not elt is None else default
 
 
-def load_acs(tree, provider, pks, verbosity):
+def iter_acs_attributes(tree, provider, verbosity):
+    '''Yield lookup and default values of SAMLAttribute for attributes requested in the
+       AttributeConsumingService nodes'''
+    content_type = ContentType.objects.get_for_model(LibertyProvider)
     acss = tree.iter(ATTRIBUTE_CONSUMING_SERVICE)
     for acs in acss:
         for ra in acs.iter(REQUESTED_ATTRIBUTE):
@@ -109,11 +114,9 @@ def load_acs(tree, provider, pks, verbosity):
                 warnings.warn('attribute %s/%s unsupported on service provider %s' % (
                     oid, name_format, provider.entity_id))
                 continue
-            content_type = ContentType.objects.get_for_model(LibertyProvider)
-            object_id = provider.pk
             kwargs = {
                 'content_type': content_type,
-                'object_id': object_id,
+                'object_id': provider.pk,
                 'name_format': 'uri',
                 'name': oid,
             }
@@ -122,21 +125,23 @@ def load_acs(tree, provider, pks, verbosity):
                 'friendly_name': friendly_name or def_name,
                 'enabled': is_required,
             }
+            yield kwargs, defaults
 
-            try:
-                attribute, created = SAMLAttribute.objects.get_or_create(
-                    defaults=defaults, **kwargs)
-                if created and verbosity > 1:
-                    print _('Created new attribute %(name)s for %(provider)s') % \
-                        {'name': oid, 'provider': provider}
-                pks.append(attribute.pk)
-            except SAMLAttribute.MultipleObjectsReturned:
-                pks.extend(SAMLAttribute.objects.filter(**kwargs).values_list('pk', flat=True))
-
-
-def load_one_entity(tree, options, sp_policy=None, afp=None):
-    '''Load or update an EntityDescriptor into the database'''
-    verbosity = int(options['verbosity'])
+
+def iter_afp_attributes(afp, provider, verbosity):
+    '''Yield lookup and default values of SAMLAttribute for attributes allowed by the
+       Shibboleth attribute filter policy'''
+    for name in afp[provider.entity_id]:
+        kwargs, defaults = build_saml_attribute_kwargs(provider, name)
+        if not kwargs:
+            if verbosity > 1:
+                print >>sys.stderr, _('Unable to find an LDAP definition for attribute %(name)s on %(provider)s') % \
+                    {'name': name, 'provider': provider}
+            continue
+        yield kwargs, defaults
+
+
+def get_entity_name(tree):
     entity_id = tree.get(ENTITY_ID)
     name = None
     # try mdui nodes
@@ -155,69 +160,189 @@ def load_one_entity(tree, options, sp_policy=None, afp=None):
                 name = organization_name.text
     if not name:
         name = entity_id
-    sp = False, False
-    sp = check_support_saml2(tree.find(SP_SSO_DESCRIPTOR_TN))
+    return name
+
+
+def is_unchanged(provider, name, metadata, options, sp_policy=None, afp=None):
+    '''Return True if loading the entity would not modify the existing provider'''
+    if provider is None:
+        return False
+    # these options may change attributes or service providers even if the metadata did not
+    if (options['load_attribute_consuming_service'] or options['create-disabled']
+            or options.get('reset-attributes')):
+        return False
+    if afp and provider.entity_id in afp:
+        return False
+    try:
+        service_provider = provider.service_provider
+    except LibertyServiceProvider.DoesNotExist:
+        return False
+    if sp_policy and service_provider.sp_options_policy_id != sp_policy.pk:
+        return False
+    return (provider.name == name[:128]
+            and provider.protocol_conformance == 3
+            and provider.federation_source == options['source']
+            and provider.metadata == metadata)
+
+
+def unique_slug(name, entity_id):
+    # build an unique slug
+    baseslug = slug = slugify(name)[:120]
+    n = 1
+    while LibertyProvider.objects.filter(slug=slug).exclude(entity_id=entity_id):
+        n += 1
+        slug = '%s-%d' % (baseslug, n)
+    return slug
+
+
+def load_entities(trees, options, sp_policy=None, afp=None):
+    '''Load or update a batch of EntityDescriptor into the database, return the entity ids of
+       the loaded entities.
+
+       Existing providers of the batch are retrieved with one query, providers whose metadata,
+       name and policy did not change are skipped, service providers and SAML attributes are
+       created in bulk.
+    '''
+    verbosity = int(options['verbosity'])
+    entity_ids = [tree.get(ENTITY_ID) for tree in trees]
     if options.get('delete'):
-        LibertyProvider.objects.filter(entity_id=entity_id).delete()
-        print 'Deleted', entity_id
-        return
-    if sp:
-        # build an unique slug
-        baseslug = slug = slugify(name)[:120]
-        n = 1
-        while LibertyProvider.objects.filter(slug=slug).exclude(entity_id=entity_id):
-            n += 1
-            slug = '%s-%d' % (baseslug, n)
-        # get or create the provider
-        provider, created = LibertyProvider.objects.get_or_create(
-            entity_id=entity_id, protocol_conformance=3,
-            defaults={'name': name[:128], 'slug': slug})
-        if verbosity > 1:
-            if created:
-                what = 'Creating'
+        LibertyProvider.objects.filter(entity_id__in=entity_ids).delete()
+        for entity_id in entity_ids:
+            print 'Deleted', entity_id
+        return entity_ids
+
+    qs = LibertyProvider.objects.filter(entity_id__in=entity_ids, protocol_conformance=3)
+    qs = qs.select_related('service_provider')
+    existing = dict((provider.entity_id, provider) for provider in qs)
+    new_service_providers = []
+    attributes = []
+    reset_attributes = []
+    loaded = []
+    for tree in trees:
+        entity_id = tree.get(ENTITY_ID)
+        try:
+            if not check_support_saml2(tree.find(SP_SSO_DESCRIPTOR_TN)):
+                loaded.append(entity_id)
+                continue
+            name = get_entity_name(tree)
+            metadata = etree.tostring(tree, encoding='utf-8').decode('utf-8').strip()
+            provider = existing.get(entity_id)
+            if is_unchanged(provider, name, metadata, options, sp_policy=sp_policy, afp=afp):
+                if verbosity > 1:
+                    print 'Unchanged %(name)s, %(id)s' % {
+                        'name': name.encode('utf8'), 'id': entity_id}
+                options['unchanged'] = options.get('unchanged', 0) + 1
+                loaded.append(entity_id)
+                continue
+            if provider is None:
+                provider = LibertyProvider(entity_id=entity_id, protocol_conformance=3,
+                                           slug=unique_slug(name, entity_id))
+            if verbosity > 1:
+                print '%(what)s %(name)s, %(id)s' % {
+                    'what': 'Updating' if provider.pk else 'Creating',
+                    'name': name.encode('utf8'), 'id': entity_id}
+            provider.name = name[:128]
+            provider.metadata = metadata
+            provider.protocol_conformance = 3
+            provider.federation_source = options['source']
+            provider.save()
+            options['count'] = options.get('count', 0) + 1
+            try:
+                service_provider = provider.service_provider
+            except LibertyServiceProvider.DoesNotExist:
+                new_service_providers.append(LibertyServiceProvider(
+                    liberty_provider=provider, enabled=not options['create-disabled'],
+                    sp_options_policy=sp_policy))
             else:
-                what = 'Updating'
-            print '%(what)s %(name)s, %(id)s' % {
-                'what': what, 'name': name.encode('utf8'), 'id': entity_id}
-        provider.name = name[:128]
-        provider.metadata = etree.tostring(tree, encoding='utf-8').decode('utf-8').strip()
-        provider.protocol_conformance = 3
-        provider.federation_source = options['source']
-        provider.save()
-        options['count'] = options.get('count', 0) + 1
-        if sp:
-            service_provider, created = LibertyServiceProvider.objects.get_or_create(
-                liberty_provider=provider, defaults={'enabled': not options['create-disabled']})
-            if sp_policy:
-                service_provider.sp_options_policy = sp_policy
-            service_provider.save()
-            pks = []
+                if sp_policy and service_provider.sp_options_policy_id != sp_policy.pk:
+                    service_provider.sp_options_policy = sp_policy
+                    service_provider.save()
             if options['load_attribute_consuming_service']:
-                load_acs(tree, provider, pks, verbosity)
+                attributes.extend((provider, kwargs, defaults) for kwargs, defaults
+                                  in iter_acs_attributes(tree, provider, verbosity))
             if afp and provider.entity_id in afp:
-                for name in afp[provider.entity_id]:
-                    kwargs, defaults = build_saml_attribute_kwargs(provider, name)
-                    if not kwargs:
-                        if verbosity > 1:
-                            print >>sys.stderr, _('Unable to find an LDAP definition for attribute %(name)s on %(provider)s') % \
-                                {'name': name, 'provider': provider}
-                        continue
-                    # create object with default attribute mapping to the same name
-                    # as the attribute if no SAMLAttribute model already exists,
-                    # otherwise do nothing
-                    try:
-                        attribute, created = SAMLAttribute.objects.get_or_create(
-                            defaults=defaults, **kwargs)
-                        if created and verbosity > 1:
-                            print (_('Created new attribute %(name)s for %(provider)s')
-                                   % {'name': name, 'provider': provider})
-                        pks.append(attribute.pk)
-                    except SAMLAttribute.MultipleObjectsReturned:
-                        pks.extend(SAMLAttribute.objects.filter(
-                            **kwargs).values_list('pk', flat=True))
+                attributes.extend((provider, kwargs, defaults) for kwargs, defaults
+                                  in iter_afp_attributes(afp, provider, verbosity))
                 if options.get('reset-attributes'):
-                    # remove attributes not matching the filters
-                    SAMLAttribute.objects.for_generic_object(provider).exclude(pk__in=pks).delete()
+                    reset_attributes.append(provider.pk)
+            loaded.append(entity_id)
+        except Exception:
+            if not options['ignore-errors']:
+                raise
+            if verbosity > 0:
+                print >>sys.stderr, (_('Failed to load entity descriptor for %s') % entity_id)
+            raise CommandError()
+    LibertyServiceProvider.objects.bulk_create(new_service_providers)
+    load_attributes(attributes, reset_attributes, verbosity)
+    return loaded
+
+
+def load_attributes(attributes, reset_attributes, verbosity):
+    '''Create missing SAML attributes, existing attributes are left untouched; remove
+       attributes not listed from providers in reset_attributes'''
+    if not attributes and not reset_attributes:
+        return
+    content_type = ContentType.objects.get_for_model(LibertyProvider)
+    object_ids = set(provider.pk for provider, kwargs, defaults in attributes)
+    object_ids.update(reset_attributes)
+    qs = SAMLAttribute.objects.filter(content_type=content_type, object_id__in=object_ids)
+    existing = {}
+    for pk, object_id, name_format, name in qs.values_list('pk', 'object_id', 'name_format',
+                                                           'name'):
+        existing.setdefault((object_id, name_format, name), []).append(pk)
+    kept = set()
+    to_create = {}
+    for provider, kwargs, defaults in attributes:
+        key = (kwargs['object_id'], kwargs['name_format'], kwargs['name'])
+        if key in existing:
+            kept.update(existing[key])
+        elif key not in to_create:
+            to_create[key] = provider, SAMLAttribute(**dict(kwargs, **defaults))
+    if reset_attributes:
+        # remove attributes not matching the filters
+        SAMLAttribute.objects.filter(content_type=content_type, object_id__in=reset_attributes) \
+            .exclude(pk__in=kept).delete()
+    SAMLAttribute.objects.bulk_create([attribute for provider, attribute in to_create.values()])
+    if verbosity > 1:
+        for provider, attribute in to_create.values():
+            print (_('Created new attribute %(name)s for %(provider)s')
+                   % {'name': attribute.name, 'provider': provider})
+
+
+def iter_entity_descriptors(metadata_file):
+    '''Parse metadata_file incrementally, yield the tag of the root element then each
+       EntityDescriptor element, the root one or the children of the root EntitiesDescriptor.
+
+       Yielded elements are removed from the tree so that memory usage does not grow with the
+       size of the file.
+    '''
+    root = None
+    depth = 0
+    for event, elt in etree.iterparse(metadata_file, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elt
+                yield root.tag
+            depth += 1
+            continue
+        depth -= 1
+        if elt.tag != ENTITY_DESCRIPTOR_TN:
+            continue
+        if depth == 0 or (depth == 1 and root.tag == ENTITIES_DESCRIPTOR_TN):
+            yield elt
+            if depth == 1:
+                root.remove(elt)
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 class Command(BaseCommand):
@@ -300,24 +425,28 @@ Any other kind of attribute filter policy is unsupported.
         except:
             raise CommandError('--source MUST be an ASCII string value')
         if metadata_file_path.startswith('http://') or metadata_file_path.startswith('https://'):
-            response = requests.get(metadata_file_path)
+            response = requests.get(metadata_file_path, stream=True)
             if not response.ok:
                 raise CommandError('Unable to open url %s' % metadata_file_path)
-            metadata_file = StringIO(response.content)
+            # parse the response while it is downloaded
+            response.raw.decode_content = True
+            metadata_file = response.raw
         else:
             try:
                 metadata_file = file(metadata_file_path)
             except:
                 raise CommandError('Unable to open file %s' % metadata_file_path)
 
+        entity_descriptors = iter_entity_descriptors(metadata_file)
         try:
-            doc = etree.parse(metadata_file)
-        except Exception, e:
+            root_tag = next(entity_descriptors)
+        except (etree.ParseError, StopIteration), e:
             raise CommandError('XML parsing error: %s' % str(e))
-        if doc.getroot().tag == ENTITY_DESCRIPTOR_TN:
-            load_one_entity(doc.getroot(), options)
-        elif doc.getroot().tag == ENTITIES_DESCRIPTOR_TN:
-            afp = None
+        if root_tag not in (ENTITY_DESCRIPTOR_TN, ENTITIES_DESCRIPTOR_TN):
+            raise CommandError('%s is not a SAMLv2 metadata file' % metadata_file)
+        afp = None
+        sp_policy = None
+        if root_tag == ENTITIES_DESCRIPTOR_TN:
             if 'attribute-filter-policy' in options and options['attribute-filter-policy']:
                 path = options['attribute-filter-policy']
                 if not os.path.isfile(path):
@@ -325,7 +454,6 @@ Any other kind of attribute filter policy is unsupported.
                         'No attribute filter policy file %s' % path)
                 afp = parse_attribute_filters_file(
                     options['attribute-filter-policy'])
-            sp_policy = None
             if 'sp_policy' in options and options['sp_policy']:
                 sp_policy_name = options['sp_policy']
                 try:
@@ -341,40 +469,26 @@ Any other kind of attribute filter policy is unsupported.
             else:
                 if verbosity > 1:
                     print 'No SAML2 service provider options policy provided'
-            loaded = []
-            if doc.getroot().tag == ENTITY_DESCRIPTOR_TN:
-                entity_descriptors = [doc.getroot()]
+        loaded = set()
+        try:
+            for batch in batches(entity_descriptors, BATCH_SIZE):
+                loaded.update(load_entities(batch, options, sp_policy=sp_policy, afp=afp))
+        except etree.ParseError, e:
+            raise CommandError('XML parsing error: %s' % str(e))
+        if root_tag == ENTITIES_DESCRIPTOR_TN and options['source']:
+            qs = LibertyProvider.objects.filter(federation_source=source)
+            if options['delete']:
+                print 'Finally delete all providers for source: %s...' % source
+                qs.delete()
             else:
-                entity_descriptors = doc.getroot().findall(ENTITY_DESCRIPTOR_TN)
-            for entity_descriptor in entity_descriptors:
-                try:
-                    load_one_entity(
-                        entity_descriptor, options,
-                        sp_policy=sp_policy,
-                        afp=afp)
-                    loaded.append(entity_descriptor.get(ENTITY_ID))
-                except Exception, e:
-                    if not options['ignore-errors']:
-                        raise
-                    if verbosity > 0:
-                        print >>sys.stderr, (_('Failed to load entity descriptor for %s')
-                                             % entity_descriptor.get(ENTITY_ID))
-                    raise CommandError()
-            if options['source']:
-                if options['delete']:
-                    print 'Finally delete all providers for source: %s...' % source
-                    LibertyProvider.objects.filter(federation_source=source).delete()
-                else:
-                    to_delete = []
-                    for provider in LibertyProvider.objects.filter(federation_source=source):
-                        if provider.entity_id not in loaded:
-                            to_delete.append(provider)
-                    for provider in to_delete:
-                        if verbosity > 1:
-                            print _('Deleted obsolete provider %s') % provider.entity_id
-                        provider.delete()
-        else:
-            raise CommandError('%s is not a SAMLv2 metadata file' % metadata_file)
+                to_delete = [(pk, entity_id) for pk, entity_id in qs.values_list('pk', 'entity_id')
+                             if entity_id not in loaded]
+                if verbosity > 1:
+                    for pk, entity_id in to_delete:
+                        print _('Deleted obsolete provider %s') % entity_id
+                for batch in batches([pk for pk, entity_id in to_delete], BATCH_SIZE):
+                    LibertyProvider.objects.filter(pk__in=batch).delete()
         if not options.get('delete'):
             if verbosity > 1:
                 print 'Loaded', options.get('count', 0), 'providers'
+                print 'Skipped', options.get('unchanged', 0), 'unchanged providers'
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saml', '0017_auto_20170710_1738'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='libertyprovider',
+            name='metadata_etag',
+            field=models.CharField(max_length=256, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='libertyprovider',
+            name='metadata_last_modified',
+            field=models.CharField(max_length=64, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='libertyprovider',
+            name='metadata_next_refresh',
+            field=models.DateTimeField(null=True, editable=False, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='libertyprovider',
+            name='metadata_refresh_failures',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='libertyprovider',
+            name='metadata_refreshed',
+            field=models.DateTimeField(verbose_name='Metadata refreshed', null=True, editable=False),
+        ),
+    ]
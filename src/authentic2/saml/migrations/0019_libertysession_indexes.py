@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saml', '0018_libertyprovider_metadata_refresh'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='libertysession',
+            index_together=set([('provider_id', 'session_index'),
+                                ('django_session_key', 'provider_id')]),
+        ),
+    ]
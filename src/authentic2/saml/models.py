@@ -2,19 +2,25 @@ import xml.etree.ElementTree as etree
 import hashlib
 import numbers
 import datetime
+import json
+import uuid
 import six
 
 import requests
 from authentic2.compat_lasso import lasso
-from authentic2.utils import normalize_attribute_values
+from authentic2.utils import normalize_attribute_values, utf8_encode
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+from django.utils.encoding import force_bytes, force_text
+from django.utils import timezone
 try:
     from django.contrib.contenttypes.fields import GenericForeignKey
 except ImportError:
@@ -27,7 +33,7 @@ except ImportError:
 from fields import PickledObjectField, MultiSelectField
 
 from . import app_settings, managers
-from .. import managers as a2_managers
+from .. import managers as a2_managers, app_settings as a2_app_settings
 from ..models import Service
 
 def metadata_validator(meta):
@@ -324,6 +330,13 @@ class LibertyProvider(Service):
     ca_cert_chain = models.TextField(blank=True)
     federation_source = models.CharField(max_length=64, blank=True, null=True,
             verbose_name=_('Federation source'))
+    # state of the refresh of metadata from metadata_url
+    metadata_etag = models.CharField(max_length=256, blank=True, editable=False)
+    metadata_last_modified = models.CharField(max_length=64, blank=True, editable=False)
+    metadata_refreshed = models.DateTimeField(
+        verbose_name=_('Metadata refreshed'), null=True, editable=False)
+    metadata_refresh_failures = models.PositiveIntegerField(default=0, editable=False)
+    metadata_next_refresh = models.DateTimeField(null=True, editable=False, db_index=True)
 
     attributes = GenericRelation(SAMLAttribute)
 
@@ -335,7 +348,7 @@ class LibertyProvider(Service):
     def save(self, *args, **kwargs):
         '''Update the SHA1 hash of the entity_id when saving'''
         if self.protocol_conformance == 3:
-            self.entity_id_sha1 = hashlib.sha1(self.entity_id).hexdigest()
+            self.entity_id_sha1 = hashlib.sha1(force_bytes(self.entity_id)).hexdigest()
         super(LibertyProvider, self).save(*args, **kwargs)
 
     def clean(self):
@@ -353,17 +366,38 @@ class LibertyProvider(Service):
     def natural_key(self):
         return (self.slug,)
 
-    def update_metadata(self):
+    def update_metadata(self, timeout=None, commit=True):
+        '''Retrieve metadata from metadata_url, the request is conditional if the previous
+           response had an ETag or a Last-Modified header. Return True if metadata changed.
+
+           With commit=False the provider is not saved, see METADATA_UPDATE_FIELDS.'''
+        if not self.metadata_url:
+            raise ValidationError(_('No metadata URL'))
+        headers = {}
+        if self.metadata_etag:
+            headers['If-None-Match'] = self.metadata_etag
+        if self.metadata_last_modified:
+            headers['If-Modified-Since'] = self.metadata_last_modified
         try:
-            if not self.metadata_url:
-                raise ValidationError(_('No metadata URL'))
-            response = requests.get(self.metadata_url)
+            response = requests.get(self.metadata_url, headers=headers, timeout=timeout)
+            response.raise_for_status()
         except requests.RequestException, e:
             raise ValidationError(_('Retrieval of metadata failed: %s') % e)
-        else:
-            self.metadata = response.content
+        self.metadata_refreshed = timezone.now()
+        changed = response.status_code != 304
+        if changed:
+            self.metadata = force_text(response.content)
             self.clean()
+            self.metadata_etag = response.headers.get('ETag', '')
+            self.metadata_last_modified = response.headers.get('Last-Modified', '')
+        if commit:
             self.save()
+        return changed
+
+    # fields modified by update_metadata(), the last ones only when metadata changed
+    METADATA_UPDATE_FIELDS = ['metadata_refreshed']
+    METADATA_CHANGE_FIELDS = ['metadata', 'metadata_etag', 'metadata_last_modified', 'entity_id',
+                              'entity_id_sha1', 'name', 'protocol_conformance']
 
     class Meta:
         ordering = ('service_ptr__name',)
@@ -577,6 +611,38 @@ class LibertySession(models.Model):
     class Meta:
         verbose_name = _("SAML session")
         verbose_name_plural = _("SAML sessions")
+        index_together = (
+            ('provider_id', 'session_index'),
+            ('django_session_key', 'provider_id'),
+        )
+
+SESSION_PROVIDER_IDS_CACHE_KEY = 'a2-saml-session-provider-ids|%s'
+# the invalidation is not seen by other processes if the cache is not shared between them,
+# and single logout would skip the providers joined since, keep the set a few seconds at most
+SESSION_PROVIDER_IDS_TIMEOUT = 5
+
+
+def get_session_provider_ids(session_key):
+    '''Return the set of provider ids having a LibertySession for this Django session, the
+       result is cached until a LibertySession is saved or deleted for the session, and at
+       most SESSION_PROVIDER_IDS_TIMEOUT seconds. Longer timeouts need a cache shared by all
+       processes.
+    '''
+    cache_key = SESSION_PROVIDER_IDS_CACHE_KEY % session_key
+    if a2_app_settings.A2_CACHE_ENABLED:
+        provider_ids = cache.get(cache_key)
+        if provider_ids is not None:
+            return provider_ids
+    provider_ids = frozenset(LibertySession.objects.filter(django_session_key=session_key)
+                             .values_list('provider_id', flat=True))
+    if a2_app_settings.A2_CACHE_ENABLED:
+        cache.set(cache_key, provider_ids, SESSION_PROVIDER_IDS_TIMEOUT)
+    return provider_ids
+
+
+def clear_session_provider_ids(sender, instance, **kwargs):
+    cache.delete(SESSION_PROVIDER_IDS_CACHE_KEY % instance.django_session_key)
+
 
 class KeyValue(models.Model):
     key = models.CharField(max_length=128, primary_key=True)
@@ -592,16 +658,64 @@ class KeyValue(models.Model):
         verbose_name = _("key value association")
         verbose_name_plural = _("key value associations")
 
+class DatabaseKeyValueStore(object):
+    '''Store values in the KeyValue table, old rows are removed by the cleanup command'''
+
+    def save(self, key, values):
+        KeyValue.objects.update_or_create(key=key, defaults={'value': values})
+
+    def get_and_delete(self, key):
+        with transaction.atomic():
+            try:
+                kv = KeyValue.objects.select_for_update().get(key=key)
+            except ObjectDoesNotExist:
+                raise KeyError(key)
+            kv.delete()
+        return kv.value
+
+
+class CacheKeyValueStore(object):
+    '''Store values as JSON in the Django cache, they expire after SAML_KEY_VALUE_TIMEOUT
+       seconds.
+
+       Each save gets a token, reading values consumes the token using cache.add() which is
+       atomic, so that values can only be retrieved once.
+
+       The default cache must be shared by all the processes serving requests, with a
+       per-process cache an SSO started on one worker cannot be continued on another.
+    '''
+    prefix = 'a2-saml-key-value|'
+
+    def get_cache_key(self, key):
+        # keys come from requests, hash them to keep cache keys short and safe
+        return self.prefix + hashlib.sha1(force_bytes(key)).hexdigest()
+
+    def save(self, key, values):
+        payload = json.dumps([uuid.uuid4().hex] + list(values), separators=(',', ':'))
+        cache.set(self.get_cache_key(key), payload, app_settings.KEY_VALUE_TIMEOUT)
+
+    def get_and_delete(self, key):
+        cache_key = self.get_cache_key(key)
+        payload = cache.get(cache_key)
+        if payload is None:
+            raise KeyError(key)
+        values = utf8_encode(json.loads(payload))
+        if not cache.add('%s|%s' % (cache_key, values[0]), True,
+                         app_settings.KEY_VALUE_TIMEOUT):
+            # already consumed by a concurrent request
+            raise KeyError(key)
+        cache.delete(cache_key)
+        return tuple(values[1:])
+
+
+def get_key_value_store():
+    return import_string(app_settings.KEY_VALUE_STORE)()
+
+
 def save_key_values(key, *values):
-    # never update an existing key, key are nonces
-    kv, created = KeyValue.objects.get_or_create(key=key, defaults={'value': values})
-    if not created:
-        kv.value = values
-        kv.save()
+    get_key_value_store().save(key, values)
+
 
 def get_and_delete_key_values(key):
-    try:
-        kv = KeyValue.objects.get(key=key)
-        return kv.value
-    except ObjectDoesNotExist:
-        raise KeyError
+    '''Return values saved for key and forget them, raise KeyError if there is none'''
+    return get_key_value_store().get_and_delete(key)
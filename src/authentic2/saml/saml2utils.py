@@ -398,7 +398,7 @@ def get_attributes_from_assertion(assertion, logger):
                 except Exception, e:
                     message = 'get_attributes_from_assertion: name or format of an \
                         attribute failed to decode as ascii: %s due to %s'
-                    logger.warning(message % (attribute.dump(), str(e)))
+                    logger.warning(message, attribute.dump(), e)
                 try:
                     values = attribute.attributeValue
                     if values:
@@ -413,7 +413,7 @@ def get_attributes_from_assertion(assertion, logger):
                 except Exception, e:
                     message = 'get_attributes_from_assertion: value of an \
                         attribute failed to decode as ascii: %s due to %s'
-                    logger.warning(message % (attribute.dump(), str(e)))
+                    logger.warning(message, attribute.dump(), e)
     attributes['__issuer'] = assertion.issuer.content
     attributes['__nameid'] = assertion.subject.nameID.content
     return attributes
@@ -1,5 +1,27 @@
 from authentic2.decorators import GlobalCache
 
+from .saml2utils import filter_attribute_private_key, filter_element_private_key
+
+
+class lazy_dump(object):
+    '''Log argument serializing a lasso object only when the message is emitted, i.e.
+
+           logger.debug('assertion %s', lazy_dump(assertion))
+
+       does not call assertion.dump() if DEBUG is disabled for logger.
+    '''
+    __slots__ = ('node',)
+
+    def __init__(self, node):
+        self.node = node
+
+    def __str__(self):
+        if self.node is None:
+            return 'None'
+        return filter_element_private_key(filter_attribute_private_key(self.node.dump()))
+
+    __repr__ = __str__
+
 
 @GlobalCache(timeout=60)
 def get_entity_ids():
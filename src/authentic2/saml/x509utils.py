@@ -1,13 +1,23 @@
 import base64
 import binascii
+import hashlib
 import tempfile
 import os
 import subprocess
 import stat
 import six
 
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
 _openssl = 'openssl'
 
+# parsed public numbers by PEM fingerprint
+_public_numbers_cache = {}
+_PUBLIC_NUMBERS_CACHE_SIZE = 256
+
 def decapsulate_pem_file(file_or_string):
     '''Remove PEM header lines'''
     if not isinstance(file_or_string, six.string_types):
@@ -43,39 +53,50 @@ def _protect_file(fd,filepath):
     else: # handle python <2.6
         os.chmod(filepath, stat.S_IRUSR | stat.S_IWUSR)
 
+def _load_public_key(pem):
+    '''Load the public key of a PEM certificate, public key or private key'''
+    backend = default_backend()
+    if 'BEGIN CERTIFICATE' in pem:
+        return x509.load_pem_x509_certificate(pem, backend).public_key()
+    elif 'PRIVATE KEY' in pem:
+        return serialization.load_pem_private_key(pem, None, backend).public_key()
+    elif 'PUBLIC KEY' in pem:
+        return serialization.load_pem_public_key(pem, backend)
+    raise ValueError('no PEM certificate or key found')
+
+
+def get_public_numbers(pem):
+    '''Return the public numbers of the key contained in a PEM certificate,
+       public key or private key, None if it cannot be parsed.
+
+       Results are cached by fingerprint of the PEM content.
+    '''
+    if isinstance(pem, unicode):
+        pem = pem.encode('ascii')
+    fingerprint = hashlib.sha256(pem).digest()
+    try:
+        return _public_numbers_cache[fingerprint]
+    except KeyError:
+        pass
+    try:
+        public_numbers = _load_public_key(pem).public_numbers()
+    except (ValueError, TypeError, AttributeError):
+        public_numbers = None
+    if len(_public_numbers_cache) >= _PUBLIC_NUMBERS_CACHE_SIZE:
+        _public_numbers_cache.clear()
+    _public_numbers_cache[fingerprint] = public_numbers
+    return public_numbers
+
+
 def check_key_pair_consistency(publickey=None,privatekey=None):
     '''Check if two PEM key pair whether they are publickey or certificate, are
     well formed and related.
     '''
     if publickey and privatekey:
-        try:
-            privatekey_file_fd, privatekey_fn = tempfile.mkstemp()
-            publickey_file_fd, publickey_fn = tempfile.mkstemp()
-            _protect_file(privatekey_file_fd, privatekey_fn)
-            _protect_file(publickey_file_fd, publickey_fn)
-            os.fdopen(privatekey_file_fd,'w').write(privatekey)
-            os.fdopen(publickey_file_fd,'w').write(publickey)
-            if 'BEGIN CERTIFICATE' in publickey:
-                rc1, modulus1 = _call_openssl(['x509', '-in', publickey_fn,'-noout','-modulus'])
-            else:
-                rc1, modulus1 = _call_openssl(['rsa', '-pubin', '-in', publickey_fn,'-noout','-modulus'])
-                if rc1 != 0:
-                    rc1, modulus1 = _call_openssl(['dsa', '-pubin', '-in', publickey_fn,'-noout','-modulus'])
-
-            if rc1 != 0:
-                return False
-
-            rc2, modulus2 = _call_openssl(['rsa', '-in', privatekey_fn,'-noout','-modulus'])
-            if rc2 != 0:
-                rc2, modulus2 = _call_openssl(['dsa', '-in', privatekey_fn,'-noout','-modulus'])
-
-            if rc1 == 0 and rc2 == 0 and modulus1 == modulus2:
-                return True
-            else:
-                return False
-        finally:
-            os.unlink(privatekey_fn)
-            os.unlink(publickey_fn)
+        public_numbers1 = get_public_numbers(publickey)
+        if public_numbers1 is None:
+            return False
+        return public_numbers1 == get_public_numbers(privatekey)
     return None
 
 def generate_rsa_keypair(numbits=1024):
@@ -96,44 +117,15 @@ def generate_rsa_keypair(numbits=1024):
         os.unlink(publickey_fn)
 
 def get_rsa_public_key_modulus(publickey):
-    try:
-        publickey_file_fd, publickey_fn = tempfile.mkstemp()
-        os.fdopen(publickey_file_fd,'w').write(publickey)
-        if 'BEGIN PUBLIC' in publickey:
-            rc, modulus = _call_openssl(['rsa', '-pubin', '-in', publickey_fn,'-noout','-modulus'])
-        elif 'BEGIN RSA PRIVATE KEY' in publickey:
-            rc, modulus = _call_openssl(['rsa', '-in', publickey_fn, '-noout', '-modulus'])
-        elif 'BEGIN CERTIFICATE' in publickey:
-            rc, modulus = _call_openssl(['x509', '-in', publickey_fn,'-noout','-modulus'])
-        else:
-            return None
-        i = modulus.find('=')
-        if rc == 0 and i:
-            return int(modulus[i+1:].strip(),16)
-    finally:
-        os.unlink(publickey_fn)
+    public_numbers = get_public_numbers(publickey)
+    if isinstance(public_numbers, rsa.RSAPublicNumbers):
+        return public_numbers.n
     return None
 
 def get_rsa_public_key_exponent(publickey):
-    try:
-        publickey_file_fd, publickey_fn = tempfile.mkstemp()
-        os.fdopen(publickey_file_fd,'w').write(publickey)
-        _exponent = 'Exponent: '
-        if 'BEGIN PUBLIC' in publickey:
-            rc, modulus = _call_openssl(['rsa', '-pubin', '-in', publickey_fn,'-noout','-text'])
-        elif 'BEGIN RSA PRIVATE' in publickey:
-            rc, modulus = _call_openssl(['rsa', '-in', publickey_fn, '-noout', '-text'])
-            _exponent = 'publicExponent: '
-        elif 'BEGIN CERTIFICATE' in publickey:
-            rc, modulus = _call_openssl(['x509', '-in', publickey_fn,'-noout','-text'])
-        else:
-            return None
-        i = modulus.find(_exponent)
-        j = modulus.find('(', i)
-        if rc == 0 and i and j:
-            return int(modulus[i+len(_exponent):j].strip())
-    finally:
-        os.unlink(publickey_fn)
+    public_numbers = get_public_numbers(publickey)
+    if isinstance(public_numbers, rsa.RSAPublicNumbers):
+        return public_numbers.e
     return None
 
 def can_generate_rsa_key_pair():
@@ -201,4 +193,3 @@ pkkt86tIOLEtaNO97CcF/t+Un5QAh9MqLmQv5pwUDo4Lqo7qo1bAfyHjOlr5kdaP
     assert(check_key_pair_consistency(cert, key))
     assert(get_xmldsig_rsa_key_value(cert))
     assert(len(decapsulate_pem_file(key).splitlines()) == len(key.splitlines())-2)
-
@@ -8,6 +8,8 @@ import urlparse
 import uuid
 import datetime
 import copy
+import collections
+import threading
 
 from functools import wraps
 from itertools import islice, chain, count
@@ -52,44 +54,144 @@ from . import plugins, app_settings, constants
 
 
 class CleanLogMessage(logging.Filter):
+    def clean(self, message):
+        return filter_element_private_key(filter_attribute_private_key(message))
+
     def filter(self, record):
-        record.msg = filter_attribute_private_key(record.msg)
-        record.msg = filter_element_private_key(record.msg)
+        record.msg = self.clean(record.msg)
+        # messages can also be given as arguments
+        if isinstance(record.args, tuple):
+            record.args = tuple(self.clean(arg) for arg in record.args)
+        elif isinstance(record.args, dict):
+            record.args = dict((key, self.clean(value)) for key, value in record.args.items())
         return True
 
 
+_MISSING = object()
+
+
+class LRUCache(object):
+    '''Thread-safe dictionary-like cache.
+
+       It keeps at most max_size entries, the least recently used entries are evicted first.
+       Entries older than timeout seconds are considered missing and removed. Hits, misses,
+       evictions and expirations are counted, see stats().
+    '''
+    def __init__(self, max_size=None, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.data = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def is_expired(self, tstamp, now):
+        return self.timeout is not None and tstamp + self.timeout <= now
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, tstamp = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.is_expired(tstamp, time.time()):
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # move to the most recently used position
+            self.data[key] = value, tstamp
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value, time.time()
+            if self.max_size is not None:
+                while len(self.data) > self.max_size:
+                    self.data.popitem(last=False)
+                    self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            try:
+                return self.data.pop(key)[0]
+            except KeyError:
+                return default
+
+    def purge(self):
+        '''Remove expired entries'''
+        if self.timeout is None:
+            return
+        now = time.time()
+        with self.lock:
+            for key, (value, tstamp) in self.data.items():
+                if self.is_expired(tstamp, now):
+                    del self.data[key]
+                    self.expirations += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'size': len(self.data),
+            'max_size': self.max_size,
+        }
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            return item is not None and not self.is_expired(item[1], time.time())
+
+    def __len__(self):
+        return len(self.data)
+
+
 class MWT(object):
     """Memoize With Timeout"""
     _caches = {}
     _timeouts = {}
 
-    def __init__(self, timeout=2):
+    def __init__(self, timeout=2, max_size=1000):
         self.timeout = timeout
+        self.max_size = max_size
 
     def collect(self):
         """Clear cache of results which have timed out"""
-        for func in self._caches:
-            cache = {}
-            for key in self._caches[func]:
-                if (time.time() - self._caches[func][key][1]) < self._timeouts[func]:
-                    cache[key] = self._caches[func][key]
-            self._caches[func] = cache
+        for cache in self._caches.values():
+            cache.purge()
 
     def __call__(self, f):
-        self.cache = self._caches[f] = {}
+        self.cache = self._caches[f] = LRUCache(max_size=self.max_size, timeout=self.timeout)
         self._timeouts[f] = self.timeout
 
         def func(*args, **kwargs):
             kw = kwargs.items()
             kw.sort()
             key = (args, tuple(kw))
-            try:
-                v = self.cache[key]
-                if (time.time() - v[1]) > self.timeout:
-                    raise KeyError
-            except KeyError:
-                v = self.cache[key] = f(*args, **kwargs), time.time()
-            return v[0]
+            v = self.cache.get(key, _MISSING)
+            if v is _MISSING:
+                v = self.cache[key] = f(*args, **kwargs)
+            return v
         func.func_name = f.func_name
 
         return func
@@ -341,6 +443,36 @@ def get_nonce(request):
     return nonce
 
 
+PASSWORD_RESET_CACHE_KEY = 'a2-password-reset|%s'
+# the invalidation is not seen by other processes if the cache is not shared between them,
+# keep the answer 10 seconds at most, like the check timestamp formerly kept in the session
+PASSWORD_RESET_CACHE_TIMEOUT = 10
+
+
+def has_password_reset(user):
+    '''Return whether the user must change its password, the answer is cached until a
+       PasswordReset of the user is created or deleted, and at most
+       PASSWORD_RESET_CACHE_TIMEOUT seconds.'''
+    from django.core.cache import cache
+    from . import models
+
+    key = PASSWORD_RESET_CACHE_KEY % user.pk
+    if app_settings.A2_CACHE_ENABLED:
+        value = cache.get(key)
+        if value is not None:
+            return value
+    value = models.PasswordReset.objects.filter(user=user).exists()
+    if app_settings.A2_CACHE_ENABLED:
+        cache.set(key, value, PASSWORD_RESET_CACHE_TIMEOUT)
+    return value
+
+
+def clear_password_reset_cache(sender, instance, **kwargs):
+    from django.core.cache import cache
+
+    cache.delete(PASSWORD_RESET_CACHE_KEY % instance.user_id)
+
+
 def record_authentication_event(request, how):
     '''Record an authentication event in the session and in the database, in
        later version the database persistence can be removed'''
@@ -5,9 +5,11 @@ import requests
 import urllib
 import re
 import collections
+import hashlib
 
 
 from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import render_to_response, render
 from django.template.loader import render_to_string, select_template
 from django.views.generic.edit import UpdateView, FormView
@@ -19,13 +21,17 @@ from django.core import mail, signing
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
 from django.contrib import messages
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, get_language
+from django.utils.encoding import force_bytes, force_text
+from django.utils.html import conditional_escape
+from django.utils.http import urlquote
 from django.contrib.auth import logout as auth_logout
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.http import (HttpResponseRedirect, HttpResponseForbidden,
-    HttpResponse)
+    HttpResponse, QueryDict)
 from django.core.exceptions import PermissionDenied
 from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
+from django.middleware.csrf import get_token
 from django.views.decorators.cache import never_cache
 from django.contrib.auth.decorators import login_required
 from django.db.models.fields import FieldDoesNotExist
@@ -256,50 +262,46 @@ email_change_verify = EmailChangeVerifyView.as_view()
 logger = logging.getLogger('authentic2.idp.views')
 
 
-@csrf_exempt
-@ensure_csrf_cookie
-@never_cache
-def login(request, template_name='authentic2/login.html',
-          redirect_field_name=REDIRECT_FIELD_NAME):
-    """Displays the login form and handles the login action."""
+LOGIN_BLOCKS_CACHE_KEY = 'a2-login-blocks|%s'
+# query string parameters whose values are substituted in cached login blocks, any other
+# parameter disables the cache
+LOGIN_BLOCKS_CACHE_PARAMS = (REDIRECT_FIELD_NAME, constants.NONCE_FIELD_NAME,
+                             constants.SERVICE_FIELD_NAME)
 
-    # redirect user to homepage if already connected, if setting
-    # A2_LOGIN_REDIRECT_AUTHENTICATED_USERS_TO_HOMEPAGE is True
-    if (request.user.is_authenticated() and
-            app_settings.A2_LOGIN_REDIRECT_AUTHENTICATED_USERS_TO_HOMEPAGE):
-        return utils.redirect(request, 'auth_homepage')
 
-    redirect_to = request.GET.get(redirect_field_name)
+def get_login_blocks_placeholder(name):
+    '''Placeholder for a per-request value in cached login blocks, derived from the secret key
+       so that it cannot be injected through the query string.'''
+    return hashlib.sha1('a2-login-%s|' % name + force_bytes(settings.SECRET_KEY)).hexdigest()
 
-    if not redirect_to or ' ' in redirect_to:
-        redirect_to = settings.LOGIN_REDIRECT_URL
-    # Heavier security check -- redirects to http://example.com should
-    # not be allowed, but things like /view/?param=http://example.com
-    # should be allowed. This regex checks if there is a '//' *before* a
-    # question mark.
-    elif '//' in redirect_to and re.match(r'[^\?]*//', redirect_to):
-            redirect_to = settings.LOGIN_REDIRECT_URL
-    nonce = request.GET.get(constants.NONCE_FIELD_NAME)
-
-    frontends = utils.get_backends('AUTH_FRONTENDS')
 
-    blocks = []
+def get_csrf_token_placeholder():
+    return get_login_blocks_placeholder('csrf-token')
 
-    registration_url = utils.get_registration_url(
-        request, service_slug=request.GET.get(constants.SERVICE_FIELD_NAME))
 
-    context = {
-        'cancel': nonce is not None,
-        'can_reset_password': app_settings.A2_USER_CAN_RESET_PASSWORD is not False,
-        'registration_authorized': getattr(settings, 'REGISTRATION_OPEN', True),
-        'registration_url': registration_url,
-    }
+def get_login_blocks_cache_key(request, frontends):
+    '''Rendered login blocks depend on the enabled frontends, the language and on which of the
+       next URL, the nonce and the service are given, their values are substituted after the
+       cache lookup. Returns None if the blocks cannot be cached.'''
+    if set(request.GET) - set(LOGIN_BLOCKS_CACHE_PARAMS):
+        return None
+    if any(len(request.GET.getlist(name)) > 1 for name in request.GET):
+        return None
+    # legacy frontends put the next URL in their context
+    if not all(hasattr(frontend, 'login') for frontend in frontends):
+        return None
+    parts = [request.get_host(), get_language() or '']
+    parts.extend(name for name in LOGIN_BLOCKS_CACHE_PARAMS if name in request.GET)
+    for frontend in frontends:
+        parts.append('%s.%s:%s' % (frontend.__class__.__module__, frontend.__class__.__name__,
+                                   frontend.id))
+    return LOGIN_BLOCKS_CACHE_KEY % hashlib.sha1('\0'.join(map(force_bytes, parts))).hexdigest()
 
-    # Cancel button
-    if request.method == "POST" \
-            and constants.CANCEL_FIELD_NAME in request.POST:
-        return utils.continue_to_next_url(request, params={'cancel': 1})
 
+def render_login_blocks(request, frontends, context, nonce, redirect_to, redirect_field_name):
+    '''Render the login blocks of the frontends, returns the blocks and the response of the
+       frontend which handled the request if any'''
+    blocks = []
     # Create blocks
     for frontend in frontends:
         # Legacy API
@@ -318,7 +320,7 @@ def login(request, template_name='authentic2/login.html',
                 if form.is_valid():
                     if request.session.test_cookie_worked():
                         request.session.delete_test_cookie()
-                    return frontend.post(request, form, nonce, redirect_to)
+                    return None, frontend.post(request, form, nonce, redirect_to)
                 block['form'] = form
             else:
                 block['form'] = form_class()
@@ -331,13 +333,8 @@ def login(request, template_name='authentic2/login.html',
             # this response is returned.
             if block:
                 if block['status_code'] != 200:
-                    return block['response']
+                    return None, block['response']
                 blocks.append(block)
-        if hasattr(frontend, 'is_hidden'):
-            blocks[-1]['is_hidden'] = frontend.is_hidden(request)
-        else:
-            blocks[-1]['is_hidden'] = False
-
 
     # Old frontends API
     for block in blocks:
@@ -356,6 +353,108 @@ def login(request, template_name='authentic2/login.html',
         block['content'] = render_to_string(
                 sub_template_name, context,
                 request=request)
+    return blocks, None
+
+
+@csrf_exempt
+@ensure_csrf_cookie
+@never_cache
+def login(request, template_name='authentic2/login.html',
+          redirect_field_name=REDIRECT_FIELD_NAME):
+    """Displays the login form and handles the login action."""
+
+    # redirect user to homepage if already connected, if setting
+    # A2_LOGIN_REDIRECT_AUTHENTICATED_USERS_TO_HOMEPAGE is True
+    if (request.user.is_authenticated() and
+            app_settings.A2_LOGIN_REDIRECT_AUTHENTICATED_USERS_TO_HOMEPAGE):
+        return utils.redirect(request, 'auth_homepage')
+
+    redirect_to = request.GET.get(redirect_field_name)
+
+    if not redirect_to or ' ' in redirect_to:
+        redirect_to = settings.LOGIN_REDIRECT_URL
+    # Heavier security check -- redirects to http://example.com should
+    # not be allowed, but things like /view/?param=http://example.com
+    # should be allowed. This regex checks if there is a '//' *before* a
+    # question mark.
+    elif '//' in redirect_to and re.match(r'[^\?]*//', redirect_to):
+            redirect_to = settings.LOGIN_REDIRECT_URL
+    nonce = request.GET.get(constants.NONCE_FIELD_NAME)
+
+    frontends = utils.get_backends('AUTH_FRONTENDS')
+
+    registration_url = utils.get_registration_url(
+        request, service_slug=request.GET.get(constants.SERVICE_FIELD_NAME))
+
+    context = {
+        'cancel': nonce is not None,
+        'can_reset_password': app_settings.A2_USER_CAN_RESET_PASSWORD is not False,
+        'registration_authorized': getattr(settings, 'REGISTRATION_OPEN', True),
+        'registration_url': registration_url,
+    }
+
+    # Cancel button
+    if request.method == "POST" \
+            and constants.CANCEL_FIELD_NAME in request.POST:
+        return utils.continue_to_next_url(request, params={'cancel': 1})
+
+    blocks = None
+    cache_key = None
+    if (request.method == 'GET' and not request.user.is_authenticated()
+            and app_settings.A2_CACHE_ENABLED and app_settings.A2_LOGIN_BLOCKS_CACHE_TIMEOUT):
+        cache_key = get_login_blocks_cache_key(request, frontends)
+    if cache_key:
+        blocks = cache.get(cache_key)
+        if blocks is None:
+            # render with placeholders for the values of the request
+            query = QueryDict(mutable=True)
+            for name in request.GET:
+                query[name] = get_login_blocks_placeholder(name)
+            cached_context = dict(context, csrf_token=get_csrf_token_placeholder())
+            cached_context['registration_url'] = get_login_blocks_placeholder('registration-url')
+            real_query, request.GET = request.GET, query
+            try:
+                blocks, response = render_login_blocks(request, frontends, cached_context, nonce,
+                                                       redirect_to, redirect_field_name)
+            finally:
+                request.GET = real_query
+            if response is None:
+                blocks = [{'id': block['id'],
+                           'name': block['name'] and force_text(block['name']),
+                           'content': block['content']} for block in blocks]
+                cache.set(cache_key, blocks, app_settings.A2_LOGIN_BLOCKS_CACHE_TIMEOUT)
+            else:
+                # the response may contain the placeholders, do not use it
+                blocks = cache_key = None
+    if cache_key:
+        substitutions = {
+            get_csrf_token_placeholder(): get_token(request),
+            get_login_blocks_placeholder('registration-url'): conditional_escape(registration_url),
+        }
+        # frontends use these values in URLs
+        for name in request.GET:
+            substitutions[get_login_blocks_placeholder(name)] = urlquote(request.GET[name],
+                                                                         safe='/')
+        substituted = []
+        for block in blocks:
+            content = force_text(block['content'])
+            for placeholder, value in substitutions.iteritems():
+                content = content.replace(placeholder, force_text(value))
+            substituted.append(dict(block, content=content))
+        blocks = substituted
+    else:
+        blocks, response = render_login_blocks(request, frontends, context, nonce, redirect_to,
+                                               redirect_field_name)
+        if response is not None:
+            return response
+
+    frontends_by_id = dict((frontend.id, frontend) for frontend in frontends)
+    for block in blocks:
+        frontend = frontends_by_id.get(block['id'])
+        if hasattr(frontend, 'is_hidden'):
+            block['is_hidden'] = frontend.is_hidden(request)
+        else:
+            block['is_hidden'] = False
 
     request.session.set_test_cookie()
 
@@ -5,6 +5,8 @@ from django.core.urlresolvers import reverse
 
 from authentic2.utils import make_url
 
+default_app_config = 'authentic2_auth_oidc.apps.AppConfig'
+
 
 class Plugin(object):
     def get_before_urls(self):
@@ -14,7 +14,7 @@ class OIDCProviderAdmin(admin.ModelAdmin):
     inlines = [OIDCClaimMappingInline]
     list_filter = ['ou']
     date_hierarchy = 'modified'
-    readonly_fields = ['created', 'modified']
+    readonly_fields = ['created', 'modified', 'jwkset_refreshed']
 
 
 class OIDCAccountAdmin(admin.ModelAdmin):
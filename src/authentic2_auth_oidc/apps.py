@@ -0,0 +1,15 @@
+import django.apps
+
+
+class AppConfig(django.apps.AppConfig):
+    name = 'authentic2_auth_oidc'
+
+    def ready(self):
+        from django.db.models.signals import post_save, post_delete
+        from . import models, utils
+
+        for sender in (models.OIDCProvider, models.OIDCClaimMapping):
+            post_save.connect(utils.clear_provider_caches, sender=sender)
+            post_delete.connect(utils.clear_provider_caches, sender=sender)
+        post_save.connect(models.clear_jwkset_cache, sender=models.OIDCProvider)
+        post_delete.connect(models.clear_jwkset_cache, sender=models.OIDCProvider)
@@ -38,13 +38,11 @@ class OIDCBackend(ModelBackend):
             return None
 
         if provider.idtoken_algo == models.OIDCProvider.ALGO_RSA:
-            key = provider.jwkset
+            key = provider.get_jwk(utils.get_id_token_kid(original_id_token))
             if not key:
                 logger.warning('auth_oidc: idtoken signature algorithm is RSA but '
                                'no JWKSet is defined on provider %s', id_token.iss)
                 return None
-            if len(key['keys']) == 1:
-                key = list(key['keys'])[0]
             algs = ['RS256', 'RS384', 'RS512']
         elif provider.idtoken_algo == models.OIDCProvider.ALGO_HMAC:
             key = JWK(kty='oct', k=base64url_encode(provider.client_secret.encode('utf-8')))
@@ -0,0 +1,49 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from authentic2_auth_oidc.utils import refresh_jwkset
+from authentic2_auth_oidc.models import OIDCProvider
+
+
+class Command(BaseCommand):
+    help = 'Refresh JSON WebKey sets of OpenID Connect providers from their jwks_uri'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='names of providers to refresh, default is all')
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='keep running and refresh every INTERVAL seconds')
+        parser.add_argument(
+            '--no-verify', default=False, action='store_true',
+            help='do not verify TLS certificates')
+        parser.add_argument(
+            '--timeout', type=int, default=10,
+            help='timeout of HTTP requests in seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            self.refresh(options)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def refresh(self, options):
+        logger = logging.getLogger(__name__)
+        verbosity = int(options['verbosity'])
+        qs = OIDCProvider.objects.filter(idtoken_algo=OIDCProvider.ALGO_RSA).exclude(jwks_uri=None) \
+            .exclude(jwks_uri='')
+        if options['names']:
+            qs = qs.filter(name__in=options['names'])
+        for provider in qs:
+            try:
+                modified = refresh_jwkset(provider, verify=not options['no_verify'],
+                                          timeout=options['timeout'])
+            except ValueError as e:
+                logger.warning(u'auth_oidc: JWKSet refresh failed for %s: %s', provider.issuer, e)
+                continue
+            if modified:
+                logger.info(u'auth_oidc: JWKSet of %s was updated', provider.issuer)
+            if verbosity > 1:
+                self.stdout.write(u'%s: %s\n' % (provider.name, 'updated' if modified else 'unchanged'))
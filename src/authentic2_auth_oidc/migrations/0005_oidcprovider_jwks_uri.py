@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentic2_auth_oidc', '0004_auto_20171017_1522'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oidcprovider',
+            name='jwks_uri',
+            field=models.URLField(max_length=256, null=True, verbose_name='JSON WebKey set URI', blank=True),
+        ),
+        migrations.AddField(
+            model_name='oidcprovider',
+            name='jwkset_etag',
+            field=models.CharField(default='', verbose_name='JSON WebKey set ETag', max_length=256, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='oidcprovider',
+            name='jwkset_last_modified',
+            field=models.CharField(default='', verbose_name='JSON WebKey set Last-Modified', max_length=64, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='oidcprovider',
+            name='jwkset_refreshed',
+            field=models.DateTimeField(null=True, verbose_name='JSON WebKey set last refresh', editable=False, blank=True),
+        ),
+    ]
@@ -14,6 +14,9 @@ from django_rbac.utils import get_ou_model_name
 
 from . import managers
 
+# cache of parsed JWKSet by provider pk, see OIDCProvider.get_parsed_jwkset()
+_jwkset_cache = {}
+
 
 def validate_jwkset(data):
     data = json.dumps(data)
@@ -88,6 +91,28 @@ class OIDCProvider(models.Model):
         null=True,
         blank=True,
         validators=[validate_jwkset])
+    jwks_uri = models.URLField(
+        max_length=256,
+        blank=True,
+        null=True,
+        verbose_name=_('JSON WebKey set URI'))
+    jwkset_etag = models.CharField(
+        max_length=256,
+        blank=True,
+        default='',
+        editable=False,
+        verbose_name=_('JSON WebKey set ETag'))
+    jwkset_last_modified = models.CharField(
+        max_length=64,
+        blank=True,
+        default='',
+        editable=False,
+        verbose_name=_('JSON WebKey set Last-Modified'))
+    jwkset_refreshed = models.DateTimeField(
+        blank=True,
+        null=True,
+        editable=False,
+        verbose_name=_('JSON WebKey set last refresh'))
     idtoken_algo = models.PositiveIntegerField(
         default=ALGO_RSA,
         choices=ALGO_CHOICES,
@@ -124,17 +149,41 @@ class OIDCProvider(models.Model):
 
     objects = managers.OIDCProviderManager()
 
+    def get_parsed_jwkset(self):
+        '''Return the parsed JWKSet and an index of its keys by kid, parsing is
+           cached by process until the provider is modified.'''
+        cached = _jwkset_cache.get(self.pk)
+        if cached is None or cached[0] != self.modified:
+            jwkset = JWKSet.from_json(json.dumps(self.jwkset_json))
+            kid_index = {}
+            for key in jwkset['keys']:
+                if key.key_id:
+                    kid_index[key.key_id] = key
+            cached = _jwkset_cache[self.pk] = (self.modified, jwkset, kid_index)
+        return cached[1], cached[2]
+
     @property
     def jwkset(self):
         from authentic2.crypto import base64url_encode
 
         if self.idtoken_algo == self.ALGO_RSA:
             if self.jwkset_json:
-                return JWKSet.from_json(json.dumps(self.jwkset_json))
+                return self.get_parsed_jwkset()[0]
         if self.idtoken_algo == self.ALGO_HMAC:
             return JWK(kty='oct', k=base64url_encode(self.client_secret.encode('utf-8')))
         return None
 
+    def get_jwk(self, kid=None):
+        '''Select the RSA key to verify a signature, using kid if given'''
+        if self.idtoken_algo != self.ALGO_RSA or not self.jwkset_json:
+            return None
+        jwkset, kid_index = self.get_parsed_jwkset()
+        if kid in kid_index:
+            return kid_index[kid]
+        if len(jwkset['keys']) == 1:
+            return list(jwkset['keys'])[0]
+        return jwkset
+
     def __unicode__(self):
         return self.name
 
@@ -228,3 +277,7 @@ class OIDCAccount(models.Model):
 
     def __repr__(self):
         return '<OIDCAccount %r on %r>' % (self.sub, self.provider and self.provider.issuer)
+
+
+def clear_jwkset_cache(sender, instance, **kwargs):
+    _jwkset_cache.pop(instance.pk, None)
@@ -5,7 +5,8 @@ import json
 
 import requests
 
-from django.utils.timezone import utc
+from django.utils.timezone import utc, now
+from django.core.exceptions import ValidationError
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext as _
 
@@ -49,6 +50,11 @@ def get_provider_by_issuer(issuer):
     return models.OIDCProvider.objects.prefetch_related('claim_mappings').get(issuer=issuer)
 
 
+def clear_provider_caches(sender, instance, **kwargs):
+    for cached in (get_providers, get_provider, has_providers, get_provider_by_issuer):
+        cached.cache.clear()
+
+
 def base64url_decode(input):
     rem = len(input) % 4
     if rem > 0:
@@ -94,6 +100,17 @@ def parse_id_token(id_token):
     return payload
 
 
+def get_id_token_kid(id_token):
+    '''Return the kid from the JOSE header of an id_token, or None'''
+    try:
+        headers = json.loads(base64url_decode(str(id_token).split('.')[0]))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if not isinstance(headers, dict):
+        return None
+    return headers.get('kid')
+
+
 REQUIRED_ID_TOKEN_KEYS = set(['iss', 'sub', 'aud', 'exp', 'iat'])
 KEY_TYPES = {
     'iss': unicode,
@@ -266,15 +283,61 @@ def register_issuer(name, issuer=None, openid_configuration=None, verify=True, t
         token_endpoint=openid_configuration['token_endpoint'],
         userinfo_endpoint=openid_configuration['userinfo_endpoint'],
         jwkset_json=jwkset_json,
+        jwks_uri=openid_configuration['jwks_uri'],
+        jwkset_etag=response.headers.get('ETag', ''),
+        jwkset_last_modified=response.headers.get('Last-Modified', ''),
+        jwkset_refreshed=now(),
         idtoken_algo=idtoken_algo,
         strategy=models.OIDCProvider.STRATEGY_CREATE)
     if old_pk:
-        models.OIDCProvider.objects.filter(pk=old_pk).update(**kwargs)
+        models.OIDCProvider.objects.filter(pk=old_pk).update(modified=now(), **kwargs)
         return models.OIDCProvider.objects.get(pk=old_pk)
     else:
         return models.OIDCProvider.objects.create(**kwargs)
 
 
+def refresh_jwkset(provider, verify=True, timeout=10):
+    '''Fetch the JWKSet of provider from its jwks_uri using a conditional
+       request, return True if keys were modified.'''
+    headers = {}
+    if provider.jwkset_etag:
+        headers['If-None-Match'] = provider.jwkset_etag
+    if provider.jwkset_last_modified:
+        headers['If-Modified-Since'] = provider.jwkset_last_modified
+    try:
+        response = requests.get(provider.jwks_uri, headers=headers, verify=verify,
+                                timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        raise ValueError(_('Unable to reach the OpenID Connect JWKSet for %(issuer)s: '
+                           '%(url)s %(error)s') % {
+                               'issuer': provider.issuer,
+                               'url': provider.jwks_uri,
+                               'error': e,
+        })
+    provider.jwkset_refreshed = now()
+    update_fields = ['jwkset_refreshed']
+    modified = False
+    if response.status_code != 304:
+        try:
+            jwkset_json = response.json()
+        except ValueError as e:
+            raise ValueError(_('Invalid JSKSet document: %s') % e)
+        try:
+            models.validate_jwkset(jwkset_json)
+        except ValidationError as e:
+            raise ValueError(_('Invalid JSKSet document: %s') % e)
+        if jwkset_json != provider.jwkset_json:
+            provider.jwkset_json = jwkset_json
+            update_fields.extend(['jwkset_json', 'modified'])
+            modified = True
+        provider.jwkset_etag = response.headers.get('ETag', '')
+        provider.jwkset_last_modified = response.headers.get('Last-Modified', '')
+        update_fields.extend(['jwkset_etag', 'jwkset_last_modified'])
+    provider.save(update_fields=update_fields)
+    return modified
+
+
 def get_openid_configuration_url(issuer):
     parsed = urlparse.urlparse(issuer)
     if parsed.query or parsed.fragment or parsed.scheme != 'https':
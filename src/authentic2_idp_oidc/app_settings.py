@@ -34,6 +34,14 @@ class AppSettings(object):
     def IDTOKEN_DURATION(self):
         return self._setting('IDTOKEN_DURATION', 30)
 
+    @property
+    def ACCESS_TOKEN_DURATION(self):
+        return self._setting('ACCESS_TOKEN_DURATION', 3600 * 8)
+
+    @property
+    def USER_INFO_CACHE_TIMEOUT(self):
+        return self._setting('USER_INFO_CACHE_TIMEOUT', 0)
+
 
 import sys
 
@@ -23,6 +23,16 @@ from rest_framework.exceptions import APIException
 class AppConfig(django.apps.AppConfig):
         name = 'authentic2_idp_oidc'
 
+        def ready(self):
+            from django.db.models.signals import post_save, post_delete
+            from django.contrib.auth.signals import user_logged_out
+            from . import utils
+            from .models import OIDCClaim
+
+            post_save.connect(utils.clear_claims_plan_cache, sender=OIDCClaim)
+            post_delete.connect(utils.clear_claims_plan_cache, sender=OIDCClaim)
+            user_logged_out.connect(utils.revoke_signed_access_tokens)
+
         # implement translation of encrypted pairwise identifiers when and OIDC Client is using the
         # A2 API
         def a2_hook_api_modify_serializer(self, view, serializer):
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentic2_idp_oidc', '0011_auto_20180808_1546'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oidcclient',
+            name='access_token_format',
+            field=models.PositiveIntegerField(
+                default=1,
+                choices=[(1, 'opaque identifier'), (2, 'signed stateless token')],
+                verbose_name='access token format'),
+        ),
+    ]
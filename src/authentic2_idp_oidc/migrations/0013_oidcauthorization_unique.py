@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def merge_authorizations(apps, schema_editor):
+    '''Merge authorizations of the same client and user in one row'''
+    OIDCAuthorization = apps.get_model('authentic2_idp_oidc', 'OIDCAuthorization')
+    seen = {}
+    to_delete = []
+    for authorization in OIDCAuthorization.objects.order_by('-expired'):
+        key = (authorization.client_ct_id, authorization.client_id, authorization.user_id)
+        if key not in seen:
+            seen[key] = authorization
+            continue
+        kept = seen[key]
+        scopes = set(kept.scopes.split()) | set(authorization.scopes.split())
+        kept.scopes = ' '.join(sorted(scopes))
+        to_delete.append(authorization.pk)
+    for authorization in seen.values():
+        authorization.scopes = ' '.join(sorted(authorization.scopes.split()))
+        authorization.save()
+    OIDCAuthorization.objects.filter(pk__in=to_delete).delete()
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentic2_idp_oidc', '0012_oidcclient_access_token_format'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_authorizations, noop),
+        migrations.AlterUniqueTogether(
+            name='oidcauthorization',
+            unique_together=set([('client_ct', 'client_id', 'user')]),
+        ),
+    ]
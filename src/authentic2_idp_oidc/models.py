@@ -64,6 +64,13 @@ class OIDCClient(Service):
         (FLOW_IMPLICIT, _('implicit/native')),
     ]
 
+    ACCESS_TOKEN_FORMAT_UUID = 1
+    ACCESS_TOKEN_FORMAT_SIGNED = 2
+    ACCESS_TOKEN_FORMATS = [
+        (ACCESS_TOKEN_FORMAT_UUID, _('opaque identifier')),
+        (ACCESS_TOKEN_FORMAT_SIGNED, _('signed stateless token')),
+    ]
+
     AUTHORIZATION_MODE_BY_SERVICE = 1
     AUTHORIZATION_MODE_BY_OU = 2
     AUTHORIZATION_MODE_NONE = 3
@@ -114,6 +121,10 @@ class OIDCClient(Service):
         default=ALGO_RSA,
         choices=ALGO_CHOICES,
         verbose_name=_('IDToken signature algorithm'))
+    access_token_format = models.PositiveIntegerField(
+        default=ACCESS_TOKEN_FORMAT_UUID,
+        choices=ACCESS_TOKEN_FORMATS,
+        verbose_name=_('access token format'))
     has_api_access = models.BooleanField(
         verbose_name=_('has API access'),
         default=False)
@@ -172,6 +183,11 @@ class OIDCAuthorization(models.Model):
 
     objects = managers.OIDCExpiredManager()
 
+    class Meta:
+        unique_together = [
+            ('client_ct', 'client_id', 'user'),
+        ]
+
     def scope_set(self):
         return utils.scope_set(self.scopes)
 
@@ -3,6 +3,8 @@ import hashlib
 import urlparse
 import base64
 import uuid
+import time
+from importlib import import_module
 
 from jwcrypto.jwk import JWK, JWKSet, InvalidJWKValue
 from jwcrypto.jwt import JWT
@@ -10,12 +12,20 @@ from jwcrypto.jwt import JWT
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 from django.utils.encoding import smart_bytes
+from django.core.cache import cache
+from django.core import signing
+from django.contrib.auth import get_user_model
 
 from authentic2 import hooks, crypto
+from authentic2.utils import timestamp_from_datetime
+from authentic2.decorators import GlobalCache
 from authentic2.attributes_ng.engine import get_attributes
 
 from . import app_settings
 
+# claims plans are invalidated on save, the timeout bounds staleness in other processes
+CLAIMS_PLAN_TIMEOUT = 60
+
 
 def base64url(content):
     return base64.urlsafe_b64encode(content).strip('=')
@@ -161,27 +171,60 @@ def normalize_claim_values(values):
     return values_list
 
 
+@GlobalCache(timeout=CLAIMS_PLAN_TIMEOUT, hostname_vary=False)
+def get_claims_plan(client_id):
+    '''Return the list of (name, value, scopes) claims of a client'''
+    from .models import OIDCClaim
+
+    plan = []
+    for claim in OIDCClaim.objects.filter(client_id=client_id, name__isnull=False):
+        plan.append((claim.name, claim.value, frozenset(claim.get_scopes())))
+    return plan
+
+
+def clear_claims_plan_cache(sender, instance, **kwargs):
+    get_claims_plan.cache.clear()
+
+
 def create_user_info(client, user, scope_set, id_token=False):
     '''Create user info dictionnary'''
     user_info = {
         'sub': make_sub(client, user)
     }
+    claims = [(name, value) for name, value, scopes in get_claims_plan(client.pk)
+              if scopes & scope_set]
     attributes = get_attributes({
         'user': user, 'request': None, 'service': client,
-        '__wanted_attributes': client.get_wanted_attributes()})
-    for claim in client.oidcclaim_set.filter(name__isnull=False):
-        if not set(claim.get_scopes()).intersection(scope_set):
+        '__wanted_attributes': [value for name, value in claims]})
+    for name, value in claims:
+        if not value in attributes:
             continue
-        if not claim.value in attributes:
-            continue
-        user_info[claim.name] = normalize_claim_values(attributes[claim.value])
+        user_info[name] = normalize_claim_values(attributes[value])
         # check if attribute is verified
-        if claim.value + ':verified' in attributes:
-            user_info[claim.value + '_verified'] = True
+        if value + ':verified' in attributes:
+            user_info[value + '_verified'] = True
     hooks.call_hooks('idp_oidc_modify_user_info', client, user, scope_set, user_info)
     return user_info
 
 
+def get_user_info_cache_key(client, user, scope_set):
+    return 'a2-idp-oidc-user-info|%s|%s|%s' % (client.pk, user.pk, ' '.join(sorted(scope_set)))
+
+
+def get_user_info(client, user, scope_set):
+    '''Create user info dictionnary for the userinfo endpoint, it can be cached
+       for a short time if A2_IDP_OIDC_USER_INFO_CACHE_TIMEOUT is set.'''
+    timeout = app_settings.USER_INFO_CACHE_TIMEOUT
+    if not timeout:
+        return create_user_info(client, user, scope_set)
+    key = get_user_info_cache_key(client, user, scope_set)
+    user_info = cache.get(key)
+    if user_info is None:
+        user_info = create_user_info(client, user, scope_set)
+        cache.set(key, user_info, timeout)
+    return user_info
+
+
 def get_issuer(request):
     return request.build_absolute_uri('/')
 
@@ -200,9 +243,9 @@ def get_oidc_sessions(request):
 
 
 def add_oidc_session(request, client):
-    oidc_sessions = request.session.setdefault('oidc_sessions', {})
     if not client.frontchannel_logout_uri:
         return
+    oidc_sessions = request.session.setdefault('oidc_sessions', {})
     uri = client.frontchannel_logout_uri
     oidc_session = {
         'frontchannel_logout_uri': uri,
@@ -217,3 +260,126 @@ def add_oidc_session(request, client):
     oidc_sessions[uri] = oidc_session
     # force session save
     request.session.modified = True
+
+
+ACCESS_TOKEN_SALT = 'authentic2_idp_oidc.access_token'
+REVOKED_SESSION_CACHE_KEY = 'a2-idp-oidc-revoked-session|%s'
+# the session was alive when the token was issued, it is checked once the token is older
+SIGNED_ACCESS_TOKEN_SESSION_CHECK_DELAY = 60
+
+
+def get_session_hash(session_key):
+    return hashlib.sha256(smart_bytes(session_key) + smart_bytes(settings.SECRET_KEY)).hexdigest()[:32]
+
+
+class SignedAccessToken(object):
+    '''Stateless access token, validity is checked using its signature, its
+       expiration time, the revocation list of sessions and, once the token is
+       older than SIGNED_ACCESS_TOKEN_SESSION_CHECK_DELAY seconds, the
+       existence of the session it was issued for.
+
+       The revocation list is kept in the default cache, if it is not shared
+       by all the processes a logout is seen by other processes only through
+       the session check.
+    '''
+
+    def __init__(self, client_id, user_id, scopes, expired, session_hash, issued=None,
+                 crypted_session_key=None):
+        self.client_id = client_id
+        self.user_id = user_id
+        self.scopes = scopes
+        self.expired = expired
+        self.session_hash = session_hash
+        self.issued = issued
+        self.crypted_session_key = crypted_session_key
+
+    @property
+    def client(self):
+        from .models import OIDCClient
+
+        if not hasattr(self, '_client'):
+            self._client = OIDCClient.objects.filter(pk=self.client_id).first()
+        return self._client
+
+    @property
+    def user(self):
+        if not hasattr(self, '_user'):
+            self._user = get_user_model().objects.filter(pk=self.user_id).first()
+        return self._user
+
+    def scope_set(self):
+        return scope_set(self.scopes)
+
+    def session_exists(self):
+        session_key = crypto.aes_base64_authenticated_decrypt(
+            settings.SECRET_KEY, self.crypted_session_key, raise_on_error=False)
+        if not session_key:
+            return False
+        engine = import_module(settings.SESSION_ENGINE)
+        return engine.SessionStore().exists(session_key)
+
+    def is_valid(self):
+        now = time.time()
+        if self.expired < now:
+            return False
+        if cache.get(REVOKED_SESSION_CACHE_KEY % self.session_hash):
+            return False
+        if now - self.issued > SIGNED_ACCESS_TOKEN_SESSION_CHECK_DELAY:
+            return self.session_exists()
+        return True
+
+    def __repr__(self):
+        return '<SignedAccessToken client:%s user:%s expired:%s scopes:%s>' % (
+            self.client_id, self.user_id, self.expired, self.scopes)
+
+
+def create_access_token(client, user, scopes, session_key, expired):
+    '''Create an access token following the format configured on the client,
+       return its serialization.'''
+    from .models import OIDCAccessToken
+
+    if client.access_token_format == client.ACCESS_TOKEN_FORMAT_SIGNED:
+        return signing.dumps({
+            'c': client.pk,
+            'u': user.pk,
+            's': scopes,
+            'e': timestamp_from_datetime(expired),
+            'h': get_session_hash(session_key),
+            'i': int(time.time()),
+            # the token is only signed, do not disclose the session key
+            'k': crypto.aes_base64_authenticated_encrypt(settings.SECRET_KEY,
+                                                     smart_bytes(session_key)),
+        }, salt=ACCESS_TOKEN_SALT, compress=True)
+    access_token = OIDCAccessToken.objects.create(
+        client=client,
+        user=user,
+        scopes=scopes,
+        session_key=session_key,
+        expired=expired)
+    return unicode(access_token.uuid)
+
+
+def parse_signed_access_token(token):
+    '''Return a SignedAccessToken if signature is valid, None otherwise'''
+    try:
+        payload = signing.loads(token, salt=ACCESS_TOKEN_SALT)
+        return SignedAccessToken(
+            client_id=payload['c'],
+            user_id=payload['u'],
+            scopes=payload['s'],
+            expired=payload['e'],
+            session_hash=payload['h'],
+            issued=payload['i'],
+            crypted_session_key=payload['k'])
+    except (signing.BadSignature, KeyError, TypeError):
+        return None
+
+
+def revoke_signed_access_tokens(sender, request=None, **kwargs):
+    '''Revoke signed access tokens bound to the session being logged out, the
+       revocation is seen by other processes only if the cache is shared.'''
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    if not session_key:
+        return
+    cache.set(REVOKED_SESSION_CACHE_KEY % get_session_hash(session_key), True,
+              app_settings.ACCESS_TOKEN_DURATION)
@@ -203,18 +203,15 @@ def authorize(request, *args, **kwargs):
         elif client.authorization_mode == client.AUTHORIZATION_MODE_BY_OU:
             auth_manager = client.ou.oidc_authorizations
 
-        qs = auth_manager.filter(user=request.user)
-
         if 'consent' in prompt:
             # if consent is asked we delete existing authorizations
             # it seems to be the safer option
-            qs.delete()
-            qs = auth_manager.none()
+            auth_manager.filter(user=request.user).delete()
+            authorized_scopes = set()
         else:
-            qs = qs.filter(expired__gte=start)
-        authorized_scopes = set()
-        for authorization in qs:
-            authorized_scopes |= authorization.scope_set()
+            authorized_scopes = auth_manager.filter(
+                user=request.user, expired__gte=start).values_list('scopes', flat=True).first()
+            authorized_scopes = utils.scope_set(authorized_scopes or '')
         if (authorized_scopes & scopes) < scopes:
             if 'none' in prompt:
                 return authorization_error(
@@ -224,16 +221,13 @@ def authorize(request, *args, **kwargs):
                     fragment=fragment)
             if request.method == 'POST':
                 if 'accept' in request.POST:
-                    pk_to_deletes = []
-                    for authorization in qs:
-                        # clean obsolete authorizations
-                        if authorization.scope_set() <= scopes:
-                            pk_to_deletes.append(authorization.pk)
-                    auth_manager.create(
-                        user=request.user, scopes=u' '.join(sorted(scopes)),
-                        expired=start + datetime.timedelta(days=365))
-                    if pk_to_deletes:
-                        auth_manager.filter(pk__in=pk_to_deletes).delete()
+                    # keep previously authorized scopes, one authorization is kept by user
+                    auth_manager.update_or_create(
+                        user=request.user,
+                        defaults={
+                            'scopes': utils.clean_words(u' '.join(authorized_scopes | scopes)),
+                            'expired': start + datetime.timedelta(days=365),
+                        })
                     logger.info(u'authorized scopes %s for service %s', ' '.join(scopes),
                                 client.name)
                 else:
@@ -268,9 +262,9 @@ def authorize(request, *args, **kwargs):
     else:
         # FIXME: we should probably factorize this part with the token endpoint similar code
         need_access_token = 'token' in response_type.split()
-        expires_in = 3600 * 8
+        expires_in = app_settings.ACCESS_TOKEN_DURATION
         if need_access_token:
-            access_token = models.OIDCAccessToken.objects.create(
+            access_token = utils.create_access_token(
                 client=client,
                 user=request.user,
                 scopes=u' '.join(scopes),
@@ -298,7 +292,7 @@ def authorize(request, *args, **kwargs):
             params['state'] = state
         if need_access_token:
             params.update({
-                'access_token': access_token.uuid,
+                'access_token': access_token,
                 'token_type': 'Bearer',
                 'expires_in': expires_in,
             })
@@ -373,8 +367,8 @@ def token(request, *args, **kwargs):
     redirect_uri = request.POST.get('redirect_uri')
     if oidc_code.redirect_uri != redirect_uri:
         return invalid_request('invalid redirect_uri')
-    expires_in = 3600 * 8
-    access_token = models.OIDCAccessToken.objects.create(
+    expires_in = app_settings.ACCESS_TOKEN_DURATION
+    access_token = utils.create_access_token(
         client=client,
         user=oidc_code.user,
         scopes=oidc_code.scopes,
@@ -399,7 +393,7 @@ def token(request, *args, **kwargs):
     if oidc_code.nonce is not None:
         id_token['nonce'] = oidc_code.nonce
     response = HttpResponse(json.dumps({
-        'access_token': unicode(access_token.uuid),
+        'access_token': access_token,
         'token_type': 'Bearer',
         'expires_in': expires_in,
         'id_token': utils.make_idtoken(client, id_token),
@@ -415,10 +409,20 @@ def authenticate_access_token(request):
     authorization = request.META['HTTP_AUTHORIZATION'].split()
     if authorization[0] != 'Bearer' or len(authorization) != 2:
         return None
-    try:
-        access_token = models.OIDCAccessToken.objects.select_related().get(uuid=authorization[1])
-    except models.OIDCAccessToken.DoesNotExist:
-        return None
+    if ':' in authorization[1]:
+        # signed stateless access token, no need to hit the database
+        access_token = utils.parse_signed_access_token(authorization[1])
+        if access_token is None:
+            return None
+        # the client or the user can have been deleted since the token was emitted
+        if access_token.client is None or access_token.user is None:
+            return None
+    else:
+        try:
+            access_token = models.OIDCAccessToken.objects.select_related().get(
+                uuid=authorization[1])
+        except models.OIDCAccessToken.DoesNotExist:
+            return None
     if not access_token.is_valid():
         return None
     return access_token
@@ -430,8 +434,8 @@ def user_info(request, *args, **kwargs):
     access_token = authenticate_access_token(request)
     if access_token is None:
         return HttpResponse('unauthenticated', status=401)
-    user_info = utils.create_user_info(access_token.client, access_token.user,
-                                       access_token.scope_set())
+    user_info = utils.get_user_info(access_token.client, access_token.user,
+                                    access_token.scope_set())
     return HttpResponse(json.dumps(user_info), content_type='application/json')
 
 
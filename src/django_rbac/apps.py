@@ -8,7 +8,7 @@ class DjangoRBACConfig(AppConfig):
     def ready(self):
         from . import signal_handlers, utils
         from django.db.models.signals import post_save, post_delete, \
-            post_migrate
+            post_migrate, m2m_changed
 
         # update role parenting when new role parenting is created
         post_save.connect(
@@ -18,6 +18,19 @@ class DjangoRBACConfig(AppConfig):
         post_delete.connect(
             signal_handlers.role_parenting_post_delete,
             sender=utils.get_role_parenting_model())
+        # start a new generation of cached RBAC values when roles relations change
+        post_save.connect(
+            utils.new_rbac_generation,
+            sender=utils.get_role_parenting_model())
+        post_delete.connect(
+            utils.new_rbac_generation,
+            sender=utils.get_role_parenting_model())
+        post_delete.connect(
+            utils.new_rbac_generation,
+            sender=utils.get_role_model())
+        m2m_changed.connect(
+            utils.new_rbac_generation,
+            sender=utils.get_role_model().members.through)
         # create CRUD operations and admin
         post_migrate.connect(
             signal_handlers.create_base_operations,
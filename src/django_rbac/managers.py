@@ -103,6 +103,10 @@ class IntCast(models.Func):
 
 class RoleQuerySet(query.QuerySet):
     def for_user(self, user):
+        if not self.query.has_filters():
+            role_ids = utils.get_user_role_ids(user)
+            if role_ids is not None:
+                return self.filter(pk__in=role_ids)
         return self.filter(members=user).parents().distinct()
 
     def parents(self, include_self=True, annotate=False):
@@ -210,12 +214,19 @@ class RoleParentingManager(models.Manager):
         if obsolete:
             queries = (query.Q(parent_id=a, child_id=b, direct=False) for a, b in obsolete)
             self.model.objects.filter(reduce(query.Q.__or__, queries)).delete()
+        # bulk_create() does not send signals
+        if add - old or obsolete:
+            utils.new_rbac_generation()
 
 
 @contextlib.contextmanager
 def defer_update_transitive_closure():
     from . import utils
 
+    if not RoleParentingManager.tls.DO_UPDATE_CLOSURE:
+        # already deferred by an enclosing block, it will do the update
+        yield
+        return
     RoleParentingManager.tls.DO_UPDATE_CLOSURE = False
     try:
         yield
@@ -224,6 +235,8 @@ def defer_update_transitive_closure():
     else:
         if RoleParentingManager.tls.CLOSURE_UPDATED:
             utils.get_role_parenting_model().objects.update_transitive_closure()
+            # values computed while the closure was not updated must not be used anymore
+            utils.new_rbac_generation()
     finally:
         RoleParentingManager.tls.DO_UPDATE_CLOSURE = True
         RoleParentingManager.tls.CLOSURE_UPDATED = False
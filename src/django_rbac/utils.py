@@ -2,6 +2,8 @@ from authentic2.utils import get_hex_uuid
 from authentic2.decorators import GlobalCache
 from django.conf import settings
 from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
 
 from . import constants
 
@@ -67,3 +69,62 @@ def get_operation(operation_tpl):
         slug=unicode(operation_tpl.slug),
         defaults={'name': unicode(operation_tpl.name)})
     return operation
+
+
+RBAC_GENERATION_CACHE_KEY = 'django-rbac-generation'
+
+
+def get_rbac_generation():
+    '''Return the current generation of the RBAC relations, a new generation is started each
+       time role memberships, role parentings or service authorizations change. It can be used
+       to build cache keys for values computed from those relations.'''
+    generation = cache.get(RBAC_GENERATION_CACHE_KEY)
+    if generation is None:
+        generation = set_rbac_generation()
+    return generation
+
+
+def set_rbac_generation():
+    generation = get_hex_uuid()
+    cache.set(RBAC_GENERATION_CACHE_KEY, generation, None)
+    return generation
+
+
+def new_rbac_generation(*args, **kwargs):
+    '''Start a new generation of the RBAC relations, can be used as a signal handler.
+
+       Inside a transaction another generation is started after the commit, values computed
+       by concurrent requests from the rows of the previous commit are then never used again.
+    '''
+    if kwargs.get('action') in ('pre_add', 'pre_remove', 'pre_clear'):
+        return
+    generation = set_rbac_generation()
+    using = kwargs.get('using')
+    # transaction.on_commit() appeared in Django 1.9
+    if hasattr(transaction, 'on_commit') and transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(set_rbac_generation, using=using)
+    return generation
+
+
+USER_ROLE_IDS_CACHE_KEY = 'django-rbac-user-role-ids|%s|%s'
+# the generation is not seen by other processes if the cache is not shared between them, keep
+# role ids for a short time only
+USER_ROLE_IDS_TIMEOUT = 10
+
+
+def get_user_role_ids(user):
+    '''Return the ids of the roles of user, direct or inherited, they are cached until the
+       next RBAC generation and at most USER_ROLE_IDS_TIMEOUT seconds. Return None if the cache
+       is disabled.'''
+    from authentic2 import app_settings
+
+    if not app_settings.A2_CACHE_ENABLED or getattr(user, 'pk', None) is None:
+        return None
+    key = USER_ROLE_IDS_CACHE_KEY % (user.pk, get_rbac_generation())
+    role_ids = cache.get(key)
+    if role_ids is None:
+        Role = get_role_model()
+        role_ids = frozenset(Role.objects.filter(members=user).parents()
+                             .values_list('pk', flat=True))
+        cache.set(key, role_ids, USER_ROLE_IDS_TIMEOUT)
+    return role_ids
@@ -21,6 +21,24 @@ import utils
 Role = get_role_model()
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', default=False,
+                     help='run tests marked as benchmark')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: timing measures, run with --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='benchmark, run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
 @pytest.fixture
 def app(request):
     wtm = django_webtest.WebTestMixin()
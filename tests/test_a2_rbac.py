@@ -180,3 +180,149 @@ def test_ou_export_json(db):
     assert ou_dict['email_is_unique'] == ou.email_is_unique
     assert ou_dict['default'] == ou.default
     assert ou_dict['validate_emails'] == ou.validate_emails
+
+
+def test_service_authorize_cache(db, settings, django_assert_num_queries):
+    from django.contrib.auth import get_user_model
+    from authentic2.utils import ServiceAccessDenied
+
+    settings.A2_CACHE_ENABLED = True
+    user = get_user_model().objects.create(username='john.doe')
+    service = Service.objects.create(name='s1', slug='s1')
+    parent = Role.objects.create(name='parent', slug='parent')
+    child = Role.objects.create(name='child', slug='child')
+
+    def authorized():
+        try:
+            return service.authorize(user)
+        except ServiceAccessDenied:
+            return False
+
+    assert authorized()
+    service.add_authorized_role(parent)
+    assert not authorized()
+    child.members.add(user)
+    assert not authorized()
+    parent.add_child(child)
+    assert authorized()
+    # decisions are cached until roles relations change
+    with django_assert_num_queries(0):
+        assert authorized()
+    user.roles.remove(child)
+    assert not authorized()
+    user.roles.add(child)
+    assert authorized()
+    parent.remove_child(child)
+    assert not authorized()
+    parent.add_child(child)
+    assert authorized()
+    child.delete()
+    assert not authorized()
+    service.remove_authorized_role(parent)
+    assert authorized()
+
+
+def test_role_for_user_cache(db, settings, django_assert_num_queries):
+    from django.contrib.auth import get_user_model
+
+    user = get_user_model().objects.create(username='john.doe')
+    roles = [Role.objects.create(name='role%s' % i, slug='role%s' % i) for i in range(20)]
+    for parent, child in zip(roles[1:], roles[:-1]):
+        parent.add_child(child)
+    other = Role.objects.create(name='other', slug='other')
+    roles[0].members.add(user)
+
+    def role_slugs():
+        return set(Role.objects.for_user(user).values_list('slug', flat=True))
+
+    settings.A2_CACHE_ENABLED = False
+    expected = set(role.slug for role in roles)
+    assert role_slugs() == expected
+
+    settings.A2_CACHE_ENABLED = True
+    assert role_slugs() == expected
+    # a single query by primary keys once effective roles are cached
+    with django_assert_num_queries(1):
+        assert role_slugs() == expected
+    other.members.add(user)
+    assert role_slugs() == expected | set(['other'])
+    roles[10].remove_child(roles[9])
+    assert role_slugs() == set(role.slug for role in roles[:10]) | set(['other'])
+
+
+@pytest.mark.benchmark
+def test_role_for_user_cache_benchmark(db, settings):
+    import time
+    from django.contrib.auth import get_user_model
+
+    user = get_user_model().objects.create(username='john.doe')
+    roles = [Role.objects.create(name='role%s' % i, slug='role%s' % i) for i in range(20)]
+    for parent, child in zip(roles[1:], roles[:-1]):
+        parent.add_child(child)
+    roles[0].members.add(user)
+
+    count = 100
+    for enabled in (False, True):
+        settings.A2_CACHE_ENABLED = enabled
+        t = time.time()
+        for i in range(count):
+            list(Role.objects.for_user(user))
+        print 'Effective roles cache', 'enabled' if enabled else 'disabled', \
+            'time per lookup:', (time.time() - t) / count
+
+
+def test_update_ous_admin_roles(db, settings):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django_rbac.models import ADMIN_OP, VIEW_OP, SEARCH_OP
+    from authentic2.a2_rbac.management import update_ous_admin_roles
+
+    def check(ou):
+        ou_admin_role = Role.objects.get(slug='_a2-managers-of-%s' % ou.slug)
+        assert ou_admin_role.ou is None
+        assert ou_admin_role.permissions.get().operation.slug == VIEW_OP.slug
+        # organizational units are not scoped, they have no scoped admin role
+        for slug in ('_a2-manager-of-roles', '_a2-manager-of-users'):
+            ct_admin_role = Role.objects.get(slug='%s-%s' % (slug, ou.slug), ou=ou)
+            assert set(ct_admin_role.children(include_self=False)) == set([ou_admin_role])
+            assert ct_admin_role.permissions.filter(operation__slug=ADMIN_OP.slug).count() == 1
+            assert ct_admin_role.permissions.filter(operation__slug=SEARCH_OP.slug).count() == 1
+        roles_admin_role = Role.objects.get(slug='_a2-manager-of-roles-%s' % ou.slug)
+        assert roles_admin_role.permissions.filter(operation__slug=VIEW_OP.slug, ou=ou).count() == 1
+
+    ous = [OU.objects.create(name='ou%s' % i, slug='ou%s' % i) for i in range(5)]
+    for ou in ous:
+        check(ou)
+    admin_role_count = Role.objects.filter(admin_scope_ct__isnull=False).count()
+
+    def count_queries():
+        with CaptureQueriesContext(connection) as ctx:
+            update_ous_admin_roles()
+        return len(ctx.captured_queries)
+
+    # nothing to change, the number of queries does not depend on the number of ous
+    queries = count_queries()
+    ous += [OU.objects.create(name='ou%s' % i, slug='ou%s' % i) for i in range(5, 10)]
+    assert count_queries() == queries
+    for ou in ous:
+        check(ou)
+    assert Role.objects.filter(admin_scope_ct__isnull=False).count() == admin_role_count + 5 * 3
+
+    # renaming an ou renames its admin roles
+    ous[0].name = 'renamed'
+    ous[0].save()
+    assert Role.objects.filter(name='Users - renamed', ou=ous[0]).count() == 1
+
+    # unmanaged content types admin roles do not inherit ou admin roles anymore
+    settings.A2_RBAC_MANAGED_CONTENT_TYPES = [('custom_user', 'user')]
+    update_ous_admin_roles()
+    users_admin_role = Role.objects.get(slug='_a2-manager-of-users-ou1')
+    roles_admin_role = Role.objects.get(slug='_a2-manager-of-roles-ou1')
+    assert users_admin_role.children(include_self=False).count() == 1
+    assert roles_admin_role.children(include_self=False).count() == 0
+
+    # no managed content type, content type admin roles are deleted, ou admin roles are kept
+    settings.A2_RBAC_MANAGED_CONTENT_TYPES = ()
+    update_ous_admin_roles()
+    assert Role.objects.filter(slug__startswith='_a2-managers-of-ou').count() == len(ous)
+    assert not Role.objects.filter(slug='_a2-manager-of-users-ou1').exists()
@@ -615,6 +615,38 @@ def test_api_drf_authentication_class(app, admin, user_ou1, oidc_client):
     assert response.json['errors']
 
 
+def test_api_credentials_cache(settings, app, admin, user_ou1):
+    import mock
+    from rest_framework import authentication
+
+    url = '/api/users/%s/' % user_ou1.uuid
+    settings.A2_CACHE_ENABLED = True
+    app.authorization = ('Basic', (admin.username, admin.username))
+    with mock.patch.object(authentication, 'authenticate',
+                           wraps=authentication.authenticate) as authenticate:
+        app.get(url)
+        app.get(url)
+        assert authenticate.call_count == 1
+        # failed verifications are not cached
+        app.authorization = ('Basic', (admin.username, 'wrong'))
+        app.get(url, status=401)
+        app.get(url, status=401)
+        assert authenticate.call_count == 3
+        # cached verifications are invalid once the password changed
+        admin.set_password('new-password')
+        admin.save()
+        app.authorization = ('Basic', (admin.username, admin.username))
+        app.get(url, status=401)
+        app.authorization = ('Basic', (admin.username, 'new-password'))
+        app.get(url)
+        app.get(url)
+        assert authenticate.call_count == 5
+        admin.is_active = False
+        admin.save()
+        resp = app.get(url, status=401)
+        assert resp.json['errors'] == "User inactive or deleted."
+
+
 def test_api_check_password(app, superuser, oidc_client, user_ou1):
     app.authorization = ('Basic', (superuser.username, superuser.username))
     # test with invalid paylaod
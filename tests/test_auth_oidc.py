@@ -410,3 +410,55 @@ def test_strategy_find_uuid(app, caplog, code, oidc_provider, oidc_provider_jwks
         with oidc_provider_mock(oidc_provider, oidc_provider_jwkset, code):
             response = response.click(href='logout')
     assert 'https://idp.example.com/logout' in response.content
+
+
+def test_jwkset_kid_selection(db, oidc_provider, oidc_provider_jwkset):
+    if oidc_provider.idtoken_algo != OIDCProvider.ALGO_RSA:
+        return
+    key1 = JWK.generate(kty='RSA', size=512, kid='key1')
+    key2 = JWK.generate(kty='RSA', size=512, kid='key2')
+    jwkset = JWKSet()
+    jwkset.add(key1)
+    jwkset.add(key2)
+    oidc_provider.jwkset_json = json.loads(jwkset.export())
+    oidc_provider.save()
+    assert oidc_provider.get_jwk('key1').key_id == 'key1'
+    assert oidc_provider.get_jwk('key2').key_id == 'key2'
+    # parsed JWKSet is cached until the provider is modified
+    assert oidc_provider.jwkset is oidc_provider.jwkset
+    # unknown kid, every keys are tried
+    assert len(oidc_provider.get_jwk('key3')['keys']) == 2
+
+
+def test_refresh_jwkset(db, oidc_provider, oidc_provider_jwkset):
+    from authentic2_auth_oidc.utils import refresh_jwkset
+
+    oidc_provider.idtoken_algo = OIDCProvider.ALGO_RSA
+    oidc_provider.jwks_uri = 'https://idp.example.com/jwks'
+    oidc_provider.save()
+    new_key = JWK.generate(kty='RSA', size=512, kid='new')
+    new_jwkset = JWKSet()
+    new_jwkset.add(new_key)
+    requests = []
+
+    @urlmatch(netloc='idp.example.com', path='/jwks')
+    def jwks_mock(url, request):
+        requests.append(request)
+        if request.headers.get('If-None-Match') == '"v2"':
+            return {'status_code': 304, 'content': ''}
+        return {
+            'content': new_jwkset.export(private_keys=False),
+            'headers': {
+                'content-type': 'application/json',
+                'ETag': '"v2"',
+            },
+        }
+
+    with HTTMock(jwks_mock):
+        assert refresh_jwkset(oidc_provider) is True
+        assert oidc_provider.get_jwk('new').key_id == 'new'
+        assert OIDCProvider.objects.get().jwkset_etag == '"v2"'
+        # conditional request, nothing changed
+        assert refresh_jwkset(oidc_provider) is False
+    assert requests[1].headers['If-None-Match'] == '"v2"'
+    assert OIDCProvider.objects.get().jwkset_refreshed is not None
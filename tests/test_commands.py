@@ -115,3 +115,110 @@ def test_resetpassword(simple_user):
 def test_sync_metadata(db):
     test_file = py.path.local(__file__).dirpath('metadata.xml').strpath
     management.call_command('sync-metadata', test_file)
+
+
+def test_sync_metadata_aggregate(db, tmpdir, capsys):
+    from authentic2.saml.models import LibertyProvider, LibertyServiceProvider
+
+    entity = py.path.local(__file__).dirpath('metadata.xml').read().split('?>', 1)[1]
+
+    def write_aggregate(*entity_ids):
+        path = tmpdir.join('aggregate.xml')
+        path.write('<EntitiesDescriptor xmlns="urn:oasis:names:tc:SAML:2.0:metadata">%s'
+                   '</EntitiesDescriptor>' % ''.join(
+                       entity.replace('http://sp6/metadata', entity_id)
+                       for entity_id in entity_ids))
+        return path.strpath
+
+    path = write_aggregate('http://sp1/metadata', 'http://sp2/metadata', 'http://sp3/metadata')
+    management.call_command('sync-metadata', path, source='fed', verbosity=2)
+    assert LibertyProvider.objects.filter(federation_source='fed').count() == 3
+    assert LibertyServiceProvider.objects.count() == 3
+    out, err = capsys.readouterr()
+    assert 'Loaded 3 providers' in out
+
+    # unchanged entities are reloaded if attribute consuming services are loaded
+    path = write_aggregate('http://sp1/metadata', 'http://sp2/metadata', 'http://sp3/metadata')
+    management.call_command('sync-metadata', path, source='fed', verbosity=2)
+    out, err = capsys.readouterr()
+    assert 'Loaded 3 providers' in out
+    assert 'Skipped 0 unchanged providers' in out
+
+    # otherwise they are skipped, obsolete ones are removed
+    path = write_aggregate('http://sp1/metadata', 'http://sp2/metadata')
+    management.call_command('sync-metadata', path, source='fed', verbosity=2,
+                            load_attribute_consuming_service=False)
+    out, err = capsys.readouterr()
+    assert 'Skipped 2 unchanged providers' in out
+    assert 'Deleted obsolete provider http://sp3/metadata' in out
+    assert set(LibertyProvider.objects.values_list('entity_id', flat=True)) == set([
+        'http://sp1/metadata', 'http://sp2/metadata'])
+
+
+def test_refresh_metadata(db, settings):
+    from httmock import urlmatch, HTTMock
+    from authentic2.saml import common
+    from authentic2.saml.models import LibertyProvider, KeyValue
+    import utils
+
+    requests = []
+    status = {'code': 200}
+
+    @urlmatch(netloc=r'sp\d\.example\.com')
+    def metadata_mock(url, request):
+        requests.append(request)
+        if status['code'] != 200:
+            return {'status_code': status['code'], 'content': ''}
+        if request.headers.get('If-None-Match') == '"1"':
+            return {'status_code': 304, 'content': ''}
+        return {
+            'status_code': 200,
+            'headers': {'ETag': '"1"', 'Content-Type': 'application/samlmetadata+xml'},
+            'content': utils.saml_sp_metadata('https://%s' % url.netloc),
+        }
+
+    # autoload is queued
+    settings.SAML_METADATA_AUTOLOAD = 'sp'
+    settings.SAML_METADATA_AUTOLOAD_ASYNC = True
+    assert common.load_provider(None, 'https://sp1.example.com/') is False
+    assert KeyValue.objects.count() == 1
+
+    with HTTMock(metadata_mock):
+        management.call_command('refresh-metadata')
+    assert KeyValue.objects.count() == 0
+    provider = LibertyProvider.objects.get()
+    assert provider.entity_id == 'https://sp1.example.com/'
+    assert provider.metadata_url == 'https://sp1.example.com/'
+    assert provider.metadata_next_refresh > now()
+
+    # refresh is not due
+    with HTTMock(metadata_mock):
+        management.call_command('refresh-metadata')
+    assert len(requests) == 1
+
+    # first refresh stores the ETag, next one is conditional
+    with HTTMock(metadata_mock):
+        management.call_command('refresh-metadata', force=True)
+        management.call_command('refresh-metadata', force=True)
+    provider.refresh_from_db()
+    assert provider.metadata_etag == '"1"'
+    assert requests[-1].headers['If-None-Match'] == '"1"'
+    assert provider.metadata_refresh_failures == 0
+
+    # failures delay the next refresh exponentially
+    status['code'] = 500
+    with HTTMock(metadata_mock):
+        management.call_command('refresh-metadata', force=True)
+        management.call_command('refresh-metadata', force=True)
+    provider.refresh_from_db()
+    assert provider.metadata_refresh_failures == 2
+    delay = (provider.metadata_next_refresh - now()).total_seconds()
+    assert 500 < delay <= 600
+
+
+def test_enqueue_metadata_autoload_unicode(db):
+    from authentic2.saml import common
+    from authentic2.saml.models import KeyValue
+
+    common.enqueue_metadata_autoload(u'https://sp.example.com/\xe9t\xe9/')
+    assert KeyValue.objects.get().value == (u'https://sp.example.com/\xe9t\xe9/', 'sp')
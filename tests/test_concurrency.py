@@ -1,8 +1,13 @@
 from django.db import connection
 
 from authentic2.models import Attribute, AttributeValue
+from authentic2.decorators import DjangoCache
 
 import threading
+import time
+
+import mock
+import pytest
 
 from utils import skipif_sqlite
 
@@ -48,3 +53,118 @@ def test_attribute_value_uniqueness(migrations, transactional_db, simple_user, c
         connection.close()
     map_threads(f, range(concurrency))
     assert AttributeValue.objects.filter(attribute=single_at).count() == 1
+
+
+@pytest.fixture
+def frozen_time(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+def test_django_cache_stale_while_revalidate(settings, frozen_time):
+    settings.A2_CACHE_ENABLED = True
+    calls = []
+    recompute = threading.Event()
+
+    @DjangoCache(timeout=10, hostname_vary=False, jitter=0)
+    def compute(x):
+        calls.append(x)
+        if len(calls) > 1:
+            recompute.wait(5)
+        return len(calls)
+
+    compute.cache.clear()
+    assert compute(1) == 1
+    assert compute(1) == 1
+    assert len(calls) == 1
+
+    # once expired, a single caller recomputes the value, concurrent callers get the stale one
+    frozen_time[0] += 11
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(compute(1))) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for i in range(500):
+        if len(results) == 9:
+            break
+        time.sleep(0.01)
+    assert results == [1] * 9
+    recompute.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [1] * 9 + [2]
+    assert len(calls) == 2
+    assert compute(1) == 2
+    assert compute.cache.stats() == {'hits': 2, 'misses': 2, 'stale_hits': 9}
+
+    # after the grace delay values are recomputed
+    frozen_time[0] += 21
+    assert compute(1) == 3
+
+
+def test_django_cache_invalidation(settings, frozen_time):
+    settings.A2_CACHE_ENABLED = True
+    calls = []
+
+    @DjangoCache(timeout=100, hostname_vary=False, jitter=0.5)
+    def compute(x):
+        calls.append(x)
+        return len(calls)
+
+    assert compute(1) == 1
+    assert compute(2) == 2
+    key = compute.cache.key(1)
+    value, expires = compute.cache.get(key)
+    assert value == 1
+    # TTLs are jittered
+    assert frozen_time[0] + 100 <= expires <= frozen_time[0] + 150
+
+    # expired entries can be deleted
+    compute.cache.delete(key, (value, expires))
+    assert compute.cache.get(key) == (None, None)
+    assert compute(1) == 3
+
+    # clear() changes the version stored with values
+    compute.cache.clear()
+    assert compute.cache.get(key) == (None, None)
+    assert compute(1) == 4
+    assert compute(2) == 5
+
+
+def test_django_cache_methods(settings):
+    settings.A2_CACHE_ENABLED = True
+
+    class A(object):
+        @DjangoCache(timeout=100, hostname_vary=False)
+        def compute(self):
+            return 'a'
+
+    class B(object):
+        @DjangoCache(timeout=100, hostname_vary=False)
+        def compute(self):
+            return 'b'
+
+    # methods with the same name in one module do not share keys
+    assert A().compute() == 'a'
+    assert B().compute() == 'b'
+    assert A.__dict__['compute'].cache.key() != B.__dict__['compute'].cache.key()
+
+
+def test_django_cache_round_trips(settings, monkeypatch):
+    import authentic2.decorators
+
+    settings.A2_CACHE_ENABLED = True
+    cache = mock.Mock(wraps=authentic2.decorators.django_cache)
+    monkeypatch.setattr(authentic2.decorators, 'django_cache', cache)
+
+    @DjangoCache(timeout=100, hostname_vary=False)
+    def compute(x):
+        return x
+
+    assert compute(1) == 1
+    cache.reset_mock()
+    # the version and the value are fetched together
+    assert compute(1) == 1
+    assert cache.get_many.call_count == 1
+    assert cache.get.call_count == 0
@@ -57,3 +57,34 @@ def test_deterministic_encryption():
                 assert crypto.aes_base64url_deterministic_decrypt(key, crypted1, salt,
                                                                   max_count=count) == raw
             print 'Decryption time:', hash_name, count, (time.time() - t) / 1000.0
+
+
+def test_authenticated_encryption():
+    for i in range(10):
+        s = str(random.getrandbits(1024))
+        crypted = crypto.aes_base64_authenticated_encrypt(key, s)
+        assert '$' not in crypted
+        assert crypto.aes_base64_authenticated_decrypt(key, crypted) == s
+    # payloads produced by aes_base64_encrypt are still readable
+    assert crypto.aes_base64_authenticated_decrypt(key, crypto.aes_base64_encrypt(key, s)) == s
+
+    with pytest.raises(crypto.DecryptionError):
+        crypto.aes_base64_authenticated_decrypt('5678', crypted)
+    with pytest.raises(crypto.DecryptionError):
+        crypto.aes_base64_authenticated_decrypt(key, crypted[:-4] + 'AAAA')
+    with pytest.raises(crypto.DecryptionError):
+        crypto.aes_base64_authenticated_decrypt(key, 'xxxx')
+    assert crypto.aes_base64_authenticated_decrypt(key, 'xxxx', raise_on_error=False) is None
+    assert crypto.aes_base64_authenticated_decrypt(key, 'xxx$y', raise_on_error=False) is None
+
+
+@pytest.mark.benchmark
+def test_authenticated_encryption_benchmark():
+    s = str(random.getrandbits(256))
+    for encrypt, decrypt in [(crypto.aes_base64_encrypt, crypto.aes_base64_decrypt),
+                             (crypto.aes_base64_authenticated_encrypt,
+                              crypto.aes_base64_authenticated_decrypt)]:
+        t = time.time()
+        for i in range(100):
+            assert decrypt(key, encrypt(key, s)) == s
+        print 'Round-trip time:', encrypt.__name__, (time.time() - t) / 100.0
@@ -572,6 +572,7 @@ def test_invalid_request(caplog, oidc_settings, oidc_client, simple_user, app):
 
     # authorization has expired
     OIDCCode.objects.all().delete()
+    OIDCAuthorization.objects.all().delete()
     authorize.expired = now() - datetime.timedelta(days=2)
     authorize.save()
     response = app.get(authorize_url)
@@ -651,7 +652,7 @@ def test_expired_manager(db, simple_user):
         expired=expired)
     OIDCAuthorization.objects.create(
         client=client,
-        user=simple_user,
+        user=User.objects.create(username='other'),
         scopes='openid',
         expired=not_expired)
     assert OIDCAuthorization.objects.count() == 2
@@ -944,3 +945,139 @@ def test_api_synchronization(app, oidc_client):
     if status == 200:
         assert response.json['result'] == 1
         assert set(response.json['unknown_uuids']) == deleted_subs
+
+
+def test_create_user_info_claims_plan(settings, simple_oidc_client, simple_user):
+    from authentic2_idp_oidc.utils import create_user_info, get_claims_plan
+
+    settings.A2_CACHE_ENABLED = True
+    get_claims_plan.cache.clear()
+    OIDCClaim.objects.create(client=simple_oidc_client, name='email',
+                             value='django_user_email', scopes='email')
+    user_info = create_user_info(simple_oidc_client, simple_user, set(['openid', 'email']))
+    assert user_info['email'] == simple_user.email
+    user_info = create_user_info(simple_oidc_client, simple_user, set(['openid']))
+    assert 'email' not in user_info
+
+    # plan is invalidated on claim save
+    OIDCClaim.objects.create(client=simple_oidc_client, name='given_name',
+                             value='django_user_first_name', scopes='profile')
+    user_info = create_user_info(simple_oidc_client, simple_user, set(['openid', 'profile']))
+    assert user_info['given_name'] == simple_user.first_name
+    assert 'email' not in user_info
+
+
+def test_user_info_cache(settings, simple_oidc_client, simple_user):
+    from authentic2_idp_oidc.utils import get_user_info
+
+    settings.A2_IDP_OIDC_USER_INFO_CACHE_TIMEOUT = 10
+    OIDCClaim.objects.create(client=simple_oidc_client, name='email',
+                             value='django_user_email', scopes='email')
+    email = simple_user.email
+    assert get_user_info(simple_oidc_client, simple_user, set(['openid', 'email']))['email'] == email
+    simple_user.email = 'other@example.net'
+    simple_user.save()
+    assert get_user_info(simple_oidc_client, simple_user, set(['openid', 'email']))['email'] == email
+    settings.A2_IDP_OIDC_USER_INFO_CACHE_TIMEOUT = 0
+    assert (get_user_info(simple_oidc_client, simple_user, set(['openid', 'email']))['email']
+            == 'other@example.net')
+
+
+def test_signed_access_token(oidc_settings, app, simple_oidc_client, simple_user):
+    simple_oidc_client.access_token_format = OIDCClient.ACCESS_TOKEN_FORMAT_SIGNED
+    simple_oidc_client.save()
+    OIDCClaim.objects.create(client=simple_oidc_client, name='email',
+                             value='django_user_email', scopes='email')
+    utils.login(app, simple_user)
+    redirect_uri = simple_oidc_client.redirect_uris.split()[0]
+    params = {
+        'client_id': simple_oidc_client.client_id,
+        'scope': 'openid email',
+        'redirect_uri': redirect_uri,
+        'response_type': 'code',
+    }
+    response = app.get(make_url('oidc-authorize', params=params))
+    response = response.form.submit('accept')
+    query = urlparse.parse_qs(urlparse.urlparse(response['Location']).query)
+    response = app.post(make_url('oidc-token'), params={
+        'grant_type': 'authorization_code',
+        'code': query['code'][0],
+        'redirect_uri': redirect_uri,
+    }, headers=client_authentication_headers(simple_oidc_client))
+    access_token = response.json['access_token']
+    assert OIDCAccessToken.objects.count() == 0
+
+    user_info_url = make_url('oidc-user-info')
+    response = app.get(user_info_url, headers=bearer_authentication_headers(access_token))
+    assert response.json['email'] == simple_user.email
+
+    # tampered tokens are refused
+    app.get(user_info_url, headers=bearer_authentication_headers('x' + access_token),
+            status=401)
+
+    # tokens are revoked on logout
+    utils.logout(app)
+    app.get(user_info_url, headers=bearer_authentication_headers(access_token), status=401)
+
+
+def test_signed_access_token_deleted_user(oidc_settings, app, simple_oidc_client, simple_user):
+    from authentic2_idp_oidc.utils import create_access_token
+
+    simple_oidc_client.access_token_format = OIDCClient.ACCESS_TOKEN_FORMAT_SIGNED
+    simple_oidc_client.save()
+    access_token = create_access_token(simple_oidc_client, simple_user, 'openid', 'abcd',
+                                       now() + datetime.timedelta(seconds=60))
+    user_info_url = make_url('oidc-user-info')
+    app.get(user_info_url, headers=bearer_authentication_headers(access_token))
+    simple_user.delete()
+    app.get(user_info_url, headers=bearer_authentication_headers(access_token), status=401)
+
+
+def test_signed_access_token_session_check(oidc_settings, app, simple_oidc_client, simple_user,
+                                           monkeypatch):
+    from django.conf import settings
+    from importlib import import_module
+    from authentic2_idp_oidc import utils as oidc_utils
+
+    simple_oidc_client.access_token_format = OIDCClient.ACCESS_TOKEN_FORMAT_SIGNED
+    simple_oidc_client.save()
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session.create()
+    access_token = oidc_utils.create_access_token(
+        simple_oidc_client, simple_user, 'openid', session.session_key,
+        now() + datetime.timedelta(seconds=60))
+    user_info_url = make_url('oidc-user-info')
+    # recent tokens are not checked against the session store
+    session.delete()
+    app.get(user_info_url, headers=bearer_authentication_headers(access_token))
+    # older ones are refused once their session is gone, even without a logout
+    monkeypatch.setattr(oidc_utils, 'SIGNED_ACCESS_TOKEN_SESSION_CHECK_DELAY', -1)
+    app.get(user_info_url, headers=bearer_authentication_headers(access_token), status=401)
+    session.create()
+    access_token = oidc_utils.create_access_token(
+        simple_oidc_client, simple_user, 'openid', session.session_key,
+        now() + datetime.timedelta(seconds=60))
+    app.get(user_info_url, headers=bearer_authentication_headers(access_token))
+
+
+def test_authorization_upsert(oidc_settings, app, simple_oidc_client, simple_user):
+    utils.login(app, simple_user)
+    redirect_uri = simple_oidc_client.redirect_uris.split()[0]
+
+    def authorize(scope):
+        return app.get(make_url('oidc-authorize', params={
+            'client_id': simple_oidc_client.client_id,
+            'scope': scope,
+            'redirect_uri': redirect_uri,
+            'response_type': 'code',
+        }))
+
+    response = authorize('openid email')
+    response = response.form.submit('accept')
+    assert OIDCAuthorization.objects.get().scopes == 'email openid'
+    response = authorize('openid profile')
+    response = response.form.submit('accept')
+    # a single authorization is kept, with the union of authorized scopes
+    assert OIDCAuthorization.objects.get().scopes == 'email openid profile'
+    response = authorize('openid email profile')
+    assert response['Location'].startswith(redirect_uri)
@@ -174,7 +174,7 @@ def test_keep_password_in_session(slapd, settings, client):
     assert not user.check_password(PASS)
     assert client.session['ldap-data']['password']
     assert DN in result.context['request'].user.ldap_data['password']
-    assert crypto.aes_base64_decrypt(
+    assert crypto.aes_base64_authenticated_decrypt(
         settings.SECRET_KEY, result.context['request'].user.ldap_data['password'][DN]) == PASS
 
 
@@ -561,3 +561,56 @@ def test_user_cannot_change_password(slapd, settings, app, db):
     assert 'Password' not in response
     response = app.get('/accounts/password/change/')
     assert response['Location'].endswith('/accounts/')
+
+
+def test_attributes_cache(slapd, settings, client, db):
+    settings.A2_CACHE_ENABLED = True
+    settings.LDAP_AUTH_SETTINGS = [{
+        'url': [slapd.ldap_url],
+        'basedn': u'o=ôrga',
+        'use_tls': False,
+        'keep_password_in_session': True,
+        'attributes': ['uid', 'carLicense'],
+        'attributes_cache_timeout': 60,
+    }]
+    result = client.post('/login/', {'login-password-submit': '1',
+                                     'username': USERNAME,
+                                     'password': PASS}, follow=True)
+    user = result.context['request'].user
+    stats = dict(ldap_backend.ATTRIBUTES_CACHE_STATS)
+    # attributes retrieved during login are reused
+    with mock.patch.object(ldap_backend.LDAPBackend, 'get_ldap_attributes') as get_ldap_attributes:
+        attributes = user.get_attributes()
+        assert get_ldap_attributes.call_count == 0
+    assert attributes['uid'] == [UID]
+    assert ldap_backend.ATTRIBUTES_CACHE_STATS['hits'] == stats['hits'] + 1
+
+    conn = slapd.get_connection_external()
+    conn.modify_s(DN, [(ldap.MOD_REPLACE, 'carLicense', ['123'])])
+    assert 'carlicense' not in user.get_attributes()
+    assert user.get_attributes(refresh=True)['carlicense'] == [u'123']
+    assert user.get_attributes()['carlicense'] == [u'123']
+
+    # changing the password clears the cache
+    conn.modify_s(DN, [(ldap.MOD_REPLACE, 'carLicense', ['456'])])
+    user.set_password(u'ogre')
+    assert user.get_attributes()['carlicense'] == [u'456']
+    assert ldap_backend.ATTRIBUTES_CACHE_STATS['misses'] > stats['misses']
+
+
+def test_attributes_cache_key(settings):
+    settings.LDAP_AUTH_SETTINGS = [{
+        'url': ['ldap://localhost'],
+        'basedn': u'o=ôrga',
+        'attributes': ['uid'],
+    }]
+    block = ldap_backend.LDAPBackend.get_config()[0]
+    key = ldap_backend.LDAPBackend.get_ldap_attributes_cache_key(block, DN)
+    assert key == ldap_backend.LDAPBackend.get_ldap_attributes_cache_key(dict(block), DN)
+    # changing the retrieved attributes or the mappings changes the key
+    for name, value in [('attributes', ['uid', 'carLicense']),
+                        ('attribute_mappings', [['uid', 'login']]),
+                        ('mandatory_attributes_values', {'title': ['x']})]:
+        changed = dict(block)
+        changed[name] = value
+        assert ldap_backend.LDAPBackend.get_ldap_attributes_cache_key(changed, DN) != key
@@ -1,3 +1,5 @@
+import re
+
 import pytest
 from urllib import quote
 
@@ -117,3 +119,66 @@ def test_session_remember_me_nok(app, settings, simple_user, freezer):
     freezer.move_to('2018-01-31')
     response = app.get('/')
     assert simple_user.first_name not in response
+
+
+def test_login_blocks_cache(db, app, settings, simple_user):
+    import django_webtest
+    from authentic2.views import get_csrf_token_placeholder
+
+    settings.A2_CACHE_ENABLED = True
+    response = app.get('/login/?next=/whatever')
+    assert 'register/?next=/whatever"' in response
+    assert get_csrf_token_placeholder() not in response.content
+    csrf_token = response.form['csrfmiddlewaretoken'].value
+
+    # another client gets the cached blocks with its own CSRF token and can log in
+    other_app = django_webtest.DjangoTestApp(extra_environ={'HTTP_HOST': 'localhost'})
+    response = other_app.get('/login/?next=/whatever')
+    assert get_csrf_token_placeholder() not in response.content
+    assert response.form['csrfmiddlewaretoken'].value != csrf_token
+    response.form.set('username', simple_user.username)
+    response.form.set('password', simple_user.username)
+    response = response.form.submit(name='login-password-submit')
+    assert response.location.endswith('/whatever')
+    assert int(other_app.session['_auth_user_id']) == simple_user.pk
+
+    # blocks are shared between next URLs, their values are substituted after the lookup
+    response = app.get('/login/?next=/other')
+    assert 'register/?next=/other"' in response
+
+    def blocks(url):
+        content = app.get(url).content
+        return re.sub(r'name=.csrfmiddlewaretoken. value=.[^\'"]*.', '', content)
+
+    url = '/login/?next=/other%3Fa%3D1%26b%3D%3Cb%3E&nonce=xyz'
+    settings.A2_CACHE_ENABLED = False
+    uncached = blocks(url)
+    assert '?next=/other%3Fa%3D1%26b%3D%3Cb%3E"' in uncached
+    settings.A2_CACHE_ENABLED = True
+    assert blocks(url) == uncached
+    assert blocks(url) == uncached
+
+
+def test_login_blocks_cache_key(rf):
+    from authentic2.views import get_login_blocks_cache_key
+
+    key = get_login_blocks_cache_key(rf.get('/login/?next=/a'), [])
+    assert key == get_login_blocks_cache_key(rf.get('/login/?next=/b%3Fx%3D1'), [])
+    assert key != get_login_blocks_cache_key(rf.get('/login/?next=/a&nonce=1'), [])
+    # unknown parameters do not fill the cache
+    assert get_login_blocks_cache_key(rf.get('/login/?next=/a&x=1'), []) is None
+    assert get_login_blocks_cache_key(rf.get('/login/?next=/a&next=/b'), []) is None
+
+
+@pytest.mark.benchmark
+def test_login_blocks_cache_benchmark(db, app, settings):
+    import time
+
+    count = 50
+    for enabled in (False, True):
+        settings.A2_CACHE_ENABLED = enabled
+        t = time.time()
+        for i in range(count):
+            app.get('/login/?next=/whatever')
+        print 'Login blocks cache', 'enabled' if enabled else 'disabled', \
+            'time per page:', (time.time() - t) / count
@@ -124,7 +124,7 @@ def test_export_csv(settings, app, superuser, django_assert_num_queries):
     user_count = User.objects.count()
     # queries should be batched to keep prefetching working without
     # overspending memory for the queryset cache, 4 queries by batches
-    num_queries = 9 + 4 * (user_count / DEFAULT_BATCH_SIZE + bool(user_count % DEFAULT_BATCH_SIZE))
+    num_queries = 7 + 4 * (user_count / DEFAULT_BATCH_SIZE + bool(user_count % DEFAULT_BATCH_SIZE))
     with django_assert_num_queries(num_queries):
          response = response.click('CSV')
     table = list(csv.reader(response.content.splitlines()))
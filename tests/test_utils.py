@@ -1,3 +1,5 @@
+import pytest
+
 from authentic2.utils import good_next_url, same_origin, select_next_url
 
 
@@ -46,3 +48,144 @@ def test_select_next_url(rf, settings):
     assert select_next_url(request, '/') == '/'
     settings.A2_REDIRECT_WHITELIST = ['//example.com/']
     assert select_next_url(request, '/') == 'http://example.com/'
+
+
+def test_store_request_middleware(rf):
+    import threading
+    from django.core.signals import request_finished
+    from authentic2.middleware import StoreRequestMiddleware
+
+    middleware = StoreRequestMiddleware()
+    request = rf.get('/')
+    middleware.process_request(request)
+    assert StoreRequestMiddleware.get_request() is request
+
+    # each thread sees its own request
+    seen = []
+
+    def other_request():
+        seen.append(StoreRequestMiddleware.get_request())
+        other = rf.get('/other/')
+        middleware.process_request(other)
+        seen.append(StoreRequestMiddleware.get_request() is other)
+
+    thread = threading.Thread(target=other_request)
+    thread.start()
+    thread.join()
+    assert seen == [None, True]
+    assert StoreRequestMiddleware.get_request() is request
+
+    middleware.process_exception(request, ValueError())
+    assert StoreRequestMiddleware.get_request() is None
+
+    middleware.process_request(request)
+    middleware.process_response(request, None)
+    assert StoreRequestMiddleware.get_request() is None
+
+    # the request is forgotten even if process_response() is skipped
+    middleware.process_request(request)
+    request_finished.send(sender=None)
+    assert StoreRequestMiddleware.get_request() is None
+
+
+def test_lru_cache(monkeypatch):
+    import threading
+    import time
+    from authentic2.utils import LRUCache
+
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+
+    cache = LRUCache(max_size=2, timeout=10)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache['a'] == 1
+    # b is the least recently used entry
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert 'a' in cache and 'c' in cache
+    now[0] += 11
+    assert cache.get('a') is None
+    assert 'c' not in cache
+    cache.purge()
+    assert len(cache) == 0
+    assert cache.stats() == {
+        'hits': 1,
+        'misses': 2,
+        'evictions': 1,
+        'expirations': 2,
+        'size': 0,
+        'max_size': 2,
+    }
+    cache['d'] = 4
+    cache.clear()
+    assert len(cache) == 0
+
+    # concurrent accesses never exceed the size bound
+    cache = LRUCache(max_size=100)
+
+    def worker(n):
+        for i in range(1000):
+            cache[(n, i)] = i
+            cache.get((n, i - 1))
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(cache) == 100
+    assert cache.stats()['evictions'] == 8 * 1000 - 100
+
+
+def test_global_cache_bounded(settings):
+    from authentic2.decorators import GlobalCache
+
+    settings.A2_CACHE_ENABLED = True
+    calls = []
+
+    @GlobalCache(hostname_vary=False, max_size=10)
+    def f(x):
+        calls.append(x)
+        return x * 2
+
+    for i in range(20):
+        assert f(i) == i * 2
+    assert f(19) == 38
+    assert len(calls) == 20
+    stats = f.cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 20
+    assert stats['evictions'] == 10
+    assert stats['size'] == 10
+    f.cache.invalidate(sender=None)
+    assert f(19) == 38
+    assert len(calls) == 21
+
+
+@pytest.mark.parametrize('wanted_attributes', [
+    # SAML attribute release plan
+    ['django_user_email', 'django_user_first_name', 'django_user_ou_slug', 'a2_role_slugs'],
+    # CAS service with its identifier attribute
+    ['django_user_username', 'django_user_full_name'],
+])
+def test_get_attributes_wanted_attributes(db, simple_user, monkeypatch, wanted_attributes):
+    from authentic2.attributes_ng.engine import get_attributes
+    from authentic2.attributes_ng.sources import django_user
+
+    get_attribute_names = django_user.get_attribute_names
+    calls = []
+
+    def counting_get_attribute_names(instance, ctx):
+        calls.append(instance)
+        return get_attribute_names(instance, ctx)
+
+    monkeypatch.setattr(django_user, 'get_attribute_names', counting_get_attribute_names)
+    ctx = {'request': None, 'user': simple_user, 'service': None}
+    full = get_attributes(ctx)
+    del calls[:]
+    pruned = get_attributes(dict(ctx, __wanted_attributes=wanted_attributes))
+    # attribute names collected by the topological sort are reused for pruning
+    assert len(calls) == 1
+    for name in wanted_attributes:
+        assert pruned[name] == full[name]
@@ -1,11 +1,15 @@
 from urlparse import urlparse
+import time
 
 from utils import login
 import pytest
+import mock
 
 from django.core.urlresolvers import reverse
 
 from authentic2.custom_user.models import User
+from authentic2.models import PasswordReset
+from authentic2.utils import get_session_store
 
 pytestmark = pytest.mark.django_db
 
@@ -46,3 +50,144 @@ def test_custom_account(settings, app, simple_user):
     response = app.get(reverse('account_management'))
     assert response.status_code == 302
     assert response['Location'] == settings.A2_ACCOUNTS_URL
+
+
+@pytest.mark.parametrize('cache_enabled', [False, True])
+def test_session_saves(settings, app, simple_user, cache_enabled):
+    settings.A2_CACHE_ENABLED = cache_enabled
+    SessionStore = get_session_store()
+    save = SessionStore.save
+
+    with mock.patch.object(SessionStore, 'save', autospec=True, side_effect=save) as mocked_save:
+        login(app, simple_user, path=reverse('account_management'))
+        # login must persist the session
+        assert mocked_save.call_count > 0
+
+        # page views do not modify the session
+        app.get(reverse('account_management'))
+        mocked_save.reset_mock()
+        for i in range(3):
+            app.get(reverse('account_management'))
+            app.get(reverse('auth_homepage'))
+        assert mocked_save.call_count == 0
+
+        # sessions of active users are still saved from time to time, their expiry slides
+        with mock.patch('authentic2.middleware.time') as mocked_time:
+            mocked_time.time.return_value = time.time() + settings.SESSION_COOKIE_AGE / 2 + 1
+            app.get(reverse('account_management'))
+            assert mocked_save.call_count == 1
+            app.get(reverse('account_management'))
+            assert mocked_save.call_count == 1
+        mocked_save.reset_mock()
+
+        # the password reset flag is not kept in the session
+        PasswordReset.objects.create(user=simple_user)
+        response = app.get(reverse('account_management'))
+        assert urlparse(response['Location']).path == reverse('auth_password_change')
+
+        PasswordReset.objects.filter(user=simple_user).delete()
+        app.get(reverse('account_management'))
+        mocked_save.reset_mock()
+        app.get(reverse('account_management'))
+        assert mocked_save.call_count == 0
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('cache_enabled', [False, True])
+def test_session_saves_benchmark(settings, app, simple_user, cache_enabled):
+    settings.A2_CACHE_ENABLED = cache_enabled
+    login(app, simple_user, path=reverse('account_management'))
+    count = 100
+    t = time.time()
+    for i in range(count):
+        app.get(reverse('account_management'))
+    print 'Database sessions, cache', 'enabled' if cache_enabled else 'disabled', \
+        'requests per second:', count / (time.time() - t)
+
+
+def test_logging_collector():
+    import logging
+    import threading
+    from authentic2.middleware import ThreadCollector, ThreadTrackingHandler
+
+    collector = ThreadCollector(max_items=10)
+    handler = ThreadTrackingHandler(collector)
+
+    def log(count, msg='message %s'):
+        for i in range(count):
+            handler.handle(logging.makeLogRecord({'msg': msg, 'args': (i,),
+                                                  'levelname': 'DEBUG'}))
+
+    # records are dropped outside of a collection
+    log(5)
+    assert collector.get_collection() is None
+
+    # collections are bounded and per thread
+    collector.start_collection()
+    log(100)
+    thread = threading.Thread(target=log, args=(5,))
+    thread.start()
+    thread.join()
+    records = handler.format_records(collector.get_collection())
+    assert [record['message'] for record in records] == [
+        'message %s' % i for i in range(90, 100)]
+    collector.clear_collection()
+    assert collector.get_collection() is None
+
+
+@pytest.mark.benchmark
+def test_logging_collector_benchmark():
+    import logging
+    from authentic2.middleware import ThreadCollector, ThreadTrackingHandler
+
+    collector = ThreadCollector(max_items=10)
+    handler = ThreadTrackingHandler(collector)
+
+    # formatting is deferred until records are displayed
+    count = 10000
+    for label, formatter in [('eager', handler.format), ('lazy', lambda record: None)]:
+        collector.start_collection(200)
+        t = time.time()
+        for i in range(count):
+            record = logging.makeLogRecord({'msg': 'assertion %s %s', 'args': ('x' * 1000, i),
+                                            'levelname': 'DEBUG'})
+            formatter(record)
+            handler.handle(record)
+        print 'Log collection,', label, 'formatting, time per record:', \
+            (time.time() - t) / count, 'kept records:', len(collector.get_collection())
+        collector.clear_collection()
+
+
+def test_logging_collector_middleware(settings, rf):
+    import logging
+    from django.core.exceptions import MiddlewareNotUsed
+    from authentic2.middleware import LoggingCollectorMiddleware, logging_handler
+
+    settings.A2_LOG_COLLECTION_ENABLED = False
+    with pytest.raises(MiddlewareNotUsed):
+        LoggingCollectorMiddleware()
+
+    settings.A2_LOG_COLLECTION_ENABLED = True
+    settings.INTERNAL_IPS = ['127.0.0.1']
+    logger = logging.getLogger('authentic2.test_logging_collector')
+    logger.setLevel(logging.INFO)
+    try:
+        middleware = LoggingCollectorMiddleware()
+        assert logging_handler in logging.root.handlers
+        request = rf.get('/', REMOTE_ADDR='127.0.0.1')
+        middleware.process_request(request)
+        logger.info('before error')
+        middleware.process_exception(request, ValueError('error'))
+        assert [log['message'] for log in request.logs] == ['before error']
+        # collections are freed at the end of requests
+        assert logging_handler.collector.get_collection() is None
+
+        request = rf.get('/', REMOTE_ADDR='10.0.0.1')
+        middleware.process_request(request)
+        logger.info('before error')
+        middleware.process_exception(request, ValueError('error'))
+        assert not hasattr(request, 'logs')
+        middleware.process_response(request, None)
+        assert logging_handler.collector.get_collection() is None
+    finally:
+        logging.root.removeHandler(logging_handler)